@@ -0,0 +1,49 @@
+"""
+Compare speed of creating books by single-item API and by bulk API.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.bulk --books 10000
+"""
+from benchmarks.common import create_client, generate_books
+
+from fastapi.testclient import TestClient
+
+from typing import Dict, List
+
+import argparse
+import tempfile
+import time
+
+
+def single_create(client: TestClient, books: List[Dict]) -> None:
+    for book in books:
+        assert client.post("/book", json=book).status_code == 200
+
+
+def bulk_create(client: TestClient, books: List[Dict], batch_size: int) -> None:
+    for i in range(0, len(books), batch_size):
+        assert client.post("/book/bulk", json=books[i:i + batch_size]).status_code == 200
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=5000, help="number of books to create")
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of books in one bulk request")
+    args = parser.parse_args()
+
+    books = generate_books(args.books)
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, storage_type in [("memory", "memory"), ("sqlite", f"sqlite:{data_dir}/{{}}.db")]:
+            for mode in ["single", "bulk"]:
+                with create_client(storage_type.format(mode)) as client:
+                    start = time.perf_counter()
+                    if mode == "single":
+                        single_create(client, books)
+                    else:
+                        bulk_create(client, books, args.batch_size)
+                    elapsed = time.perf_counter() - start
+                print(f"{name:8} {mode:8} {len(books) / elapsed:12.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+from fastapi.testclient import TestClient
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import socket
+import threading
+import time
+
+
+def generate_books(count: int) -> List[Dict]:
+    return [{"author": f"Author {i % 1000}", "title": f"Title {i}", "published_date": f"{1900 + i % 120}-01-01"}
+            for i in range(count)]
+
+
+def load_app(storage_type: str):
+    """Create application with the storage: the storage is opened when the application is started."""
+    from rest_app.rest import Settings, create_app
+    return create_app(Settings(storage_type=storage_type))
+
+
+def create_client(storage_type: str) -> TestClient:
+    """Client of the new application: use it as context manager to start and stop the application."""
+    return TestClient(load_app(storage_type))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def run_server(app) -> Iterator[str]:
+    """Run application by uvicorn in the background thread. Provide base URL."""
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
@@ -0,0 +1,62 @@
+"""
+Measure latency of reads under mixed read/write load from concurrent clients through uvicorn server.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.concurrency --clients 32 --requests 200
+"""
+from benchmarks.common import generate_books, load_app, percentile, run_server
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import argparse
+import requests
+import tempfile
+import time
+
+
+def client_load(base_url: str, requests_count: int, write_every: int) -> List[float]:
+    """Send requests: one write per `write_every` reads. Return latencies of reads."""
+    latencies = []
+    with requests.Session() as session:
+        for i in range(requests_count):
+            if i % write_every == 0:
+                book = generate_books(1)[0]
+                session.post(f"{base_url}/book", json=book).raise_for_status()
+                continue
+            start = time.perf_counter()
+            session.get(f"{base_url}/book/list", params={"author": "Author 1*", "limit": 20}).raise_for_status()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=10000, help="number of books in the storage")
+    parser.add_argument("--clients", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=100, help="number of requests of every client")
+    parser.add_argument("--write-every", type=int, default=10, help="one write per this number of requests")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, storage_type in [("memory", "memory"), ("sqlite", f"sqlite:{data_dir}/books.db")]:
+            with run_server(load_app(storage_type)) as base_url:
+                books = generate_books(args.books)
+                for i in range(0, len(books), 1000):
+                    requests.post(f"{base_url}/book/bulk", json=books[i:i + 1000]).raise_for_status()
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                    futures = [executor.submit(client_load, base_url, args.requests, args.write_every)
+                               for _ in range(args.clients)]
+                    latencies = sum([future.result() for future in futures], [])
+                elapsed = time.perf_counter() - start
+
+            total = args.clients * args.requests
+            print(f"{name:8} {total / elapsed:8.0f} req/s   "
+                  f"p50 {percentile(latencies, 50) * 1000:7.2f} ms   "
+                  f"p99 {percentile(latencies, 99) * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compare throughput of single-book writes from concurrent writers with one transaction per write and with group
+commit (concurrent writes share one transaction), for both `synchronous` modes of SQLite.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.group_commit --writes 2000
+"""
+from benchmarks.common import generate_books, percentile
+from rest_app import get_storage
+from rest_app.domain import BookUpdate
+
+from typing import List
+
+import argparse
+import asyncio
+import tempfile
+import time
+
+
+async def writer(storage, books: List[BookUpdate], latencies: List[float]) -> None:
+    for book in books:
+        start = time.perf_counter()
+        await storage.create(book)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_writers(storage, books: List[BookUpdate], writers: int) -> List[float]:
+    latencies = []
+    await asyncio.gather(*[writer(storage, books[i::writers], latencies) for i in range(writers)])
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=2000, help="number of created books in every run")
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 10, 100], help="numbers of concurrent writers")
+    parser.add_argument("--group-size", type=int, default=64, help="max number of writes in one transaction")
+    args = parser.parse_args()
+
+    books = [BookUpdate(**book) for book in generate_books(args.writes)]
+    with tempfile.TemporaryDirectory() as data_dir:
+        for synchronous in ["NORMAL", "FULL"]:
+            for writers in args.writers:
+                for group_size in [0, args.group_size]:
+                    storage = get_storage(f"sqlite:{data_dir}/{synchronous}-{writers}-{group_size}.db"
+                                          f"?synchronous={synchronous}&group_commit={group_size}")
+                    loop = asyncio.new_event_loop()
+                    try:
+                        start = time.perf_counter()
+                        latencies = loop.run_until_complete(run_writers(storage, books, writers))
+                        elapsed = time.perf_counter() - start
+                    finally:
+                        loop.close()
+                        storage.close()
+
+                    mode = f"group {group_size}" if group_size else "single"
+                    batch = f"avg batch {storage.group_commit_stats()['avg_batch_size']:5.1f}" if group_size else ""
+                    print(f"{synchronous:7} {writers:4} writers {mode:9} {args.writes / elapsed:9.0f} writes/s   "
+                          f"p50 {percentile(latencies, 50) * 1000:7.2f} ms   "
+                          f"p99 {percentile(latencies, 99) * 1000:7.2f} ms   {batch}")
+
+
+if __name__ == "__main__":
+    main()
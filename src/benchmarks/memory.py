@@ -0,0 +1,47 @@
+"""
+Measure memory usage of the memory storage per book: books as pydantic models and compact mode.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.memory --books 100000
+"""
+from benchmarks.common import generate_books
+from rest_app.domain import BookUpdate
+from rest_app.storage.memory import MemoryBookStorage
+
+import argparse
+import gc
+import tracemalloc
+
+
+def measure(compact: bool, books: int) -> int:
+    """Bytes that are allocated by the storage with books (including indexes)."""
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    # Values are created inside of tracing, so strings that are kept by the storage are counted.
+    updates = [BookUpdate(**book) for book in generate_books(books)]
+    storage = MemoryBookStorage(compact)
+    storage.create_many(updates)
+    del updates
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    storage.close()
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=100000, help="number of books in the catalog")
+    args = parser.parse_args()
+
+    results = {}
+    for compact in [False, True]:
+        results[compact] = measure(compact, args.books)
+        print(f"{'compact' if compact else 'models':8} {results[compact] / args.books:8.1f} bytes/book   "
+              f"{results[compact] / 1024 / 1024:8.1f} MiB")
+    print(f"compact mode saves {1 - results[True] / results[False]:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Measure latency of expensive list requests under overload without and with admission control. Clients send more
+concurrent scans than the server can handle: without limits all of them slow down together, with limits only a few
+are handled at once and the rest are rejected fast with `Retry-After`.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.overload --clients 4 --threads 16
+"""
+from benchmarks.common import free_port, generate_books, percentile
+from benchmarks.workers import start_server
+from rest_app.domain import BookUpdate
+from rest_app.storage.sqlite import SQLiteBookStorage
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from typing import List, Tuple
+
+import argparse
+import json
+import os
+import random
+import requests
+import tempfile
+import time
+
+
+def scan_load(base_url: str, duration: float, books: int) -> Tuple[List[float], int]:
+    """Send scans with random cursors (they are not cached). Return latencies of admitted scans and rejections."""
+    generator = random.Random()
+    latencies = []
+    rejected = 0
+    end = time.perf_counter() + duration
+    with requests.Session() as session:
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            response = session.get(f"{base_url}/book/list",
+                                   params={"title": "*5*", "limit": 200, "after_id": generator.randrange(books)})
+            if response.status_code in [429, 503]:
+                rejected += 1
+                time.sleep(float(response.headers.get("Retry-After", 1)) / 10)  # Impatient clients.
+                continue
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+    return latencies, rejected
+
+
+def client_load(base_url: str, duration: float, books: int, threads: int) -> Tuple[List[float], int]:
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda _: scan_load(base_url, duration, books), range(threads)))
+    return sum([latencies for latencies, _ in results], []), sum(rejected for _, rejected in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=100000, help="number of books in the storage")
+    parser.add_argument("--clients", type=int, default=4, help="number of client processes")
+    parser.add_argument("--threads", type=int, default=16, help="number of concurrent requests of every client")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of the load")
+    parser.add_argument("--concurrency", type=int, default=2, help="limit of concurrent scans with admission control")
+    parser.add_argument("--queue-size", type=int, default=4, help="size of the queue with admission control")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        storage_type = f"sqlite:{data_dir}/books.db"
+        storage = SQLiteBookStorage(f"{data_dir}/books.db")
+        storage.create_many([BookUpdate(**book) for book in generate_books(args.books)])
+        storage.close()
+
+        for name, limits in [("unlimited", {}), ("admission", {"/book/list": args.concurrency})]:
+            port = free_port()
+            server = start_server(storage_type, 1, port, route_concurrency=json.dumps(limits),
+                                  admission_queue_size=str(args.queue_size), request_deadline="2")
+            try:
+                with Pool(args.clients) as pool:
+                    results = pool.starmap(client_load, [(f"http://127.0.0.1:{port}", args.duration, args.books,
+                                                          args.threads)] * args.clients)
+            finally:
+                server.terminate()
+                server.wait()
+            latencies = sum([client_latencies for client_latencies, _ in results], [])
+            rejected = sum(client_rejected for _, client_rejected in results)
+            print(f"{name:10} {len(latencies) / args.duration:7.0f} admitted/s   "
+                  f"p50 {percentile(latencies, 50) * 1000:8.1f} ms   p99 {percentile(latencies, 99) * 1000:8.1f} ms   "
+                  f"{rejected / args.duration:7.0f} rejected/s   (CPUs: {os.cpu_count()})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Micro-benchmarks of the hot helpers: parsing of published dates (`strptime()` formats against the ISO parser) and
+matching of wildcard filters (regular expression compiled on every list against cached matchers).
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.parsing --values 100000
+"""
+from benchmarks.common import generate_books
+from rest_app.domain import parse_iso_date
+from rest_app.storage.wildcard import wildcard_matcher
+
+from datetime import datetime
+
+import argparse
+import re
+import time
+
+
+def parse_by_strptime(date_string: str):
+    """Previous parser: formats are tried one by one until `strptime()` does not raise an error."""
+    for date_format in ["%Y-%m-%d", "%Y-%m", "%Y"]:
+        try:
+            return datetime.strptime(date_string, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def measure(name: str, function, values: list, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for value in values:
+            function(value)
+    per_value = (time.perf_counter() - start) / repeat / len(values)
+    print(f"{name:40} {per_value * 1e9:10.1f} ns/value")
+    return per_value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--values", type=int, default=100000, help="number of parsed and matched values")
+    parser.add_argument("--repeat", type=int, default=3, help="number of repeats")
+    args = parser.parse_args()
+
+    books = generate_books(args.values)
+    for name, dates in [("YYYY-MM-DD", [book["published_date"] for book in books]),
+                        ("YYYY", [book["published_date"][:4] for book in books])]:
+        before = measure(f"strptime() {name}", parse_by_strptime, dates, args.repeat)
+        parse_iso_date.cache_clear()
+        after = measure(f"parse_iso_date() {name}", parse_iso_date, dates, args.repeat)
+        print(f"{'':40} {before / after:10.1f}x faster")
+
+    titles = [book["title"] for book in books]
+    for pattern in ["Title 1*", "*99", "Title ?2*"]:
+        def compile_on_every_list(value, pattern=pattern):  # Previous filter: one list is one value here.
+            return re.compile(pattern.replace("?", ".?").replace("*", ".*")).match(value)
+
+        before = measure(f"re.compile() every list '{pattern}'", compile_on_every_list, titles, args.repeat)
+        after = measure(f"wildcard_matcher() '{pattern}'", lambda value: wildcard_matcher(pattern)(value), titles,
+                        args.repeat)
+        print(f"{'':40} {before / after:10.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Compare full-text search with search by wildcard filters of the list on a generated catalog.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.search --books 100000
+"""
+from rest_app.domain import BookUpdate
+from rest_app.storage.memory import MemoryBookStorage
+from rest_app.storage.sqlite import SQLiteBookStorage
+
+from typing import List
+
+import argparse
+import random
+import tempfile
+import time
+
+WORDS = ["ancient", "bright", "castle", "dragon", "empire", "forest", "garden", "harbor", "island", "journey",
+         "kingdom", "legend", "mountain", "night", "ocean", "palace", "quest", "river", "shadow", "tower"]
+
+
+def generate_books(count: int) -> List[BookUpdate]:
+    generator = random.Random(1)
+    return [BookUpdate(author=f"Author {generator.randrange(count // 10 + 1)}",
+                       title=" ".join(generator.sample(WORDS, 3)).title() + f" {i}")
+            for i in range(count)]
+
+
+def measure(name: str, function, repeat: int) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        found = function()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:32} {elapsed * 1000:9.2f} ms   {len(found):7} books")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=100000, help="number of books in the catalog")
+    parser.add_argument("--repeat", type=int, default=5, help="number of repeats of every query")
+    args = parser.parse_args()
+
+    books = generate_books(args.books)
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, storage in [("memory", MemoryBookStorage()), ("sqlite", SQLiteBookStorage(f"{data_dir}/books.db"))]:
+            storage.create_many(books)
+            measure(f"{name} list title=*Dragon*Tower*",
+                    lambda: storage.list(title="*Dragon*Tower*", limit=100), args.repeat)
+            measure(f"{name} search dragon tower", lambda: storage.search("dragon tower", limit=100), args.repeat)
+            measure(f"{name} list title=*Castle 12*", lambda: storage.list(title="*Castle 12*", limit=100), args.repeat)
+            measure(f"{name} search castle 12", lambda: storage.search("castle 12", limit=100), args.repeat)
+            storage.close()
+
+
+if __name__ == "__main__":
+    main()
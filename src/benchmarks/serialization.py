@@ -0,0 +1,58 @@
+"""
+Compare per-row cost of the list serialization: validated models of books (`Book` for every row and `Book.json()`)
+and trusted records of the storage encoded directly to JSON.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.serialization --books 100000
+"""
+from benchmarks.common import generate_books
+from rest_app.domain import BookUpdate
+from rest_app.encoding import book_record, encode_records, orjson
+from rest_app.storage.memory import MemoryBookStorage
+from rest_app.storage.sqlite import SQLiteBookStorage
+
+import argparse
+import tempfile
+import time
+
+
+def measure(name: str, function, rows: int, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    per_row = (time.perf_counter() - start) / repeat / rows
+    print(f"{name:32} {per_row * 1e6:8.2f} us/row")
+    return per_row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=100000, help="number of books in the catalog")
+    parser.add_argument("--page", type=int, default=1000, help="number of books in the list")
+    parser.add_argument("--repeat", type=int, default=20, help="number of repeats of every list")
+    args = parser.parse_args()
+
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    books = [BookUpdate(**book) for book in generate_books(args.books)]
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, storage in [("memory", MemoryBookStorage()), ("sqlite", SQLiteBookStorage(f"{data_dir}/books.db"))]:
+            storage.create_many(books)
+            validated = measure(
+                f"{name} validated",
+                lambda: b"".join(encode_records(map(book_record, storage.list(limit=args.page)), False)),
+                args.page, args.repeat)
+            validated_json = measure(
+                f"{name} validated + Book.json()",
+                lambda: b"[" + b",".join(book.json().encode() for book in storage.list(limit=args.page)) + b"]",
+                args.page, args.repeat)
+            trusted = measure(
+                f"{name} trusted records",
+                lambda: b"".join(encode_records(storage.list_records(limit=args.page), False)),
+                args.page, args.repeat)
+            print(f"{name:32} {validated_json / trusted:8.1f}x faster than Book.json(), "
+                  f"{validated / trusted:.1f}x faster than validated records")
+            storage.close()
+
+
+if __name__ == "__main__":
+    main()
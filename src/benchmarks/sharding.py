@@ -0,0 +1,73 @@
+"""
+Measure scaling of sharded SQLite storage by number of shards: throughput of single-book writes from concurrent
+writers and latency of a full scan (filter that can not use indexes), which is run on all shards in parallel.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.sharding --shards 1 2 4 --writers 8
+"""
+from benchmarks.common import generate_books, percentile
+from rest_app.domain import BookUpdate
+from rest_app.storage.sqlite import SQLiteBookStorage
+from rest_app.storage.sqlite_sharded import ShardedSQLiteBookStorage
+
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import os
+import tempfile
+import time
+
+
+def measure_writes(storage, books: list, writers: int) -> float:
+    """Create books one by one from concurrent threads. Return writes per second."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        for i in range(writers):
+            executor.submit(lambda part: [storage.create(book) for book in part], books[i::writers])
+    return len(books) / (time.perf_counter() - start)
+
+
+def measure_scans(storage, repeat: int) -> list:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        storage.list_records(title="*99")  # Leading wildcard and no limit: every book of every shard is checked.
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=200000, help="number of books for scans")
+    parser.add_argument("--writes", type=int, default=2000, help="number of single-book writes")
+    parser.add_argument("--writers", type=int, default=8, help="number of concurrent writers")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="numbers of shards")
+    parser.add_argument("--synchronous", default="FULL", help="synchronous pragma of databases")
+    parser.add_argument("--repeat", type=int, default=20, help="number of scans")
+    args = parser.parse_args()
+
+    books = [BookUpdate(**book) for book in generate_books(args.books)]
+    pragmas = {"synchronous": args.synchronous}
+    print(f"cpus: {os.cpu_count()}")
+    with tempfile.TemporaryDirectory() as data_dir:
+        storages = [("sqlite", lambda: SQLiteBookStorage(f"{data_dir}/books.db", args.writers, pragmas))]
+        for shards in args.shards:
+            storages.append((f"{shards} shards", lambda shards=shards: ShardedSQLiteBookStorage(
+                f"{data_dir}/{shards}", shards, args.writers, pragmas)))
+
+        for name, open_storage in storages:
+            storage = open_storage()
+            try:
+                writes = measure_writes(storage, books[:args.writes], args.writers)
+                for i in range(args.writes, len(books), 10000):
+                    storage.create_many(books[i:i + 10000])
+                latencies = measure_scans(storage, args.repeat)
+            finally:
+                storage.close()
+            print(f"{name:10} {writes:9.0f} writes/s   "
+                  f"scan p50 {percentile(latencies, 50) * 1000:8.2f} ms   "
+                  f"p99 {percentile(latencies, 99) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measure warm start of the memory storage with snapshot: loading of books from the snapshot and from the log.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.snapshot --books 1000000
+"""
+from benchmarks.common import generate_books
+from rest_app.domain import BookUpdate
+from rest_app.storage.memory import PersistentMemoryBookStorage
+
+import argparse
+import os
+import tempfile
+import time
+
+
+def start_storage(name: str, snapshot_path: str, compact: bool) -> PersistentMemoryBookStorage:
+    start = time.perf_counter()
+    storage = PersistentMemoryBookStorage(snapshot_path, compact)
+    print(f"{name:32} {time.perf_counter() - start:8.2f} s   {len(storage.books):9} books")
+    return storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=1000000, help="number of books in the snapshot")
+    parser.add_argument("--log", type=int, default=10000, help="number of books that are created after snapshot")
+    args = parser.parse_args()
+
+    books = [BookUpdate(**book) for book in generate_books(args.books)]
+    with tempfile.TemporaryDirectory() as data_dir:
+        for compact in [False, True]:
+            mode = "compact" if compact else "models"
+            snapshot_path = os.path.join(data_dir, f"{mode}.snapshot")
+
+            storage = PersistentMemoryBookStorage(snapshot_path, compact, snapshot_log_size=2 ** 62)
+            storage.load(len(books), [(i + 1, book.author, book.title, book.published_date)
+                                      for i, book in enumerate(books)])
+            storage.snapshot()
+            print(f"{mode} snapshot: {os.path.getsize(snapshot_path) / 1024 / 1024:.1f} MiB")
+            storage.create_many(books[:args.log])
+            storage.log.close()  # Stop without snapshot.
+
+            start_storage(f"{mode} snapshot + log", snapshot_path, compact).close()
+            start_storage(f"{mode} snapshot", snapshot_path, compact).close()
+
+
+if __name__ == "__main__":
+    main()
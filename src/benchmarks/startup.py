@@ -0,0 +1,98 @@
+"""
+Measure start time of the service by storage: import of the application module, creation of the application and its
+startup (storage is opened), the first request and reopening of the storage in the same process (schema is checked
+once per process). Every run is a fresh Python process, like a new worker.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.startup --repeat 10
+"""
+from typing import Any, Dict
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+async def call_app(app, path: str, query_string: bytes) -> int:
+    """Call ASGI application directly (test client would add its own imports to the measurement). Return status."""
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path, "root_path": "",
+             "query_string": query_string, "headers": [], "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 80)}
+    messages = []
+
+    async def receive() -> Dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: Dict[str, Any]) -> None:
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]["status"]
+
+
+def measure_startup(storage_type: str) -> Dict[str, float]:
+    """Run in the fresh process: durations of start steps (milliseconds) and whether SQLite code was loaded."""
+    start = time.perf_counter()
+    from rest_app.rest import Settings, create_app
+    imported = time.perf_counter()
+    app = create_app(Settings(storage_type=storage_type))
+    created = time.perf_counter()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(app.router.startup())
+    started = time.perf_counter()
+    assert loop.run_until_complete(call_app(app, "/book/list", b"limit=1")) == 200
+    requested = time.perf_counter()
+    loop.run_until_complete(app.router.shutdown())
+    loop.close()
+
+    from rest_app import get_storage
+    reopen_start = time.perf_counter()
+    get_storage(storage_type).close()
+    reopened = time.perf_counter()
+    return {
+        "import_ms": (imported - start) * 1000,
+        "create_ms": (created - imported) * 1000,
+        "startup_ms": (started - created) * 1000,
+        "first_request_ms": (requested - started) * 1000,
+        "reopen_ms": (reopened - reopen_start) * 1000,
+        "sqlite_loaded": "sqlite3" in sys.modules,
+    }
+
+
+def run_process(storage_type: str, lazy_assets: bool) -> Dict[str, float]:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path), PRELOAD_STATIC_ASSETS=str(not lazy_assets))
+    output = subprocess.check_output([sys.executable, "-m", "benchmarks.startup", "--child", storage_type], env=env)
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10, help="number of processes for every storage")
+    parser.add_argument("--lazy-assets", action="store_true", help="compress static assets on the first request")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_startup(args.child)))
+        return
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        storages = [("memory", "memory"),
+                    ("sqlite", f"sqlite:{data_dir}/books.db"),
+                    ("sharded", f"sqlite-sharded:{data_dir}/shards:4")]
+        for name, storage_type in storages:
+            # The first process creates the databases.
+            runs = [run_process(storage_type, args.lazy_assets) for _ in range(args.repeat)]
+            steps = " ".join(f"{step[:-3]} {statistics.median(run[step] for run in runs):6.1f} ms"
+                             for step in ["import_ms", "create_ms", "startup_ms", "first_request_ms", "reopen_ms"])
+            print(f"{name:8} {steps}   sqlite loaded: {any(run['sqlite_loaded'] for run in runs)}")
+
+
+if __name__ == "__main__":
+    main()
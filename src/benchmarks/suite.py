@@ -0,0 +1,314 @@
+"""
+Benchmark suite: generate catalog, send requests to every endpoint with memory and SQLite storages (in-process by test
+client and through uvicorn server) and save ops/sec and latency percentiles as JSON. Only the request of the scenario
+is timed: books that it needs (like the book to delete) are created by its setup before.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.suite run --books 10000 --output bench/new.json
+    PYTHONPATH=src python -m benchmarks.suite compare bench/old.json bench/new.json
+"""
+from benchmarks.common import generate_books, load_app, percentile, run_server
+
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+STORAGES = ["memory", "sqlite"]
+MODES = ["inprocess", "server"]
+
+
+class Client:
+    """The same interface for test client and HTTP session: paths are relative to base URL."""
+
+    def __init__(self, session: Any, base_url: str = ""):
+        self.session = session
+        self.base_url = base_url
+
+    def request(self, method: str, path: str, **kwargs) -> Any:
+        response = self.session.request(method, self.base_url + path, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {path}: {response.status_code} {response.text[:200]}")
+        return response
+
+
+class Context:
+    """State that is shared by requests of scenarios: catalog size and IDs of books."""
+
+    def __init__(self, books: int, seed: int = 1):
+        self.books = books
+        self.random = random.Random(seed)
+
+    def random_id(self) -> int:
+        return self.random.randint(1, self.books)
+
+    def random_book(self) -> Dict:
+        i = self.random_id()
+        return {"author": f"Author {i % 1000}", "title": f"Title {i}", "published_date": f"{1900 + i % 120}-01-01"}
+
+
+def list_page(client: Client, context: Context) -> None:
+    client.request("GET", "/book/list", params={"limit": 100})
+
+
+def list_next_page(client: Client, context: Context) -> None:
+    client.request("GET", "/book/list", params={"limit": 100, "after_id": context.random_id()})
+
+
+def list_author(client: Client, context: Context) -> None:
+    client.request("GET", "/book/list", params={"author": f"Author {context.random.randrange(1000)}", "limit": 100})
+
+
+def list_title_prefix(client: Client, context: Context) -> None:
+    client.request("GET", "/book/list", params={"title": f"Title {context.random_id()}*", "limit": 100})
+
+
+def list_date_range(client: Client, context: Context) -> None:
+    year = 1900 + context.random.randrange(120)
+    client.request("GET", "/book/list", params={"published_date_from": f"{year}-01-01",
+                                                "published_date_to": f"{year + 1}-01-01",
+                                                "order_by": "published_date",
+                                                "limit": 100})
+
+
+def list_uncached(client: Client, context: Context, _book_id: int) -> None:
+    # New book of the setup changes version of the storage, so the list is read from the storage.
+    client.request("GET", "/book/list", params={"limit": 100})
+
+
+def stats(client: Client, context: Context) -> None:
+    year = 1900 + context.random.randrange(120)
+    client.request("GET", "/book/stats", params={"group_by": "month", "published_date_from": f"{year}-01-01"})
+
+
+def changes(client: Client, context: Context) -> None:
+    client.request("GET", "/book/changes", params={"since": context.random_id(), "limit": 100})
+
+
+def metrics(client: Client, context: Context) -> None:
+    client.request("GET", "/metrics")
+
+
+def export_author(client: Client, context: Context) -> None:
+    client.request("GET", "/book/export", params={"author": f"Author {context.random.randrange(1000)}"})
+
+
+def search(client: Client, context: Context) -> None:
+    client.request("GET", "/book/search", params={"q": f"title {context.random_id()}", "limit": 10})
+
+
+def get(client: Client, context: Context) -> None:
+    client.request("GET", f"/book/{context.random_id()}")
+
+
+def add(client: Client, context: Context) -> None:
+    client.request("POST", "/book", json=context.random_book())
+
+
+def update(client: Client, context: Context, book_id: int) -> None:
+    client.request("PUT", f"/book/{book_id}", json={"title": f"Title {book_id} (2nd edition)"})
+
+
+def patch(client: Client, context: Context) -> None:
+    book_id = context.random_id()
+    client.request("PATCH", f"/book/{book_id}", json={"title": f"Title {book_id} (revised)"})
+
+
+def delete(client: Client, context: Context, book_id: int) -> None:
+    client.request("DELETE", f"/book/{book_id}")
+
+
+def bulk_add(client: Client, context: Context) -> None:
+    client.request("POST", "/book/bulk", json=generate_books(100))
+
+
+def bulk_update(client: Client, context: Context) -> None:
+    client.request("PUT", "/book/bulk", json=[{"id": context.random_id(), "title": "Updated"} for _ in range(100)])
+
+
+def bulk_delete(client: Client, context: Context, book_ids: List[int]) -> None:
+    client.request("DELETE", "/book/bulk", json=book_ids)
+
+
+def create_book(client: Client, context: Context) -> Tuple[int]:
+    return client.request("POST", "/book", json=context.random_book()).json()["id"],
+
+
+def create_books(client: Client, context: Context) -> Tuple[List[int]]:
+    books = client.request("POST", "/book/bulk", json=generate_books(100)).json()
+    return [result["book"]["id"] for result in books],
+
+
+SCENARIOS: Dict[str, Callable[..., None]] = {
+    "list_page": list_page,
+    "list_next_page": list_next_page,
+    "list_author": list_author,
+    "list_title_prefix": list_title_prefix,
+    "list_date_range": list_date_range,
+    "list_uncached": list_uncached,
+    "export_author": export_author,
+    "search": search,
+    "stats": stats,
+    "changes": changes,
+    "metrics": metrics,
+    "get": get,
+    "add": add,
+    "update": update,
+    "patch": patch,
+    "delete": delete,
+    "bulk_add": bulk_add,
+    "bulk_update": bulk_update,
+    "bulk_delete": bulk_delete,
+}
+# Not timed requests before every request of the scenario: they return arguments of the scenario.
+SETUPS: Dict[str, Callable[[Client, Context], Tuple]] = {
+    "list_uncached": create_book,
+    "update": create_book,
+    "delete": create_book,
+    "bulk_delete": create_books,
+}
+
+
+def fill_storage(app, books: int, batch_size: int = 10000) -> None:
+    """Create books directly in the storage of started application: much faster than by HTTP."""
+    from rest_app.domain import BookUpdate
+    storage = app.state.book_service.storage.storage
+    for start in range(0, books, batch_size):
+        batch = generate_books(min(batch_size, books - start))
+        storage.create_many([BookUpdate(**book) for book in batch])
+
+
+@contextmanager
+def open_client(app, mode: str) -> Iterator[Client]:
+    if mode == "inprocess":
+        from fastapi.testclient import TestClient
+        with TestClient(app) as test_client:  # Startup opens the storage.
+            yield Client(test_client)
+        return
+
+    import requests
+    with run_server(app) as base_url, requests.Session() as session:
+        yield Client(session, base_url)
+
+
+def run_scenario(client: Client, context: Context, name: str, requests_count: int) -> Dict[str, float]:
+    scenario, setup = SCENARIOS[name], SETUPS.get(name)
+    latencies = []
+    for _ in range(requests_count):
+        args = () if setup is None else setup(client, context)
+        request_start = time.perf_counter()
+        scenario(client, context, *args)
+        latencies.append(time.perf_counter() - request_start)
+    return {
+        "requests": requests_count,
+        "ops_per_sec": requests_count / sum(latencies),  # Time of setups is not counted.
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL)
+        return commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args: argparse.Namespace) -> None:
+    scenarios = args.scenarios or list(SCENARIOS.keys())
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for storage in args.storages:
+            for mode in args.modes:
+                storage_type = "memory" if storage == "memory" else f"sqlite:{data_dir}/{mode}.db"
+                app = load_app(storage_type)
+                with open_client(app, mode) as client:
+                    fill_storage(app, args.books)
+                    for name in scenarios:
+                        context = Context(args.books)
+                        result = dict(storage=storage, mode=mode, scenario=name,
+                                      **run_scenario(client, context, name, args.requests))
+                        print(f"{storage:8} {mode:10} {name:18} {result['ops_per_sec']:9.1f} ops/s   "
+                              f"p50 {result['p50_ms']:8.2f} ms   p95 {result['p95_ms']:8.2f} ms   "
+                              f"p99 {result['p99_ms']:8.2f} ms")
+                        results.append(result)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "books": args.books,
+            "requests": args.requests,
+        },
+        "results": results,
+    }
+    if args.output:
+        from pathlib import Path
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+def result_key(result: Dict) -> Tuple[str, str, str]:
+    return result["storage"], result["mode"], result["scenario"]
+
+
+def compare(args: argparse.Namespace) -> int:
+    """Print changes between two reports. Return 1 if throughput of any scenario dropped more than threshold."""
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        baseline, current = json.load(baseline_file), json.load(current_file)
+    print(f"{baseline['meta']['commit']} -> {current['meta']['commit']}")
+
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = 0
+    for result in current["results"]:
+        old = baseline_results.get(result_key(result))
+        if old is None:
+            continue
+        change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        regression = change < -args.threshold
+        regressions += regression
+        print(f"{' '.join(result_key(result)):40} {old['ops_per_sec']:9.1f} -> {result['ops_per_sec']:9.1f} ops/s "
+              f"({change:+7.1%})   p99 {old['p99_ms']:8.2f} -> {result['p99_ms']:8.2f} ms"
+              f"{'   REGRESSION' if regression else ''}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("--books", type=int, default=10000, help="number of books in the catalog (10k - 10M)")
+    run_parser.add_argument("--requests", type=int, default=200, help="number of requests of every scenario")
+    run_parser.add_argument("--storages", nargs="+", choices=STORAGES, default=STORAGES)
+    run_parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    run_parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS.keys()))
+    run_parser.add_argument("--output", help="path of JSON report")
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="allowed drop of ops/sec, 0.1 is 10%%")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
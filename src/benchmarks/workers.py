@@ -0,0 +1,96 @@
+"""
+Measure scaling of read throughput with number of uvicorn worker processes that share SQLite storage. Clients are
+separate processes, so they are not limited by GIL of one process. Also check that every worker sees the new book.
+
+Run from the root directory:
+    PYTHONPATH=src python -m benchmarks.workers --workers 1 2 4 --clients 8
+"""
+from benchmarks.common import free_port, generate_books
+from rest_app.domain import BookUpdate
+from rest_app.storage.sqlite import SQLiteBookStorage
+
+from multiprocessing import Pool
+from typing import List
+
+import argparse
+import os
+import random
+import requests
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def client_load(base_url: str, duration: float, books: int) -> int:
+    """
+    Read random pages of the list during `duration` seconds. Return number of requests. Every request uses new
+    connection: sockets of uvicorn workers do not have TCP_NODELAY, so keep-alive requests wait for delayed ACK.
+    """
+    generator = random.Random(os.getpid())
+    count = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        after_id = generator.randrange(books)
+        requests.get(f"{base_url}/book/list", params={"limit": 20, "after_id": after_id}).raise_for_status()
+        count += 1
+    return count
+
+
+def start_server(storage_type: str, workers: int, port: int, **settings: str) -> subprocess.Popen:
+    """Start uvicorn process, other settings of the application are passed by environment variables."""
+    env = dict(os.environ, storage_type=storage_type, WEB_CONCURRENCY=str(workers), **settings)
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "rest_app.rest:app", "--app-dir", "src",
+                               "--port", str(port), "--log-level", "warning"], env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(600):
+        try:
+            requests.get(f"{base_url}/book/list", params={"limit": 1})
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server was not started")
+
+
+def check_coherence(base_url: str, checks: int) -> None:
+    """New book should be listed by every worker: new connections are accepted by different workers."""
+    book = requests.post(f"{base_url}/book", json=generate_books(1)[0]).json()
+    for _ in range(checks):
+        books = requests.get(f"{base_url}/book/list", params={"after_id": book["id"] - 1}).json()
+        assert book in books, "Worker returned outdated list"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=10000, help="number of books in the storage")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="numbers of worker processes")
+    parser.add_argument("--clients", type=int, default=8, help="number of client processes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of the load")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        storage_type = f"sqlite:{data_dir}/books.db"
+        storage = SQLiteBookStorage(f"{data_dir}/books.db")
+        storage.create_many([BookUpdate(**book) for book in generate_books(args.books)])
+        storage.close()
+
+        results: List[float] = []
+        for workers in args.workers:
+            port = free_port()
+            server = start_server(storage_type, workers, port)
+            base_url = f"http://127.0.0.1:{port}"
+            try:
+                check_coherence(base_url, checks=workers * 4)
+                with Pool(args.clients) as pool:
+                    counts = pool.starmap(client_load, [(base_url, args.duration, args.books)] * args.clients)
+            finally:
+                server.terminate()
+                server.wait()
+            results.append(sum(counts) / args.duration)
+            print(f"{workers:3} workers {results[-1]:9.0f} req/s   {results[-1] / results[0]:5.2f}x   "
+                  f"(CPUs: {os.cpu_count()})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,55 @@
-from rest_app.storage.memory import MemoryBookStorage
-from rest_app.storage.sqlite import SQLiteBookStorage
+from rest_app.storage.asynchronous import AsyncBookStorage, ExecutorBookStorage
 
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qsl
 
-def get_storage(storage_type: str = "memory"):
-    storage_params = storage_type.split(":")
+
+def parse_storage_type(storage_type: str) -> Tuple[List[str], Dict[str, str]]:
+    """Split storage type like "sqlite:<path>?pool_size=8&mmap_size=0" to positional parameters and options."""
+    storage_type, _, options = storage_type.partition("?")
+    return storage_type.split(":"), dict(parse_qsl(options))
+
+
+def get_storage(storage_type: str = "memory", slow_query_threshold: float = 0.0) -> AsyncBookStorage:
+    """
+    Create storage and wrap it to asynchronous interface. Backends are imported here: the application with one backend
+    does not load (and does not pay start time for) the others. SQLite statements that run longer than
+    `slow_query_threshold` seconds are logged (zero disables the log).
+    """
+    storage_params, storage_options = parse_storage_type(storage_type)
     if storage_params[0].lower() in ["sqlite", "sqlite3"]:
         if len(storage_params) != 2:
             raise ValueError('SQLite 3 storage require path of the database: "sqlite:<path_to_database>"')
-        return SQLiteBookStorage(storage_params[1])
+        pool_size = int(storage_options.pop("pool_size", 4))
+        group_commit = int(storage_options.pop("group_commit", 0))  # Max number of writes in one transaction.
+        group_commit_delay = float(storage_options.pop("group_commit_delay", 0.0))
+        from rest_app.storage.sqlite import SQLiteBookStorage
+        # Other options are pragmas.
+        storage = SQLiteBookStorage(storage_params[1], pool_size, storage_options, slow_query_threshold)
+        if group_commit > 0:
+            from rest_app.storage.group_commit import GroupCommitBookStorage
+            return GroupCommitBookStorage(storage, pool_size, group_commit, group_commit_delay)
+        return ExecutorBookStorage(storage, max_workers=pool_size)  # One reader connection per thread.
+
+    if storage_params[0].lower() == "sqlite-sharded":
+        if len(storage_params) != 3:
+            raise ValueError('Sharded SQLite 3 storage require directory and number of shards: '
+                             '"sqlite-sharded:<path_to_directory>:<shards>"')
+        pool_size = int(storage_options.pop("pool_size", 4))
+        from rest_app.storage.sqlite_sharded import ShardedSQLiteBookStorage
+        storage = ShardedSQLiteBookStorage(storage_params[1], int(storage_params[2]), pool_size, storage_options,
+                                           slow_query_threshold)
+        return ExecutorBookStorage(storage, max_workers=pool_size)
 
-    return MemoryBookStorage()
+    from rest_app.storage.memory import MemoryBookStorage, PersistentMemoryBookStorage
+    compact = storage_options.pop("compact", "0").lower() in ["1", "true", "yes"]
+    if len(storage_params) == 2:  # Memory storage with snapshot: "memory:<path_to_snapshot>".
+        fsync_interval = float(storage_options.pop("fsync_interval", 1.0))
+        storage = PersistentMemoryBookStorage(storage_params[1],
+                                              compact,
+                                              fsync_interval,
+                                              int(storage_options.pop("snapshot_log_size", 64 * 1024 * 1024)))
+        if fsync_interval <= 0:  # Every write waits for the disk: use one thread to not block the event loop.
+            return ExecutorBookStorage(storage, max_workers=1)
+        return AsyncBookStorage(storage)
+    return AsyncBookStorage(MemoryBookStorage(compact))
@@ -0,0 +1,174 @@
+from rest_app.deadline import RequestDeadlineException, task_deadlines
+from rest_app.metrics import ADMISSION_QUEUE_WAIT, ADMISSION_REJECTED
+
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+from starlette.types import Message, Receive, Scope, Send
+
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import asyncio
+import collections
+import time
+
+
+class AdmissionRejectedException(Exception):
+    """Request is not admitted: `reason` is a label of metrics."""
+
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+class RouteLimiter:
+    """
+    Limit of concurrently handled requests of one route with FIFO queue of waiting requests. Slot of the finished
+    request is passed directly to the first waiting one, so new requests can not overtake the queue.
+    """
+
+    def __init__(self, concurrency: int, queue_size: int):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = collections.deque()
+
+    async def acquire(self, timeout: Optional[float]) -> None:
+        """Take a slot, waiting in the queue at most `timeout` seconds (without limit for None)."""
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.queue_size:
+            raise AdmissionRejectedException("queue_full")
+        if timeout is not None and timeout <= 0:
+            raise AdmissionRejectedException("deadline_queued")
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():  # Slot was passed right before the timeout: give it to the next request.
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejectedException("deadline_queued")
+            raise
+
+    def release(self) -> None:
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # Number of active requests is not changed: the slot is passed.
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": self.active, "queued": len(self.waiters)}
+
+
+def route_limiters(limits: Dict[str, int], queue_size: int) -> Dict[str, RouteLimiter]:
+    """Limiters of routes with positive limits."""
+    return {route: RouteLimiter(limit, queue_size) for route, limit in limits.items() if limit > 0}
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware that sheds load of expensive routes before it piles up: requests of the route (template, like
+    "/book/list") are admitted by its limiter, so only a few of them are handled at once, the next ones wait in the
+    bounded queue and others are rejected at once by `status_code` (503 or 429) with `Retry-After` header. Requests of
+    limited routes have the deadline (seconds from arrival, 0 disables it): if the response is not started before it,
+    waiting or handling is cancelled (storage work that was not started by executor threads is cancelled with it,
+    running SQLite queries are interrupted) and the request is rejected.
+    Streamed responses are not cancelled after the start. Other routes are not limited.
+    """
+
+    def __init__(self,
+                 app,
+                 routes: List[Any],
+                 limiters: Dict[str, RouteLimiter],
+                 deadline: float = 0.0,
+                 status_code: int = 503,
+                 retry_after: int = 1):
+        self.app = app
+        self.routes = routes  # Routes of the application are added after the middleware, so they are read later.
+        self.limiters = limiters
+        self.deadline = deadline
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def find_limiter(self, scope: Scope) -> Tuple[Optional[str], Optional[RouteLimiter], Scope]:
+        """Limited route of the request, its limiter and scope of the route (endpoint is used as label of metrics)."""
+        for route in self.routes:
+            limiter = self.limiters.get(getattr(route, "path", None))
+            if limiter is not None:
+                match, child_scope = route.matches(scope)
+                if match is Match.FULL:
+                    return route.path, limiter, child_scope
+        return None, None, {}
+
+    async def reject(self, scope: Scope, receive: Receive, send: Send, route: str, reason: str) -> None:
+        ADMISSION_REJECTED.inc(route, reason)
+        response = JSONResponse(status_code=self.status_code,
+                                content={"message": "Service is overloaded, retry later"},
+                                headers={"Retry-After": str(self.retry_after)})
+        await response(scope, receive, send)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.limiters:
+            await self.app(scope, receive, send)
+            return
+        route, limiter, child_scope = self.find_limiter(scope)
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        deadline = start + self.deadline if self.deadline > 0 else None
+        try:
+            await limiter.acquire(None if deadline is None else deadline - start)
+        except AdmissionRejectedException as e:
+            scope.update(child_scope)  # Rejected requests are labeled by the route too.
+            await self.reject(scope, receive, send, route, e.reason)
+            return
+        ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - start, route)
+        try:
+            if deadline is None:
+                await self.app(scope, receive, send)
+            else:
+                await self.call_before_deadline(scope, receive, send, route, deadline)
+        finally:
+            limiter.release()
+
+    async def call_before_deadline(self, scope: Scope, receive: Receive, send: Send, route: str,
+                                   deadline: float) -> None:
+        started = False
+
+        async def send_with_start(message: Message) -> None:
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        task = asyncio.ensure_future(self.app(scope, receive, send_with_start))
+        task_deadlines[task] = deadline  # Storage calls of the handler read it.
+        try:
+            done, _ = await asyncio.wait([task], timeout=max(deadline - time.perf_counter(), 0))
+            if done or started:
+                try:
+                    await task
+                    return
+                except RequestDeadlineException:  # Query was interrupted right before the timeout.
+                    if started:
+                        raise
+            else:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        except asyncio.CancelledError:  # Client is gone: stop the handler too.
+            task.cancel()
+            raise
+        if not started:
+            await self.reject(scope, receive, send, route, "deadline")
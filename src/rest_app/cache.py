@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import hashlib
+import time
+
+
+class CachedResponse:
+    """Serialized response with its entity tag."""
+
+    __slots__ = ["version", "expires", "body", "etag", "headers"]
+
+    def __init__(self, version: int, expires: float, body: bytes, headers: Dict[str, str]):
+        self.version = version
+        self.expires = expires
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.headers = headers
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized responses with time to live. Responses are saved with version of the storage and are not
+    returned after any change of the storage.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, version: int) -> Optional[CachedResponse]:
+        if version != self.version:  # Storage was changed: all responses are outdated.
+            self.entries.clear()
+            self.version = version
+
+        entry = self.entries.get(key)
+        if entry is None or entry.expires < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Hashable, version: int, body: bytes, headers: Dict[str, str]) -> CachedResponse:
+        """Create response and save it, if it was made for the current version of the storage."""
+        entry = CachedResponse(version, time.monotonic() + self.ttl, body, headers)
+        if self.max_size <= 0 or version != self.version:
+            return entry
+
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
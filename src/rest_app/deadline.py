@@ -0,0 +1,54 @@
+"""
+Deadline of the request that is handled by the current task of the event loop or by the current worker thread.
+Blocking storage calls run in other threads, so the deadline is passed to them explicitly: queries can be stopped when
+nobody waits for their results anymore.
+"""
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+import asyncio
+import threading
+import weakref
+
+# Deadlines (`time.perf_counter()` values) of handlers of admitted requests by their tasks.
+task_deadlines: "weakref.WeakKeyDictionary[asyncio.Task, float]" = weakref.WeakKeyDictionary()
+thread_deadlines = threading.local()
+
+
+class RequestDeadlineException(Exception):
+    """Deadline of the request is passed: its storage query was stopped."""
+
+
+def current_task() -> Optional[asyncio.Task]:
+    try:
+        if hasattr(asyncio, "current_task"):  # Python 3.7+.
+            return asyncio.current_task()
+        return asyncio.Task.current_task()
+    except RuntimeError:  # Not in the event loop.
+        return None
+
+
+def current_deadline() -> Optional[float]:
+    """Deadline of the current worker thread or of the current task, None if the request does not have it."""
+    deadline = getattr(thread_deadlines, "deadline", None)
+    if deadline is not None:
+        return deadline
+    task = current_task()
+    return None if task is None else task_deadlines.get(task)
+
+
+@contextmanager
+def thread_deadline(deadline: Optional[float]) -> Iterator[None]:
+    """Set deadline of the current thread while the block runs."""
+    previous = getattr(thread_deadlines, "deadline", None)
+    thread_deadlines.deadline = deadline
+    try:
+        yield
+    finally:
+        thread_deadlines.deadline = previous
+
+
+def call_with_deadline(deadline: Optional[float], function: Callable, *args, **kwargs) -> Any:
+    """Call function with the deadline of the caller: used by threads of executors."""
+    with thread_deadline(deadline):
+        return function(*args, **kwargs)
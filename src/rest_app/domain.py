@@ -1,7 +1,36 @@
 from pydantic import BaseModel, validator
 
-from datetime import date, datetime
-from typing import Optional
+from datetime import date
+from enum import Enum
+from typing import Any, List, Optional, Tuple
+
+import functools
+import re
+
+WORD = re.compile(r"\w+")
+# Formats of the published date: "YYYY-MM-DD", "YYYY-MM" and "YYYY". Month and day can have one digit, like
+# `strptime()` accepts.
+ISO_DATE = re.compile(r"([0-9]{4})(?:-(1[0-2]|0?[1-9])(?:-(3[01]|[12][0-9]|0?[1-9]))?)?")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Split text to lower case words for the full-text search."""
+    if not text:
+        return []
+    return WORD.findall(text.lower())
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_iso_date(date_string: str) -> Optional[date]:
+    """Parse date by one regular expression. Dates are repeated a lot (SQLite rows), so results are cached."""
+    match = ISO_DATE.fullmatch(date_string)
+    if match is None:
+        return None
+    year, month, day = match.groups()
+    try:
+        return date(int(year), int(month or 1), int(day or 1))
+    except ValueError:  # Day is out of range of the month.
+        return None
 
 
 class BookNotFoundException(Exception):
@@ -11,6 +40,68 @@ class BookNotFoundException(Exception):
         self.book_id = book_id
 
 
+class BookVersionConflictException(Exception):
+    """Book was changed: its version is not the expected one."""
+
+    def __init__(self, book_id: int, version: int):
+        self.book_id = book_id
+        self.version = version
+
+
+class BookChangesCompactedException(Exception):
+    """Changes after the requested one are not known anymore: the client should read all books again."""
+
+    def __init__(self, since: int, first_seq: int):
+        self.since = since
+        self.first_seq = first_seq
+
+
+class StorageBusyException(Exception):
+    """No connection of the storage became free in time: the request should be retried later."""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+
+
+class BookOrder(str, Enum):
+    """Fields that can be used to order the list of books. Books with equal values are ordered by ID."""
+    id = "id"
+    author = "author"
+    title = "title"
+    published_date = "published_date"
+
+    def sort_value(self, book: Any) -> Any:
+        """Value of the field that is used for comparison. Empty values are the first ones."""
+        if self is BookOrder.id:
+            return book.id
+        value = getattr(book, self.value)
+        if value is None:
+            return ""
+        return value.isoformat() if isinstance(value, date) else value
+
+
+class BookFacet(str, Enum):
+    """Fields that books can be counted by: author and year or month of publishing."""
+    author = "author"
+    year = "year"
+    month = "month"
+
+    def group_value(self, author: Optional[str], published_date: Optional[date]) -> Optional[str]:
+        """Value of the group of the book: author or ISO string of year or month."""
+        if self is BookFacet.author:
+            return author
+        if published_date is None:
+            return None
+        return published_date.isoformat()[:4 if self is BookFacet.year else 7]
+
+    def sort_key(self, group: Tuple[Optional[str], int]) -> Any:
+        """Authors are ordered by number of books, dates are ordered by value. Empty values are the first ones."""
+        value, count = group
+        if self is BookFacet.author:
+            return -count, value is not None, value or ""
+        return value is not None, value or ""
+
+
 class BookUpdate(BaseModel):
     """Class for book create or update requests. Contain data that can came from the user."""
     author: Optional[str]
@@ -22,16 +113,7 @@ class BookUpdate(BaseModel):
         if not date_string:
             return None
 
-        supported_formats = ["%Y-%m-%d", "%Y-%m", "%Y"]
-
-        date_val = None
-        for f in supported_formats:
-            try:
-                date_val = datetime.strptime(date_string, f).date()
-                break
-            except ValueError:
-                continue
-
+        date_val = parse_iso_date(date_string)
         if not date_val:
             raise ValueError(f"Published date '{date_string}' have incorrect format")
         else:
@@ -54,3 +136,10 @@ class Book(BookUpdate):
 
     class Config:
         allow_mutation = True
+
+
+class BookBulkResult(BaseModel):
+    """Result for one item of bulk request: HTTP status code and the book or the error message."""
+    status: int
+    book: Optional[Book]
+    message: Optional[str]
@@ -0,0 +1,69 @@
+from rest_app.domain import Book
+
+from datetime import date
+from typing import Any, Iterable, Iterator, Optional, Tuple, Union
+
+import json
+
+try:
+    import orjson
+except ImportError:  # Optional dependency (installed with fastapi[all]), standard encoder is used without it.
+    orjson = None
+
+BOOK_FIELDS = ("id", "author", "title", "published_date")  # Order of columns of the books table.
+
+# Book as it is saved by the storage. Date can be `date` or ISO string (SQLite), both are encoded in the same way.
+BookRecord = Tuple[int, Optional[str], Optional[str], Any]
+# Position in the change feed: number of the change or numbers of changes of every shard joined by dots ("12.0.7").
+ChangeCursor = Union[int, str]
+# Change of the book: cursor after the change, book ID and the current record (None for removed book).
+BookChange = Tuple[ChangeCursor, int, Optional[BookRecord]]
+
+
+def book_record(book: Book) -> BookRecord:
+    return book.id, book.author, book.title, book.published_date
+
+
+def encode_default(value: Any) -> Any:
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value: Any) -> bytes:
+    """Encode value to JSON bytes by orjson, if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=encode_default).encode()
+
+
+def encode_record(record: BookRecord) -> bytes:
+    """Encode record of trusted storage to JSON object without building and validating of `Book` model."""
+    return dumps(dict(zip(BOOK_FIELDS, record)))
+
+
+def encode_change(change: BookChange) -> bytes:
+    seq, book_id, record = change
+    book = None if record is None else dict(zip(BOOK_FIELDS, record))
+    return dumps({"seq": seq, "id": book_id, "deleted": record is None, "book": book})
+
+
+def encode_records(records: Iterable[BookRecord], ndjson: bool, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Encode records as NDJSON or JSON array. Small lines are joined to chunks to reduce number of writes."""
+    separator = b"\n" if ndjson else b","
+    chunk = bytearray() if ndjson else bytearray(b"[")
+    first = True
+    for record in records:
+        if not ndjson and not first:
+            chunk += separator
+        chunk += encode_record(record)
+        if ndjson:
+            chunk += separator
+        first = False
+        if len(chunk) >= chunk_size:
+            yield bytes(chunk)
+            chunk.clear()
+    if not ndjson:
+        chunk += b"]"
+    if chunk:
+        yield bytes(chunk)
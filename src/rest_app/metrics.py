@@ -0,0 +1,222 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import bisect
+import logging
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    """Histogram with labels. Buckets are saved separately and are accumulated only for the output."""
+
+    type = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 description: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values: Dict[LabelValues, List[float]] = {}  # Counts of buckets, +Inf bucket and the sum.
+
+    def observe(self, value: float, *label_values: str) -> None:
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[position] += 1
+            counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = [(label_values, list(counts)) for label_values, counts in self.values.items()]
+        for label_values, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = format_labels(self.labels + ("le",), label_values + (le,))
+                yield f"{self.name}_bucket{labels} {total}"
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {counts[-1]}"
+            yield f"{self.name}_count{labels} {total}"
+
+
+class Gauge:
+    """Value that is read from the callback during the output: used for counters of other objects."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 callback: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def samples(self) -> Iterable[str]:
+        if self.callback is None:
+            return
+        for label_values, value in self.callback().items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+class Registry:
+    """
+    Set of metrics that are exported in Prometheus text format. Metrics of the parent registry (process-wide ones) are
+    exported first.
+    """
+
+    def __init__(self, parent: Optional["Registry"] = None):
+        self.parent = parent
+        self.metrics: Dict[str, object] = {}
+
+    def register(self, metric, replace: bool = False):
+        """
+        Add metric to the registry. Existing metric with the same name is returned instead of the new one, because
+        modules can be reloaded (tests do that) and values should not be lost. Gauges of objects should be replaced.
+        """
+        if replace:
+            self.metrics[metric.name] = metric
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        lines = [self.parent.render().rstrip("\n")] if self.parent is not None else []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "http_requests_total", "Number of HTTP requests.", ["method", "route", "status"]))
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Duration of HTTP requests.", ["method", "route"]))
+STORAGE_OPERATION_DURATION = REGISTRY.register(Histogram(
+    "storage_operation_duration_seconds", "Duration of storage operations.", ["backend", "operation"]))
+STORAGE_ROWS = REGISTRY.register(Counter(
+    "storage_rows_returned_total", "Number of books returned by storage operations.", ["backend", "operation"]))
+VALIDATION_DURATION = REGISTRY.register(Histogram(
+    "book_validation_duration_seconds", "Duration of building pydantic models of books from storage or request.",
+    ["source"]))
+SQLITE_CONNECTION_WAIT = REGISTRY.register(Histogram(
+    "sqlite_connection_wait_seconds", "Time of waiting for SQLite connection from the pool.", ["kind"]))
+SQLITE_QUERY_DURATION = REGISTRY.register(Histogram(
+    "sqlite_query_duration_seconds", "Duration of SQLite statements execution.", ["statement"]))
+SQLITE_GROUP_COMMIT_SIZE = REGISTRY.register(Histogram(
+    "sqlite_group_commit_writes", "Number of writes that are committed by one transaction.", [],
+    (1, 2, 4, 8, 16, 32, 64, 128, 256)))
+SQLITE_GROUP_COMMIT_DURATION = REGISTRY.register(Histogram(
+    "sqlite_group_commit_duration_seconds", "Duration of transactions of grouped writes, including the commit."))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    "admission_rejected_total", "Number of requests that were rejected by admission control.", ["route", "reason"]))
+ADMISSION_QUEUE_WAIT = REGISTRY.register(Histogram(
+    "admission_queue_wait_seconds", "Time of waiting in the queue of the route by admitted requests.", ["route"]))
+
+slow_query_logger = logging.getLogger("rest_app.slow_query")
+
+
+class SlowQueryLog:
+    """Log SQL statements that are executed longer than threshold (seconds). Zero or negative threshold disables log."""
+
+    def __init__(self, threshold: float = 0.0):
+        self.threshold = threshold
+
+    def check(self, duration: float, sql: str) -> None:
+        if 0 < self.threshold <= duration:
+            slow_query_logger.warning("Slow query (%.3f s): %s", duration, " ".join(sql.split()))
+
+
+def time_operation(backend: str, operation: str, function: Callable, *args, **kwargs):
+    """Call storage operation and observe its duration and number of returned books."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    STORAGE_OPERATION_DURATION.observe(time.perf_counter() - start, backend, operation)
+    if isinstance(result, list):
+        STORAGE_ROWS.inc(backend, operation, amount=len(result))
+    return result
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that counts HTTP requests and observes their duration. Requests are labeled by route template
+    (like "/book/{book_id}"), not by path, so the number of label values is bounded.
+    """
+
+    def __init__(self, app, routes: List[Any]):
+        self.app = app
+        self.routes = routes
+        self.route_paths: Dict[Any, str] = {}
+
+    def route_path(self, endpoint: Any) -> str:
+        if endpoint not in self.route_paths:
+            for route in self.routes:  # Endpoint of routes or application of mounts is saved to the scope by router.
+                self.route_paths[getattr(route, "endpoint", None) or getattr(route, "app", None)] = route.path or "/"
+            self.route_paths.setdefault(endpoint, "unknown")
+        return self.route_paths[endpoint]
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500  # Response was not started because of the error.
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = self.route_path(scope.get("endpoint"))
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, scope["method"], route)
+            HTTP_REQUESTS.inc(scope["method"], route, str(status))
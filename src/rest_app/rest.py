@@ -1,75 +1,536 @@
-from rest_app import get_storage
-from rest_app.domain import Book, BookUpdate, BookNotFoundException
+from rest_app import get_storage, parse_storage_type
+from rest_app.admission import AdmissionMiddleware, route_limiters
+from rest_app.cache import ResponseCache
+from rest_app.domain import Book, BookBulkResult, BookChangesCompactedException, BookFacet, BookOrder, BookUpdate, \
+    BookNotFoundException, BookVersionConflictException, StorageBusyException
+from rest_app.encoding import BookChange, BookRecord, ChangeCursor, book_record, dumps, encode_change, \
+    encode_record, encode_records, orjson
+from rest_app.metrics import REGISTRY, VALIDATION_DURATION, Gauge, MetricsMiddleware, Registry
+from rest_app.static import EncodedResponseGZipMiddleware, StaticAssets
+from rest_app.storage.asynchronous import AsyncBookStorage
 
-from fastapi import FastAPI, Request
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 
-from pydantic import BaseSettings
-from typing import List
+from pydantic import BaseSettings, ValidationError, parse_obj_as
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from enum import Enum
+import asyncio
+import functools
+import itertools
+import json
+import re
+import time
 
 
 class Settings(BaseSettings):
     storage_type: str = "sqlite:data/book_storage.db"
+    max_page_size: int = 1000
+    list_cache_size: int = 1024  # Number of cached responses of the book list, 0 disables the cache.
+    list_cache_ttl: float = 60.0  # Seconds.
+    trusted_reads: bool = True  # Encode records of the storage without validation: they were validated on write.
+    web_concurrency: int = 1  # Number of uvicorn worker processes, the same variable is read by uvicorn.
+    slow_query_threshold: float = 0.1  # Seconds, SQLite statements that run longer are logged. 0 disables the log.
+    gzip_minimum_size: int = 1024  # Bytes, larger responses are compressed by gzip. 0 disables compression.
+    changes_poll_interval: float = 0.1  # Seconds between checks of the storage version while clients wait for changes.
+    # Admission control: route -> number of concurrently handled requests, others wait in the queue of the route.
+    route_concurrency: Dict[str, int] = {"/book/list": 16, "/book/search": 16, "/book/stats": 16, "/book/export": 2}
+    admission_queue_size: int = 64  # Requests of the route that can wait, the next ones are rejected at once.
+    request_deadline: float = 10.0  # Seconds for waiting and handling of limited routes until the response. 0 disables.
+    overload_status_code: int = 503  # Status of rejected requests: 503 or 429.
+    overload_retry_after: int = 1  # Seconds, value of `Retry-After` header of rejected requests.
+    preload_static_assets: bool = True  # Compress static assets on startup, otherwise on the first request of them.
+
+
+class ExportFormat(str, Enum):
+    json = "json"
+    ndjson = "ndjson"
+
+
+class BookService:
+    """
+    State of one application: settings, caches and the storage. The storage is opened on startup and closed on
+    shutdown, so the application is created (and worker processes are forked) without opening any files.
+    """
+
+    def __init__(self, setting: Settings):
+        self.setting = setting
+        self.storage: Optional[AsyncBookStorage] = None
+        self.list_cache = ResponseCache(setting.list_cache_size, setting.list_cache_ttl)
+        self.limiters = route_limiters(setting.route_concurrency, setting.admission_queue_size)
+        # Gauges of this application are exported with process-wide metrics, other applications do not replace them.
+        # Values are read on export.
+        self.registry = Registry(REGISTRY)
+        self.registry.register(Gauge("list_cache", "Counters and size of the book list cache.", ["stat"],
+                                     lambda: {(name,): value for name, value in self.list_cache.stats().items()}))
+        self.registry.register(Gauge("sqlite_statement_cache", "Hits and misses of SQLite prepared statements cache.",
+                                     ["stat"], self.statement_cache_metrics))
+        self.registry.register(Gauge("admission_requests", "Numbers of active and queued requests of limited routes.",
+                                     ["route", "state"], self.admission_metrics))
+        self.registry.register(Gauge("sqlite_group_commit", "Counters of grouped SQLite writes.", ["stat"],
+                                     self.group_commit_metrics))
+
+    def open(self) -> None:
+        storage = get_storage(self.setting.storage_type, self.setting.slow_query_threshold)
+        if self.setting.web_concurrency > 1 and storage.backend == "memory":
+            storage.close()
+            raise ValueError("Memory storage can not be shared by worker processes, use SQLite storage")
+        export_limiter = self.limiters.get("/book/export")
+        if storage.backend.startswith("sqlite") and export_limiter is not None:
+            # Every export has its own connection: the limit keeps them fewer than the readers of short queries.
+            pool_size = int(parse_storage_type(self.setting.storage_type)[1].get("pool_size", 4))
+            if export_limiter.concurrency >= pool_size:
+                storage.close()
+                raise ValueError(f"Concurrency of '/book/export' should be less than SQLite pool size {pool_size}")
+        self.storage = storage
+
+    def close(self) -> None:
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+
+    def statement_cache_metrics(self) -> Dict[Tuple[str], float]:
+        # Only SQLite has prepared statements.
+        stats = getattr(getattr(self.storage, "storage", None), "statement_cache_stats", None)
+        return {} if stats is None else {(name,): value for name, value in stats().items()}
+
+    def group_commit_metrics(self) -> Dict[Tuple[str], float]:
+        stats = getattr(self.storage, "group_commit_stats", None)  # Only if group commit is enabled.
+        return {} if stats is None else {(name,): value for name, value in stats().items()}
+
+    def admission_metrics(self) -> Dict[Tuple[str, str], float]:
+        return {(route, state): value
+                for route, limiter in self.limiters.items() for state, value in limiter.stats().items()}
+
 
+async def book_service(request: Request) -> BookService:
+    return request.app.state.book_service
 
-setting = Settings()
-app = FastAPI()
-book_storage = get_storage(setting.storage_type)
+
+router = APIRouter()
 
 
-@app.exception_handler(BookNotFoundException)
 async def book_not_found_exception(_request: Request, exc: BookNotFoundException):
     return JSONResponse(status_code=404, content={"message": f"Book with ID {exc.book_id} not found"})
 
 
-@app.get(
+async def book_version_conflict_exception(_request: Request, exc: BookVersionConflictException):
+    return JSONResponse(status_code=412,
+                        content={"message": f"Book with ID {exc.book_id} was changed"},
+                        headers={"ETag": book_etag(exc.book_id, exc.version)})
+
+
+async def storage_busy_exception(request: Request, exc: StorageBusyException):
+    setting = request.app.state.book_service.setting
+    return JSONResponse(status_code=setting.overload_status_code,
+                        content={"message": f"Storage is busy for {exc.timeout} seconds, retry later"},
+                        headers={"Retry-After": str(setting.overload_retry_after)})
+
+
+async def book_changes_compacted_exception(_request: Request, exc: BookChangesCompactedException):
+    return JSONResponse(status_code=410,
+                        content={"message": f"Changes after {exc.since} are not known, read changes from 0 again"})
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+async def prefetch(storage: AsyncBookStorage, records: Iterator[BookRecord]) -> Iterator[BookRecord]:
+    """Read the first record, so errors of the request are raised before the response is started."""
+    first = await storage.run(next, records, None)
+    if first is None:
+        return iter([])
+    return itertools.chain([first], records)
+
+
+async def validated_list_records(storage: AsyncBookStorage, *args) -> List[BookRecord]:
+    """Records of books that were validated by the storage: used if reads are not trusted."""
+    return [book_record(book) for book in await storage.list(*args)]
+
+
+def validated_iterate_records(storage: AsyncBookStorage, *args, **kwargs) -> Iterator[BookRecord]:
+    return map(book_record, storage.iterate(*args, **kwargs))
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+@router.get(
     "/book/list",
+    response_model=List[Book],  # Schema of the documentation: encoded responses are returned as they are.
     description="""Return the list of books. You are also can filter by book records, like an 'author', 'title' and 
     date of publishing (parameters 'published_date_from' and 'published_date_to'). For 'author' and 'title' you are 
-    also can use primitive regular expressions: '?' for any one symbol and '*' for zero or many any symbols.""")
+    also can use primitive regular expressions: '?' for any one symbol and '*' for zero or many any symbols. 
+    Books are returned by pages of at most 'limit' books ordered by 'order_by' field. If there are more books, 
+    header 'X-Next-Cursor' contains value for 'after_id' parameter to request the next page. With header 
+    'Accept: application/x-ndjson' books are returned one per line.""")
 async def book_list(
+        request: Request,
         author: str = None,
         title: str = None,
         published_date_from: str = None,
-        published_date_to: str = None) -> List[Book]:
-    return book_storage.list(
+        published_date_to: str = None,
+        limit: int = Query(None, ge=1),
+        after_id: int = None,
+        order_by: BookOrder = BookOrder.id,
+        service: BookService = Depends(book_service)) -> Response:
+    limit = min(limit or service.setting.max_page_size, service.setting.max_page_size)
+    date_from = BookUpdate.parse_date_str(published_date_from)
+    date_to = BookUpdate.parse_date_str(published_date_to)
+    ndjson = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+    cache_key = author, title, date_from, date_to, limit, after_id, order_by, ndjson
+    version = service.storage.version  # Read before the storage: response can be older, but not newer than version.
+    cached = service.list_cache.get(cache_key, version)
+    if cached is None:
+        if service.setting.trusted_reads:
+            list_records = service.storage.list_records
+        else:
+            list_records = functools.partial(validated_list_records, service.storage)
+        records = await list_records(
+            author,
+            title,
+            date_from,
+            date_to,
+            limit + 1,  # One more book shows that there is the next page.
+            after_id,
+            order_by
+        )
+        headers = {}
+        if len(records) > limit:
+            records = records[:limit]
+            headers["X-Next-Cursor"] = str(records[-1][0])
+        cached = service.list_cache.put(cache_key, version, b"".join(encode_records(records, ndjson)), headers)
+
+    headers = dict(cached.headers, ETag=cached.etag)
+    if etag_matches(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body,
+                    media_type=NDJSON_MEDIA_TYPE if ndjson else "application/json",
+                    headers=headers)
+
+
+@router.get(
+    "/book/search",
+    response_model=List[Book],
+    description="""Full-text search of books by words of author and title. Every word of the query 'q' should be 
+    found (as beginning of a word), best matches are returned first. Use 'limit' and 'offset' for pagination.""")
+async def book_search(
+        q: str,
+        limit: int = Query(None, ge=1),
+        offset: int = Query(0, ge=0),
+        service: BookService = Depends(book_service)) -> Response:
+    limit = min(limit or service.setting.max_page_size, service.setting.max_page_size)
+    if service.setting.trusted_reads:
+        records = await service.storage.search_records(q, limit, offset)
+    else:
+        records = [book_record(book) for book in await service.storage.search(q, limit, offset)]
+    return Response(content=b"".join(encode_records(records, False)), media_type="application/json")
+
+
+@router.get(
+    "/book/stats",
+    response_model=List[Dict[str, Any]],
+    description="""Return numbers of books by groups: 'author', 'year' or 'month' of publishing (date histogram). 
+    Books can be filtered like in the list. Authors are ordered by number of books, dates are ordered by value. 
+    Use 'limit' to return only the first groups.""")
+async def book_stats(
+        request: Request,
+        group_by: BookFacet = BookFacet.author,
+        author: str = None,
+        title: str = None,
+        published_date_from: str = None,
+        published_date_to: str = None,
+        limit: int = Query(None, ge=1),
+        service: BookService = Depends(book_service)) -> Response:
+    date_from = BookUpdate.parse_date_str(published_date_from)
+    date_to = BookUpdate.parse_date_str(published_date_to)
+
+    cache_key = "stats", group_by, author, title, date_from, date_to, limit
+    version = service.storage.version
+    cached = service.list_cache.get(cache_key, version)
+    if cached is None:
+        groups = await service.storage.count_groups(group_by, author, title, date_from, date_to, limit)
+        body = dumps([{"value": value, "count": count} for value, count in groups])
+        cached = service.list_cache.put(cache_key, version, body, {})
+
+    headers = dict(cached.headers, ETag=cached.etag)
+    if etag_matches(request.headers.get("if-none-match"), cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+
+# Number of the change or numbers of changes of every shard joined by dots (sharded storage).
+CHANGE_CURSOR_PATTERN = r"^\d+(\.\d+)*$"
+
+
+def change_cursor(since: str) -> ChangeCursor:
+    return int(since) if since.isdigit() else since
+
+
+async def wait_changes(service: BookService, since: ChangeCursor, limit: int, timeout: float) -> List[BookChange]:
+    """Changes after `since`. If there are no changes, wait for them at most `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+        version = service.storage.version  # Read before the storage: changes after it are not missed.
+        changes = await service.storage.changes(since, limit)
+        if changes or time.monotonic() >= deadline:
+            return changes
+        while service.storage.version == version and time.monotonic() < deadline:
+            await asyncio.sleep(service.setting.changes_poll_interval)
+
+
+@router.get(
+    "/book/changes",
+    response_model=Dict[str, Any],
+    description="""Return changes of books after the change 'since' (0 for all books), ordered by numbers of changes. 
+    Only the last change of every book is returned, removed books have 'deleted' flag. Use 'last_seq' of the response 
+    as 'since' of the next request: it is a number, or numbers of every shard joined by dots for sharded storage. 
+    With 'wait' seconds the request waits for changes if there are no changes yet (long polling). Status 410 means 
+    that changes after 'since' are not known: read changes from 0 again.""")
+async def book_changes(
+        since: str = Query("0", regex=CHANGE_CURSOR_PATTERN),
+        limit: int = Query(None, ge=1),
+        wait: float = Query(0, ge=0, le=60),
+        service: BookService = Depends(book_service)) -> Response:
+    limit = min(limit or service.setting.max_page_size, service.setting.max_page_size)
+    since = change_cursor(since)
+    changes = await wait_changes(service, since, limit, wait)
+    last_seq = changes[-1][0] if changes else since
+    body = b'{"last_seq":%s,"changes":[%s]}' % (dumps(last_seq), b",".join(map(encode_change, changes)))
+    return Response(content=body, media_type="application/json")
+
+
+async def change_events(service: BookService, since: ChangeCursor, changes: List[BookChange],
+                        timeout: float) -> Iterator[bytes]:
+    deadline = time.monotonic() + timeout
+    while True:
+        if changes:
+            yield b"".join(b"id: %s\nevent: change\ndata: %s\n\n" % (str(change[0]).encode(), encode_change(change))
+                           for change in changes)
+            since = changes[-1][0]
+        else:
+            yield b": no changes\n\n"  # Comment keeps the connection alive through proxies.
+        if time.monotonic() >= deadline:
+            return
+        changes = await wait_changes(service, since, service.setting.max_page_size,
+                                     min(15.0, max(deadline - time.monotonic(), 0)))
+
+
+@router.get(
+    "/book/changes/stream",
+    description="""Stream changes of books after the change 'since' as Server-Sent Events: event 'change' with the 
+    cursor of the change as ID. The stream is closed after 'timeout' seconds, the browser reconnects with 
+    'Last-Event-ID' header that is used instead of 'since'.""")
+async def book_changes_stream(
+        request: Request,
+        since: str = Query("0", regex=CHANGE_CURSOR_PATTERN),
+        timeout: float = Query(300, gt=0, le=3600),
+        service: BookService = Depends(book_service)) -> StreamingResponse:
+    last_event_id = request.headers.get("last-event-id", "")
+    if re.match(CHANGE_CURSOR_PATTERN, last_event_id):
+        since = last_event_id
+    since = change_cursor(since)
+    # Errors are returned before the stream.
+    changes = await service.storage.changes(since, service.setting.max_page_size)
+    return StreamingResponse(change_events(service, since, changes, timeout),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/cache/stats", description="Return statistics of the book list cache.")
+async def cache_stats(service: BookService = Depends(book_service)) -> Dict[str, Any]:
+    return service.list_cache.stats()
+
+
+@router.get("/metrics", description="Return metrics of the service in Prometheus text format.")
+async def metrics(service: BookService = Depends(book_service)) -> PlainTextResponse:
+    return PlainTextResponse(service.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get(
+    "/book/export",
+    description="""Export all books that match the filters of '/book/list' as JSON array or NDJSON ('format' 
+    parameter). Books are streamed from the storage, so the response is not limited by the page size.""")
+async def book_export(
+        author: str = None,
+        title: str = None,
+        published_date_from: str = None,
+        published_date_to: str = None,
+        order_by: BookOrder = BookOrder.id,
+        format: ExportFormat = ExportFormat.ndjson,
+        service: BookService = Depends(book_service)) -> StreamingResponse:
+    if service.setting.trusted_reads:
+        iterate_records = service.storage.iterate_records
+    else:
+        iterate_records = functools.partial(validated_iterate_records, service.storage)
+    records = iterate_records(
         author,
         title,
         BookUpdate.parse_date_str(published_date_from),
-        BookUpdate.parse_date_str(published_date_to)
+        BookUpdate.parse_date_str(published_date_to),
+        order_by=order_by
     )
+    ndjson = format is ExportFormat.ndjson
+    return StreamingResponse(encode_records(await prefetch(service.storage, records), ndjson),
+                             media_type=NDJSON_MEDIA_TYPE if ndjson else "application/json")
 
 
-@app.post("/book", description="Create an new book record.")
-async def book_add(book: BookUpdate) -> Book:
-    persist_book = book_storage.create(book)
+@router.post("/book", description="Create an new book record.")
+async def book_add(book: BookUpdate, service: BookService = Depends(book_service)) -> Book:
+    persist_book = await service.storage.create(book)
     return persist_book
 
 
-@app.delete("/book/{book_id}", description="Delete existing book record. Use Book ID that generated by storage.")
-async def book_delete(book_id: int) -> Book:
-    persist_book = book_storage.find(book_id)
-    book_storage.remove(persist_book.id)
-    return persist_book
+async def read_bulk_items(request: Request) -> List[Any]:
+    """Read items of bulk request from JSON array or NDJSON body."""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Incorrect body: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Body should be an array")
+    return items
 
 
-@app.put("/book/{book_id}", description="Update existing book record. Use Book ID that generated by storage.")
-async def book_update(book_id: int, update: BookUpdate) -> Book:
-    persist_book = book_storage.find(book_id)
+def validate_bulk_items(model: Any, items: List[Any], results: List[Optional[BookBulkResult]]) -> List[Tuple[int, Any]]:
+    """Validate every item separately. Return valid items with their indexes and save errors of others to results."""
+    start = time.perf_counter()
+    valid_items = []
+    for index, item in enumerate(items):
+        try:
+            valid_items.append((index, parse_obj_as(model, item)))
+        except ValidationError as e:
+            results[index] = BookBulkResult(status=422, message=str(e))
+    VALIDATION_DURATION.observe(time.perf_counter() - start, "request")
+    return valid_items
 
-    update_dict = update.dict()
-    for field_name in update_dict.keys():
-        field_value = update_dict[field_name]  # Extract new value...
-        if field_value:  # ...if value is defined...
-            setattr(persist_book, field_name, field_value)  # ...update existing object.
-    book_storage.persist(persist_book)
 
-    return persist_book
+def book_bulk_result(book: Optional[Book], book_id: int) -> BookBulkResult:
+    if book is None:
+        return BookBulkResult(status=404, message=f"Book with ID {book_id} not found")
+    return BookBulkResult(status=200, book=book)
+
+
+@router.post(
+    "/book/bulk",
+    description="""Create many book records in one transaction. Body is an array of books or NDJSON (header 
+    'Content-Type: application/x-ndjson'). Return result for every item.""")
+async def book_bulk_add(request: Request, service: BookService = Depends(book_service)) -> List[BookBulkResult]:
+    items = await read_bulk_items(request)
+    results: List[Optional[BookBulkResult]] = [None] * len(items)
+    valid_items = validate_bulk_items(BookUpdate, items, results)
+
+    books = await service.storage.create_many([book for _, book in valid_items])
+    for (index, _), book in zip(valid_items, books):
+        results[index] = BookBulkResult(status=200, book=book)
+    return results
+
+
+@router.put(
+    "/book/bulk",
+    description="""Update many existing book records in one transaction. Body is an array of books with IDs or NDJSON 
+    (header 'Content-Type: application/x-ndjson'). Return result for every item.""")
+async def book_bulk_update(request: Request, service: BookService = Depends(book_service)) -> List[BookBulkResult]:
+    items = await read_bulk_items(request)
+    results: List[Optional[BookBulkResult]] = [None] * len(items)
+    valid_items = validate_bulk_items(Book, items, results)
+
+    books = await service.storage.update_many([update for _, update in valid_items])
+    for (index, update), book in zip(valid_items, books):
+        results[index] = book_bulk_result(book, update.id)
+    return results
 
 
-def custom_openapi():
+@router.delete(
+    "/book/bulk",
+    description="""Delete many existing book records in one transaction. Body is an array of Book IDs or NDJSON 
+    (header 'Content-Type: application/x-ndjson'). Return result for every item.""")
+async def book_bulk_delete(request: Request, service: BookService = Depends(book_service)) -> List[BookBulkResult]:
+    items = await read_bulk_items(request)
+    results: List[Optional[BookBulkResult]] = [None] * len(items)
+    valid_items = validate_bulk_items(int, items, results)
+
+    books = await service.storage.remove_many([book_id for _, book_id in valid_items])
+    for (index, book_id), book in zip(valid_items, books):
+        results[index] = book_bulk_result(book, book_id)
+    return results
+
+
+def book_etag(book_id: int, version: int) -> str:
+    return f'"{book_id}-{version}"'
+
+
+def expected_version(book_id: int, if_match: Optional[str]) -> Optional[int]:
+    """Version of the book from `If-Match` header. None if any version can be changed."""
+    if not if_match:
+        return None
+    tags = [tag.strip() for tag in if_match.split(",")]
+    if "*" in tags:
+        return None
+    prefix = f'"{book_id}-'
+    for tag in tags:  # Weak tags are never matched for changes.
+        if tag.startswith(prefix) and tag.endswith('"') and tag[len(prefix):-1].isdigit():
+            return int(tag[len(prefix):-1])
+    raise HTTPException(status_code=412, detail=f"Tags {if_match} are not tags of book with ID {book_id}")
+
+
+def versioned_book_response(book: Book, version: Optional[int] = None) -> Response:
+    headers = {} if version is None else {"ETag": book_etag(book.id, version)}
+    return Response(content=encode_record(book_record(book)), media_type="application/json", headers=headers)
+
+
+@router.get(
+    "/book/{book_id}",
+    response_model=Book,
+    description="""Return existing book record. Header 'ETag' contains version of the book: use it in 'If-Match' 
+    header of the change requests to change the book only if nobody changed it before.""")
+async def book_get(book_id: int, service: BookService = Depends(book_service)) -> Response:
+    return versioned_book_response(*await service.storage.find_versioned(book_id))
+
+
+@router.delete(
+    "/book/{book_id}",
+    response_model=Book,
+    description="Delete existing book record. Use Book ID that generated by storage.")
+async def book_delete(book_id: int, request: Request, service: BookService = Depends(book_service)) -> Response:
+    version = expected_version(book_id, request.headers.get("if-match"))
+    return versioned_book_response(await service.storage.delete_returning(book_id, version))
+
+
+@router.put(
+    "/book/{book_id}",
+    response_model=Book,
+    description="""Update existing book record. Use Book ID that generated by storage. Empty values are not changed.""")
+async def book_update(book_id: int, update: BookUpdate, request: Request,
+                      service: BookService = Depends(book_service)) -> Response:
+    version = expected_version(book_id, request.headers.get("if-match"))
+    fields = {field_name: field_value for field_name, field_value in update.dict().items() if field_value}
+    return versioned_book_response(*await service.storage.update_fields(book_id, fields, version))
+
+
+@router.patch(
+    "/book/{book_id}",
+    response_model=Book,
+    description="""Change only given fields of existing book record, 'null' clears the field. Use Book ID that 
+    generated by storage.""")
+async def book_patch(book_id: int, update: BookUpdate, request: Request,
+                     service: BookService = Depends(book_service)) -> Response:
+    version = expected_version(book_id, request.headers.get("if-match"))
+    fields = update.dict(exclude_unset=True)
+    return versioned_book_response(*await service.storage.update_fields(book_id, fields, version))
+
+
+def custom_openapi(app: FastAPI) -> Dict[str, Any]:
     if app.openapi_schema:  # If was cached...
         return app.openapi_schema  # ...return cache.
 
@@ -84,12 +545,53 @@ def custom_openapi():
     return app.openapi_schema
 
 
-app.openapi = custom_openapi
+def create_app(setting: Optional[Settings] = None) -> FastAPI:
+    """
+    Create the application. Nothing is opened here: the storage is opened by the startup handler and closed by the
+    shutdown one, so the application can be created before worker processes are forked or many times in tests.
+    """
+    setting = setting or Settings()
+    service = BookService(setting)
+    app = FastAPI(default_response_class=ORJSONResponse if orjson is not None else JSONResponse)
+    app.state.book_service = service
+    # The first middleware is the inner one: time in the queue is a part of request duration, rejections are not
+    # compressed.
+    app.add_middleware(AdmissionMiddleware, routes=app.routes, limiters=service.limiters,
+                       deadline=setting.request_deadline, status_code=setting.overload_status_code,
+                       retry_after=setting.overload_retry_after)
+    if setting.gzip_minimum_size > 0:
+        # Level 6 is a few times faster than 9 and the responses are only a bit larger.
+        app.add_middleware(EncodedResponseGZipMiddleware, minimum_size=setting.gzip_minimum_size, compresslevel=6)
+    app.add_middleware(MetricsMiddleware, routes=app.routes)
+
+    app.add_exception_handler(BookNotFoundException, book_not_found_exception)
+    app.add_exception_handler(BookVersionConflictException, book_version_conflict_exception)
+    app.add_exception_handler(BookChangesCompactedException, book_changes_compacted_exception)
+    app.add_exception_handler(StorageBusyException, storage_busy_exception)
+    app.include_router(router)
+
+    # To prevent overrode existing REST APIs.
+    css_assets = StaticAssets("resources/css")
+    css_assets.mount(app, "/css")
+    js_assets = StaticAssets("resources/js")
+    js_assets.mount(app, "/js")
+    img_assets = StaticAssets("resources/img")
+    img_assets.mount(app, "/img")
+    # Should be last one to prevent catching other resources. Links of pages to assets are replaced by hashed URLs.
+    html_assets = StaticAssets("resources/html", html=True, urls=[css_assets, js_assets, img_assets])
+    html_assets.mount(app, "/")
+
+    def load_static_assets():
+        for static_assets in [css_assets, js_assets, img_assets, html_assets]:
+            static_assets.load()  # Compress files before the first page is requested.
+
+    app.add_event_handler("startup", service.open)
+    if setting.preload_static_assets:
+        app.add_event_handler("startup", load_static_assets)
+    app.add_event_handler("shutdown", service.close)
+    app.openapi = lambda: custom_openapi(app)
+
+    return app
 
 
-# To prevent overrode existing REST APIs.
-app.mount("/css", StaticFiles(directory="resources/css"))
-app.mount("/js", StaticFiles(directory="resources/js"))
-app.mount("/img", StaticFiles(directory="resources/img"))
-# Should be last one to prevent catching other resources.
-app.mount("/", StaticFiles(directory="resources/html", html=True))
+app = create_app()
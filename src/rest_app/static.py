@@ -0,0 +1,195 @@
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.responses import PlainTextResponse, Response
+from starlette.types import Message, Receive, Scope, Send
+
+from typing import Dict, List, Optional
+
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:  # Optional dependency: without it assets are compressed only by gzip.
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"  # URL with hash of the content is never changed.
+REVALIDATE = "no-cache"  # URL without hash: the client should check ETag on every use.
+COMPRESSED_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+MEDIA_TYPES = {".map": "application/json"}  # Source maps are not known by `mimetypes`.
+MIN_COMPRESSED_SIZE = 256  # Smaller files are not compressed: headers are larger than saved bytes.
+
+
+def gzip_compress(content: bytes) -> bytes:
+    """Deterministic gzip (zero modification time), so the same files give the same bytes."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(content)
+    return buffer.getvalue()
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    """Encodings of `Accept-Encoding` header, except disabled by 'q=0'."""
+    result = []
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+            continue
+        result.append(name.strip().lower())
+    return result
+
+
+def hashed_name(name: str, digest: str) -> str:
+    """Name with hash of the content before the extension: "js/jquery.js" -> "js/jquery.<hash>.js"."""
+    stem, dot, extension = name.rpartition(".")
+    if not dot or "/" in extension:
+        return f"{name}.{digest}"
+    return f"{stem}.{digest}.{extension}"
+
+
+class StaticAsset:
+    """File that is kept in memory with precompressed variants."""
+
+    __slots__ = ["content", "media_type", "digest", "encoded"]
+
+    def __init__(self, content: bytes, media_type: str):
+        self.content = content
+        self.media_type = media_type
+        self.digest = hashlib.sha256(content).hexdigest()[:16]
+        self.encoded: Dict[str, bytes] = {}  # Encoding -> compressed content, only if it is smaller.
+        if len(content) >= MIN_COMPRESSED_SIZE and media_type.startswith(COMPRESSED_TYPES):
+            variants = {"gzip": gzip_compress(content)}
+            if brotli is not None:
+                variants["br"] = brotli.compress(content)
+            self.encoded = {encoding: data for encoding, data in variants.items() if len(data) < len(content)}
+
+    def etag(self, encoding: Optional[str]) -> str:
+        # Strong tag is different for every representation, so caches do not mix compressed and plain bodies.
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+class StaticAssets:
+    """
+    ASGI application that serves files of the directory from memory. Files are read and compressed by gzip (and
+    brotli, if it is installed) once, on the first request or by `load()` on startup. Every file is available by own
+    name (revalidated by strong ETag) and by name with hash of the content (cached forever). Links of HTML files to
+    `urls` are replaced by hashed URLs, so pages always load the current versions of assets.
+    """
+
+    def __init__(self, directory: str, html: bool = False, urls: Optional[List["StaticAssets"]] = None):
+        self.directory = directory
+        self.html = html
+        self.urls = urls or []
+        self.prefix = ""  # Path of the mount, set by `mount()`.
+        self.lock = threading.Lock()
+        self.assets: Optional[Dict[str, StaticAsset]] = None
+        self.hashed: Dict[str, StaticAsset] = {}
+
+    def mount(self, app, path: str) -> None:
+        self.prefix = path.rstrip("/")
+        app.mount(path, self)
+
+    def load(self) -> Dict[str, StaticAsset]:
+        with self.lock:
+            if self.assets is None:
+                self.assets = self.read_assets()
+                self.hashed = {hashed_name(name, asset.digest): asset for name, asset in self.assets.items()}
+        return self.assets
+
+    def read_assets(self) -> Dict[str, StaticAsset]:
+        assets = {}
+        if not os.path.isdir(self.directory):
+            return assets
+        replacements = {}
+        for static_assets in self.urls:
+            replacements.update(static_assets.hashed_urls())
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                path = os.path.join(root, file_name)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                with open(path, "rb") as file:
+                    content = file.read()
+                media_type = MEDIA_TYPES.get(os.path.splitext(file_name)[1]) or mimetypes.guess_type(file_name)[0] \
+                    or "application/octet-stream"
+                if media_type == "text/html":
+                    for url, hashed_url in replacements.items():
+                        content = content.replace(f'"{url}"'.encode(), f'"{hashed_url}"'.encode())
+                assets[name] = StaticAsset(content, media_type)
+        return assets
+
+    def hashed_urls(self) -> Dict[str, str]:
+        """Absolute URLs of files and URLs with hashes of the content."""
+        return {f"{self.prefix}/{name}": f"{self.prefix}/{hashed_name(name, asset.digest)}"
+                for name, asset in self.load().items()}
+
+    def find(self, path: str):
+        assets = self.load()
+        name = path.lstrip("/")
+        if self.html and (not name or name.endswith("/")):
+            name += "index.html"
+        asset = self.hashed.get(name)
+        if asset is not None:
+            return asset, IMMUTABLE
+        return assets.get(name), REVALIDATE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["method"] not in ["GET", "HEAD"]:
+            await PlainTextResponse("Method Not Allowed", status_code=405)(scope, receive, send)
+            return
+        asset, cache_control = self.find(scope["path"])
+        if asset is None:
+            await PlainTextResponse("Not Found", status_code=404)(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encodings = accepted_encodings(request_headers.get("accept-encoding", ""))
+        encoding = next((name for name in ["br", "gzip"] if name in encodings and name in asset.encoded), None)
+        headers = {"ETag": asset.etag(encoding), "Cache-Control": cache_control}
+        if asset.encoded:
+            headers["Vary"] = "Accept-Encoding"
+        if encoding:
+            headers["Content-Encoding"] = encoding
+
+        if_none_match = request_headers.get("if-none-match", "")
+        if headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]:
+            await Response(status_code=304, headers=headers)(scope, receive, send)
+            return
+        response = Response(asset.encoded[encoding] if encoding else asset.content, media_type=asset.media_type,
+                            headers=headers)
+        if scope["method"] == "HEAD":
+            response.body = b""  # Headers (also Content-Length) are the same as for GET.
+        await response(scope, receive, send)
+
+
+class EncodedResponseGZipMiddleware(GZipMiddleware):
+    """
+    GZip middleware that does not compress responses again (precompressed assets already have `Content-Encoding`) and
+    does not compress events: compressor would hold them in the buffer.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in accepted_encodings(Headers(scope=scope).get("accept-encoding", "")):
+            await EncodedResponseGZipResponder(self.app, self.minimum_size, self.compresslevel)(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+class EncodedResponseGZipResponder(GZipResponder):
+
+    def __init__(self, app, minimum_size: int, compresslevel: int = 9):
+        super().__init__(app, minimum_size, compresslevel)
+        self.passthrough = False
+
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self.passthrough = "content-encoding" in headers or headers.get("content-type", "").startswith(
+                "text/event-stream")
+        if self.passthrough:
+            await self.send(message)
+        else:
+            await super().send_with_gzip(message)
@@ -0,0 +1,151 @@
+from rest_app.deadline import call_with_deadline, current_deadline
+from rest_app.domain import Book, BookFacet, BookOrder, BookUpdate
+from rest_app.encoding import BookChange, BookRecord, ChangeCursor
+from rest_app.metrics import time_operation
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import date
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import asyncio
+import functools
+
+
+class AsyncBookStorage:
+    """
+    Asynchronous interface of book storage. Storage that does not block (memory) is called directly in the event
+    loop, so its methods are effectively native coroutines.
+    """
+
+    def __init__(self, storage: Any):
+        self.storage = storage
+        self.backend = getattr(storage, "backend", type(storage).__name__)  # Label of metrics.
+
+    @property
+    def version(self) -> int:
+        """Version of the data: changed after every write."""
+        return self.storage.version
+
+    async def run(self, method: Callable, *args, **kwargs) -> Any:
+        """Run method of the storage (or any other blocking function that works with the storage)."""
+        return time_operation(self.backend, method.__name__, method, *args, **kwargs)
+
+    async def list(self,
+                   author: Optional[str] = None,
+                   title: Optional[str] = None,
+                   published_date_from: Optional[date] = None,
+                   published_date_to: Optional[date] = None,
+                   limit: Optional[int] = None,
+                   after_id: Optional[int] = None,
+                   order_by: BookOrder = BookOrder.id) -> List[Book]:
+        return await self.run(self.storage.list, author, title, published_date_from, published_date_to, limit,
+                              after_id, order_by)
+
+    async def list_records(self,
+                           author: Optional[str] = None,
+                           title: Optional[str] = None,
+                           published_date_from: Optional[date] = None,
+                           published_date_to: Optional[date] = None,
+                           limit: Optional[int] = None,
+                           after_id: Optional[int] = None,
+                           order_by: BookOrder = BookOrder.id) -> List[BookRecord]:
+        return await self.run(self.storage.list_records, author, title, published_date_from, published_date_to, limit,
+                              after_id, order_by)
+
+    def iterate(self,
+                author: Optional[str] = None,
+                title: Optional[str] = None,
+                published_date_from: Optional[date] = None,
+                published_date_to: Optional[date] = None,
+                limit: Optional[int] = None,
+                after_id: Optional[int] = None,
+                order_by: BookOrder = BookOrder.id) -> Iterator[Book]:
+        """Blocking iterator: should be consumed with `run()` or in the thread pool (like `StreamingResponse` do)."""
+        return self.storage.iterate(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+
+    def iterate_records(self,
+                        author: Optional[str] = None,
+                        title: Optional[str] = None,
+                        published_date_from: Optional[date] = None,
+                        published_date_to: Optional[date] = None,
+                        limit: Optional[int] = None,
+                        after_id: Optional[int] = None,
+                        order_by: BookOrder = BookOrder.id) -> Iterator[BookRecord]:
+        """Blocking iterator, like `iterate()`."""
+        return self.storage.iterate_records(author, title, published_date_from, published_date_to, limit, after_id,
+                                            order_by)
+
+    async def search(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[Book]:
+        return await self.run(self.storage.search, query, limit, offset)
+
+    async def search_records(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[BookRecord]:
+        return await self.run(self.storage.search_records, query, limit, offset)
+
+    async def count_groups(self,
+                           facet: BookFacet,
+                           author: Optional[str] = None,
+                           title: Optional[str] = None,
+                           published_date_from: Optional[date] = None,
+                           published_date_to: Optional[date] = None,
+                           limit: Optional[int] = None) -> List[Tuple[Optional[str], int]]:
+        return await self.run(self.storage.count_groups, facet, author, title, published_date_from, published_date_to,
+                              limit)
+
+    async def changes(self, since: ChangeCursor = 0, limit: Optional[int] = None) -> List[BookChange]:
+        return await self.run(self.storage.changes, since, limit)
+
+    async def find(self, book_id: int) -> Book:
+        return await self.run(self.storage.find, book_id)
+
+    async def find_versioned(self, book_id: int) -> Tuple[Book, int]:
+        return await self.run(self.storage.find_versioned, book_id)
+
+    async def create(self, book: BookUpdate) -> Book:
+        return await self.run(self.storage.create, book)
+
+    async def create_many(self, books: List[BookUpdate]) -> List[Book]:
+        return await self.run(self.storage.create_many, books)
+
+    async def update_many(self, updates: List[Book]) -> List[Optional[Book]]:
+        return await self.run(self.storage.update_many, updates)
+
+    async def remove_many(self, book_ids: List[int]) -> List[Optional[Book]]:
+        return await self.run(self.storage.remove_many, book_ids)
+
+    async def update_fields(self,
+                            book_id: int,
+                            fields: Dict[str, Any],
+                            expected_version: Optional[int] = None) -> Tuple[Book, int]:
+        return await self.run(self.storage.update_fields, book_id, fields, expected_version)
+
+    async def delete_returning(self, book_id: int, expected_version: Optional[int] = None) -> Book:
+        return await self.run(self.storage.delete_returning, book_id, expected_version)
+
+    async def remove(self, book_id: int) -> None:
+        return await self.run(self.storage.remove, book_id)
+
+    async def persist(self, book: Book) -> None:
+        return await self.run(self.storage.persist, book)
+
+    def close(self) -> None:
+        self.storage.close()
+
+
+class ExecutorBookStorage(AsyncBookStorage):
+    """Asynchronous interface of blocking storage (SQLite): methods are run in the dedicated thread pool."""
+
+    def __init__(self, storage: Any, max_workers: int = 4, executor: Optional[Executor] = None):
+        super().__init__(storage)
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+
+    async def run(self, method: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_event_loop()
+        # Duration is observed inside of the thread, so it does not include waiting for a free worker. Deadline of the
+        # request is passed to the thread: queries of the storage stop after it.
+        return await loop.run_in_executor(
+            self.executor, functools.partial(call_with_deadline, current_deadline(), time_operation, self.backend,
+                                             method.__name__, method, *args, **kwargs))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)  # Finish running queries before closing connections.
+        super().close()
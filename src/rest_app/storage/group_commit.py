@@ -0,0 +1,154 @@
+from rest_app.domain import Book, BookUpdate
+from rest_app.metrics import SQLITE_GROUP_COMMIT_DURATION, SQLITE_GROUP_COMMIT_SIZE, time_operation
+from rest_app.storage.asynchronous import ExecutorBookStorage
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import asyncio
+import threading
+import time
+
+# Write of the queue: method of the storage, its arguments and the future of the caller.
+PendingWrite = Tuple[Callable, Tuple[Any, ...], asyncio.Future]
+
+
+class GroupCommitStats:
+    """Number of grouped transactions and writes, the largest group and total duration of transactions."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.max_batch_size = 0
+        self.commit_seconds = 0.0
+
+    def record(self, batch_size: int, duration: float) -> None:
+        with self.lock:
+            self.batches += 1
+            self.writes += batch_size
+            self.max_batch_size = max(self.max_batch_size, batch_size)
+            self.commit_seconds += duration
+
+    def as_dict(self) -> Dict[str, float]:
+        return {"batches": self.batches,
+                "writes": self.writes,
+                "max_batch_size": self.max_batch_size,
+                "avg_batch_size": self.writes / self.batches if self.batches else 0.0,
+                "avg_commit_seconds": self.commit_seconds / self.batches if self.batches else 0.0}
+
+
+class GroupCommitBookStorage(ExecutorBookStorage):
+    """
+    SQLite storage that joins single-book writes of concurrent requests to one transaction (group commit), so one
+    commit (and one sync of the disk with `synchronous=FULL`) is shared by many writes. Writes wait in the queue while
+    the previous transaction runs, then up to `max_batch_size` of them are committed together. With `max_delay` the
+    transaction also waits for more writes, it is useful only with slow commits. Every write runs in own savepoint,
+    so errors (like a missing book) are returned only to own caller; if the commit fails, all writes of it fail.
+    """
+
+    def __init__(self, storage: Any, max_workers: int = 4, max_batch_size: int = 64, max_delay: float = 0.0):
+        super().__init__(storage, max_workers)
+        if max_batch_size < 1:
+            raise ValueError(f"Group commit size should be positive, but was {max_batch_size}")
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.pending: List[PendingWrite] = []
+        self.commit_task: Optional[asyncio.Future] = None  # Task of the queue: it runs while there are writes.
+        self.stats = GroupCommitStats()
+
+    async def write(self, method: Callable, *args) -> Any:
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((method, args, future))
+        if self.commit_task is None or self.commit_task.done():
+            self.commit_task = asyncio.ensure_future(self.commit_pending())
+            self.commit_task.add_done_callback(self.commit_done)
+        return await future
+
+    async def commit_pending(self) -> None:
+        """Commit writes of the queue by groups until it is empty."""
+        while self.pending:
+            if self.max_delay > 0 and len(self.pending) < self.max_batch_size:
+                await asyncio.sleep(self.max_delay)
+            batch = [write for write in self.pending[:self.max_batch_size] if not write[2].cancelled()]
+            del self.pending[:self.max_batch_size]
+            if not batch:  # Callers are cancelled (their deadlines are passed): writes are not needed anymore.
+                continue
+            writes = [(method, args) for method, args, _ in batch]
+            try:
+                results = await asyncio.get_event_loop().run_in_executor(self.executor, self.commit, writes)
+            except asyncio.CancelledError:  # Storage is closed (it is an Exception before Python 3.8).
+                for _, _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:  # Transaction failed: none of writes are saved.
+                results = [(None, e)] * len(batch)
+            for (_, _, future), (result, error) in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def commit_done(self, task: asyncio.Future) -> None:
+        """Writes of the queue fail with the error of the task (or are cancelled with it), so callers do not hang."""
+        if task.cancelled():
+            error = None
+        else:
+            error = task.exception()  # Retrieved: the error is not lost in "exception was never retrieved" logs.
+            if error is None:
+                return
+        if self.commit_task is task:
+            pending, self.pending = self.pending, []
+            for _, _, future in pending:
+                if future.done():
+                    continue
+                if error is None:
+                    future.cancel()
+                else:
+                    future.set_exception(error)
+
+    def commit(self, writes: List[Tuple[Callable, Tuple[Any, ...]]]) -> List[Tuple[Any, Optional[Exception]]]:
+        """Run writes in one transaction. Return result or error of every write."""
+        start = time.perf_counter()
+        results = []
+        with self.storage.pool.writer() as connection:  # Writer of the storage joins the outer transaction.
+            for method, args in writes:
+                connection.execute("SAVEPOINT grouped_write;")
+                try:
+                    results.append((time_operation(self.backend, method.__name__, method, *args), None))
+                except Exception as e:
+                    connection.execute("ROLLBACK TO grouped_write;")
+                    results.append((None, e))
+                connection.execute("RELEASE grouped_write;")
+        duration = time.perf_counter() - start
+        SQLITE_GROUP_COMMIT_SIZE.observe(len(writes))
+        SQLITE_GROUP_COMMIT_DURATION.observe(duration)
+        self.stats.record(len(writes), duration)
+        return results
+
+    async def create(self, book: BookUpdate) -> Book:
+        return await self.write(self.storage.create, book)
+
+    async def update_fields(self,
+                            book_id: int,
+                            fields: Dict[str, Any],
+                            expected_version: Optional[int] = None) -> Tuple[Book, int]:
+        return await self.write(self.storage.update_fields, book_id, fields, expected_version)
+
+    async def delete_returning(self, book_id: int, expected_version: Optional[int] = None) -> Book:
+        return await self.write(self.storage.delete_returning, book_id, expected_version)
+
+    async def remove(self, book_id: int) -> None:
+        return await self.write(self.storage.remove, book_id)
+
+    async def persist(self, book: Book) -> None:
+        return await self.write(self.storage.persist, book)
+
+    def group_commit_stats(self) -> Dict[str, float]:
+        return self.stats.as_dict()
+
+    def close(self) -> None:
+        if self.commit_task is not None and not self.commit_task.done():
+            self.commit_task.cancel()  # Waiting writes are cancelled, the running transaction is waited by executor.
+        super().close()
@@ -1,25 +1,78 @@
-from rest_app.domain import Book, BookUpdate, BookNotFoundException
+from rest_app.domain import Book, BookChangesCompactedException, BookFacet, BookOrder, BookUpdate, \
+    BookNotFoundException, BookVersionConflictException, tokenize
+from rest_app.encoding import BookChange, BookRecord, ChangeCursor, book_record
+from rest_app.storage.memory_index import ChangeLog, GroupCounter, InvertedIndex, SortedIndex
+from rest_app.storage.memory_persistence import BookVersions, SavedBook, WriteLog, read_snapshot, write_snapshot
+from rest_app.storage.wildcard import literal_prefix, wildcard_matcher
 
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from datetime import date
-import re
+import bisect
+import functools
+import gc
+import itertools
+import operator
+import sys
+import threading
+
+
+def share_author(author: Optional[str]) -> Optional[str]:
+    """Equal authors are one string: interned strings are freed when no book refers to them."""
+    return None if author is None else sys.intern(author)
+
+
+@functools.lru_cache(maxsize=4096)
+def share_date(published_date: Optional[date]) -> Optional[date]:
+    """Equal dates are one object while they are in the bounded cache: popular dates stay there."""
+    return published_date
+
+
+class CompactBook:
+    """Book that is saved in compact mode: object with slots instead of pydantic model."""
+
+    __slots__ = ["id", "author", "title", "published_date"]
+
+    def __init__(self, id: int, author: Optional[str], title: Optional[str], published_date: Optional[date]):
+        self.id = id
+        self.author = author
+        self.title = title
+        self.published_date = published_date
 
 
 class MemoryBookStorage:
-    """Base storage for books that save data in memory."""
+    """
+    Base storage for books that save data in memory. In compact mode books are saved as `CompactBook` with shared
+    authors and dates, and `Book` models are created only for results.
+    """
+
+    backend = "memory"
 
-    def __init__(self):
+    def __init__(self, compact: bool = False):
+        self.compact = compact
         self.id_counter = 0
-        self.books = []
+        self.version = 0  # Version of the data: changed after every write.
+        self.books: Dict[int, Any] = {}  # Book or CompactBook. Insertion order is the order of IDs.
+        self.ids: List[int] = []  # Sorted IDs to start iteration from any ID.
+        self.book_versions: BookVersions = {}  # Versions of changed books only, others have version 1.
+        # Indexes of filtered fields and indexed values, because books can be changed before persist().
+        self.author_index = SortedIndex()
+        self.title_index = SortedIndex()
+        self.published_date_index = SortedIndex()
+        self.words_index = InvertedIndex()
+        self.indexed_values: Dict[int, Tuple[Optional[str], Optional[str], Optional[date]]] = {}
+        # Number of books by author and by month of publishing: facets without filters do not scan books.
+        self.author_counter = GroupCounter()
+        self.month_counter = GroupCounter()
+        self.change_log = ChangeLog()  # Last changes of books for the change feed.
 
     @staticmethod
     def string_compare_expr(key: str, value: str):
         if value is None:
             return None
 
-        reg_exp = re.compile(value.replace("?", ".?").replace("*", ".*"))
-        return lambda record: reg_exp.match(getattr(record, key))
+        matches = wildcard_matcher(value)
+        return lambda record: getattr(record, key) is not None and matches(getattr(record, key))
 
     @staticmethod
     def date_compare_expr(key: str, comparator: str, value: date):
@@ -27,24 +80,215 @@ class MemoryBookStorage:
             return None
 
         if comparator == ">":
-            return lambda record: getattr(record, key) > value
+            return lambda record: getattr(record, key) is not None and getattr(record, key) > value
+        else:
+            return lambda record: getattr(record, key) is not None and getattr(record, key) < value
+
+    def store(self, book: Book) -> Any:
+        """Object that is saved for the book."""
+        if not self.compact:
+            return book
+        return CompactBook(book.id, share_author(book.author), book.title, share_date(book.published_date))
+
+    def to_book(self, record: Any) -> Book:
+        """Book of the saved object. Values were validated before saving, so model is not validated again."""
+        if not self.compact:
+            return record
+        return Book.construct(id=record.id, author=record.author, title=record.title,
+                              published_date=record.published_date)
+
+    def load(self, id_counter: int, books: Iterable[SavedBook], versions: Optional[BookVersions] = None) -> None:
+        """
+        Add books (and versions of changed ones) to the empty storage. Indexes are built at once, so it is much faster
+        than create().
+        """
+        books = sorted(books, key=operator.itemgetter(0))
+        if self.compact:
+            # Dates of the snapshot are shared already.
+            self.books = {book_id: CompactBook(book_id, share_author(author), title, date_value)
+                          for book_id, author, title, date_value in books}
         else:
-            return lambda record: getattr(record, key) < value
+            self.books = {book_id: Book.construct(id=book_id, author=author, title=title, published_date=published_date)
+                          for book_id, author, title, published_date in books}
+            self.indexed_values = {book_id: (author, title, published_date)
+                                   for book_id, author, title, published_date in books}
+        self.ids = [book[0] for book in books]
+        self.id_counter = id_counter
+        self.book_versions = versions or {}
+
+        self.author_index.extend([(author, book_id) for book_id, author, _, _ in books])
+        self.title_index.extend([(title, book_id) for book_id, _, title, _ in books])
+        self.published_date_index.extend([(published_date, book_id) for book_id, _, _, published_date in books])
+        author_words: Dict[Optional[str], List[str]] = {}  # Authors are repeated, split them once.
+        documents = []
+        for book_id, author, title, _ in books:
+            words = author_words.get(author)
+            if words is None:
+                words = author_words[author] = tokenize(author)
+            documents.append((book_id, words + tokenize(title)))
+        self.words_index.extend(documents)
+        self.author_counter.extend(book[1] for book in books)
+        self.month_counter.extend(BookFacet.month.group_value(None, book[3]) for book in books)
+        self.change_log.extend(self.ids)  # Loaded books are changes after the previous ones.
+        self.version += 1
+
+    def stored(self, book_id: int) -> Any:
+        record = self.books.get(book_id)
+        if record is None:
+            raise BookNotFoundException(book_id)
+        return record
+
+    def indexed(self, book_id: int) -> Tuple[Optional[str], Optional[str], Optional[date]]:
+        if self.compact:  # Saved objects are not shared, so they are not changed before persist().
+            record = self.books[book_id]
+            return record.author, record.title, record.published_date
+        return self.indexed_values[book_id]
+
+    def add_to_indexes(self, record: Any) -> None:
+        values = record.author, record.title, record.published_date
+        self.author_index.add(values[0], record.id)
+        self.title_index.add(values[1], record.id)
+        self.published_date_index.add(values[2], record.id)
+        self.words_index.add(record.id, tokenize(values[0]) + tokenize(values[1]))
+        self.author_counter.add(values[0])
+        self.month_counter.add(BookFacet.month.group_value(None, values[2]))
+        if not self.compact:
+            self.indexed_values[record.id] = values
+
+    def remove_from_indexes(self, book_id: int) -> None:
+        author, title, published_date = self.indexed(book_id)
+        self.indexed_values.pop(book_id, None)
+        self.author_index.remove(author, book_id)
+        self.title_index.remove(title, book_id)
+        self.published_date_index.remove(published_date, book_id)
+        self.words_index.remove(book_id, tokenize(author) + tokenize(title))
+        self.author_counter.remove(author)
+        self.month_counter.remove(BookFacet.month.group_value(None, published_date))
+
+    def candidates(self,
+                   author: Optional[str],
+                   title: Optional[str],
+                   published_date_from: Optional[date],
+                   published_date_to: Optional[date]) -> Optional[List[int]]:
+        """
+        IDs of books that can match the filters, found by the most selective index. Return None if there is no index
+        for filters, so all books should be checked.
+        """
+        searches = []
+        if published_date_from is not None or published_date_to is not None:
+            searches.append((self.published_date_index.count_range(published_date_from, published_date_to),
+                             lambda: self.published_date_index.range(published_date_from, published_date_to)))
+        for index, value in [(self.author_index, author), (self.title_index, title)]:
+            prefix = literal_prefix(value)
+            if prefix is not None:
+                searches.append((index.count_prefix(prefix), lambda index=index, prefix=prefix: index.prefix(prefix)))
+
+        if not searches:
+            return None
+        _, search = min(searches, key=lambda count_search: count_search[0])
+        return search()
 
     def list(self,
              author: Optional[str] = None,
              title: Optional[str] = None,
              published_date_from: Optional[date] = None,
-             published_date_to: Optional[date] = None) -> List[Book]:
-        """Provide list of saved books."""
+             published_date_to: Optional[date] = None,
+             limit: Optional[int] = None,
+             after_id: Optional[int] = None,
+             order_by: BookOrder = BookOrder.id) -> List[Book]:
+        """Provide list of saved books. Return at most `limit` books that follow the book `after_id`."""
+
+        records = self.query(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+        return [self.to_book(record) for record in records]
 
+    def query(self,
+              author: Optional[str],
+              title: Optional[str],
+              published_date_from: Optional[date],
+              published_date_to: Optional[date],
+              limit: Optional[int],
+              after_id: Optional[int],
+              order_by: BookOrder) -> List[Any]:
+        """Saved objects of books for the list."""
+        order_by = BookOrder(order_by)
+        books = self.select(author, title, published_date_from, published_date_to, after_id, order_by)
+        if order_by is BookOrder.id:  # Books are selected in order of IDs: stop after the page.
+            return list(itertools.islice(books, limit))
+
+        result = sorted(books, key=lambda record: (order_by.sort_value(record), record.id))
+        if limit is not None:
+            result = result[:limit]
+        return result
+
+    def list_records(self,
+                     author: Optional[str] = None,
+                     title: Optional[str] = None,
+                     published_date_from: Optional[date] = None,
+                     published_date_to: Optional[date] = None,
+                     limit: Optional[int] = None,
+                     after_id: Optional[int] = None,
+                     order_by: BookOrder = BookOrder.id) -> List[BookRecord]:
+        """The same as `list()`, but return records of books."""
+
+        records = self.query(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+        return [book_record(record) for record in records]
+
+    def iterate(self,
+                author: Optional[str] = None,
+                title: Optional[str] = None,
+                published_date_from: Optional[date] = None,
+                published_date_to: Optional[date] = None,
+                limit: Optional[int] = None,
+                after_id: Optional[int] = None,
+                order_by: BookOrder = BookOrder.id) -> Iterator[Book]:
+        """Iterate over saved books. Only ordering by ID does not require to collect all found books."""
+
+        records = self.iterate_stored(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+        return map(self.to_book, records)
+
+    def iterate_stored(self,
+                       author: Optional[str],
+                       title: Optional[str],
+                       published_date_from: Optional[date],
+                       published_date_to: Optional[date],
+                       limit: Optional[int],
+                       after_id: Optional[int],
+                       order_by: BookOrder) -> Iterator[Any]:
+        order_by = BookOrder(order_by)
+        if order_by is not BookOrder.id:
+            yield from self.query(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+            return
+
+        books = self.select(author, title, published_date_from, published_date_to, after_id, order_by)
+        yield from itertools.islice(books, limit)
+
+    def select(self,
+               author: Optional[str],
+               title: Optional[str],
+               published_date_from: Optional[date],
+               published_date_to: Optional[date],
+               after_id: Optional[int],
+               order_by: BookOrder) -> Iterator[Book]:
         filter_conditions = [MemoryBookStorage.string_compare_expr("author", author),
                              MemoryBookStorage.string_compare_expr("title", title),
                              MemoryBookStorage.date_compare_expr("published_date", ">", published_date_from),
                              MemoryBookStorage.date_compare_expr("published_date", "<", published_date_to)]
+        if after_id is not None:
+            after = (order_by.sort_value(self.stored(after_id)) if order_by is not BookOrder.id else after_id), after_id
+            filter_conditions.append(lambda record: (order_by.sort_value(record), record.id) > after)
 
-        result = []
-        for record in self.books:
+        book_ids = self.candidates(author, title, published_date_from, published_date_to)
+        if book_ids is not None:
+            book_ids.sort()
+        elif order_by is BookOrder.id and after_id is not None:
+            book_ids = self.ids[bisect.bisect_right(self.ids, after_id):]
+        else:
+            book_ids = list(self.ids)  # Copy: storage can be changed during iteration.
+
+        for book_id in book_ids:
+            record = self.books.get(book_id)
+            if record is None:  # Was removed during iteration.
+                continue
             add = True
             for cond in filter_conditions:
                 if not cond:
@@ -54,32 +298,291 @@ class MemoryBookStorage:
                 add = False
                 break
             if add:
-                result.append(record)
+                yield record
+
+    def iterate_records(self,
+                        author: Optional[str] = None,
+                        title: Optional[str] = None,
+                        published_date_from: Optional[date] = None,
+                        published_date_to: Optional[date] = None,
+                        limit: Optional[int] = None,
+                        after_id: Optional[int] = None,
+                        order_by: BookOrder = BookOrder.id) -> Iterator[BookRecord]:
+        """The same as `iterate()`, but return records of books."""
+
+        records = self.iterate_stored(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+        return map(book_record, records)
+
+    def search(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[Book]:
+        """Find books that contain all words of the query (as prefixes) in author or title. Best matches are first."""
+
+        return [self.to_book(record) for record in self.search_stored(query, limit, offset)]
+
+    def search_records(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[BookRecord]:
+        """The same as `search()`, but return records of books."""
+
+        return [book_record(record) for record in self.search_stored(query, limit, offset)]
+
+    def search_stored(self, query: str, limit: Optional[int], offset: int) -> List[Any]:
+        words = tokenize(query)
+        if not words:
+            return []
+        book_ids = self.words_index.search(words)
+        end = None if limit is None else offset + limit
+        return [self.books[book_id] for book_id in book_ids[offset:end]]
+
+    def count_groups(self,
+                     facet: BookFacet,
+                     author: Optional[str] = None,
+                     title: Optional[str] = None,
+                     published_date_from: Optional[date] = None,
+                     published_date_to: Optional[date] = None,
+                     limit: Optional[int] = None) -> List[Tuple[Optional[str], int]]:
+        """Count filtered books by groups of the facet. Without filters counters of the groups are used."""
+
+        facet = BookFacet(facet)
+        if author is None and title is None and published_date_from is None and published_date_to is None:
+            if facet is BookFacet.author:
+                groups = self.author_counter.groups()
+            elif facet is BookFacet.month:
+                groups = self.month_counter.groups()
+            else:
+                groups = self.month_counter.groups(lambda month: month and month[:4])
+        else:
+            groups = {}
+            for record in self.select(author, title, published_date_from, published_date_to, None, BookOrder.id):
+                value = facet.group_value(record.author, record.published_date)
+                groups[value] = groups.get(value, 0) + 1
+        return sorted(groups.items(), key=facet.sort_key)[:limit]
+
+    def changes(self, since: ChangeCursor = 0, limit: Optional[int] = None) -> List[BookChange]:
+        """
+        The last changes of books after the change `since`, ordered by numbers of changes. Removed books have empty
+        records (tombstones).
+        """
+
+        log = self.change_log
+        if not isinstance(since, int):  # Cursor of sharded storage.
+            raise BookChangesCompactedException(since, log.first_seq)
+        if (0 < since < log.first_seq) or since > log.seq:  # Changes were before start or of another storage.
+            raise BookChangesCompactedException(since, log.first_seq)
+        result = []
+        for seq, book_id in log.since(since, limit):
+            record = self.books.get(book_id)
+            result.append((seq, book_id, None if record is None else book_record(record)))
         return result
 
     def find(self, book_id: int) -> Book:
         """Find book from the storage. Can be used for modification or delete requests."""
 
-        for book in self.books:
-            if book.id == book_id:
-                return book
-        raise BookNotFoundException(book_id)
+        return self.to_book(self.stored(book_id))
+
+    def find_versioned(self, book_id: int) -> Tuple[Book, int]:
+        """Find book and its version."""
+
+        return self.find(book_id), self.book_versions.get(book_id, 1)
+
+    def check_version(self, book_id: int, expected_version: Optional[int]) -> None:
+        if book_id not in self.books:
+            raise BookNotFoundException(book_id)
+        version = self.book_versions.get(book_id, 1)
+        if expected_version is not None and version != expected_version:
+            raise BookVersionConflictException(book_id, version)
 
     def create(self, book: BookUpdate) -> Book:
         """Create book in a storage. Populate unique identifier for future requests."""
 
         self.id_counter += 1
         book = Book(id=self.id_counter, **book.dict())  # Join parameters...
-        self.books.append(book)
+        record = self.books[book.id] = self.store(book)
+        self.ids.append(book.id)  # IDs grow, so list stays sorted.
+        self.add_to_indexes(record)
+        self.change_log.add(book.id)
+        self.version += 1
+        return book
+
+    def create_many(self, books: List[BookUpdate]) -> List[Book]:
+        """Create books in a storage."""
+
+        return [self.create(book) for book in books]
+
+    def update_many(self, updates: List[Book]) -> List[Optional[Book]]:
+        """Update books in a storage. Empty values are not changed. Return None for not found books."""
+
+        result = []
+        for update in updates:
+            record = self.books.get(update.id)
+            if record is None:
+                result.append(None)
+                continue
+            book = self.to_book(record)
+            for field_name, field_value in update.dict(exclude={"id"}).items():
+                if field_value:
+                    setattr(book, field_name, field_value)
+            self.persist(book)
+            result.append(book)
+        return result
+
+    def remove_many(self, book_ids: List[int]) -> List[Optional[Book]]:
+        """Remove books from the storage. Return removed books or None for not found books."""
+
+        result = []
+        for book_id in book_ids:
+            record = self.books.get(book_id)
+            if record is not None:
+                self.remove(book_id)
+            result.append(None if record is None else self.to_book(record))
+        return result
+
+    def update_fields(self,
+                      book_id: int,
+                      fields: Dict[str, Any],
+                      expected_version: Optional[int] = None) -> Tuple[Book, int]:
+        """
+        Set given fields of the book (empty values clear the field), if the book has expected version. Return updated
+        book and its new version.
+        """
+
+        self.check_version(book_id, expected_version)
+        book = self.find(book_id).copy(update=fields)
+        self.persist(book)
+        return book, self.book_versions[book_id]
+
+    def delete_returning(self, book_id: int, expected_version: Optional[int] = None) -> Book:
+        """Remove book, if it has expected version. Return removed book."""
+
+        self.check_version(book_id, expected_version)
+        book = self.find(book_id)
+        self.remove(book_id)
         return book
 
     def remove(self, book_id: int) -> None:
         """Remove book from the storage."""
 
-        book = self.find(book_id)
-        self.books.remove(book)
+        if book_id not in self.books:
+            raise BookNotFoundException(book_id)
+        del self.ids[bisect.bisect_left(self.ids, book_id)]
+        self.remove_from_indexes(book_id)
+        del self.books[book_id]
+        self.book_versions.pop(book_id, None)
+        self.change_log.add(book_id)  # Tombstone.
+        self.version += 1
 
-    def persist(self, _book: Book) -> None:
+    def persist(self, book: Book) -> None:
         """Update book in a storage."""
 
+        if book.id not in self.books:
+            raise BookNotFoundException(book.id)
+        reindex = self.indexed(book.id) != (book.author, book.title, book.published_date)
+        if reindex:
+            self.remove_from_indexes(book.id)
+        record = self.books[book.id] = self.store(book)
+        if reindex:
+            self.add_to_indexes(record)
+        self.book_versions[book.id] = self.book_versions.get(book.id, 1) + 1
+        self.change_log.add(book.id)
+        self.version += 1
+
+    def close(self) -> None:
+        """Release storage resources."""
+
         pass
+
+
+class PersistentMemoryBookStorage(MemoryBookStorage):
+    """
+    Memory storage that is saved to the snapshot file and the log of changes after it (`<snapshot>.log`). Books are
+    loaded on start, the log is merged to the new snapshot on start, on close and when it is longer than
+    `snapshot_log_size` bytes. The last one is written by the background thread: writes (and the event loop that
+    calls the storage directly) do not wait for it.
+    """
+
+    def __init__(self,
+                 snapshot_path: str,
+                 compact: bool = False,
+                 fsync_interval: float = 1.0,
+                 snapshot_log_size: int = 64 * 1024 * 1024):
+        super().__init__(compact)
+        self.snapshot_path = snapshot_path
+        self.snapshot_log_size = snapshot_log_size
+
+        from pathlib import Path
+        Path(snapshot_path).parent.mkdir(parents=True, exist_ok=True)
+
+        log_path = snapshot_path + ".log"
+        gc_enabled = gc.isenabled()
+        gc.disable()  # Millions of new objects start many useless collections, all of them are kept.
+        try:
+            id_counter, change_seq, books, versions = read_snapshot(snapshot_path)
+            max_id, log_entries = WriteLog.replay(log_path, books, versions)  # Changes after the snapshot.
+            # Older changes are not saved: the feed starts after them and all loaded books are new changes.
+            self.change_log = ChangeLog(change_seq + log_entries)
+            self.load(max(id_counter, max_id), books.values(), versions)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.log = WriteLog(log_path, fsync_interval)
+        self.snapshot_thread: Optional[threading.Thread] = None
+        if self.log.size > 0:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Save all books to the snapshot and clear the log."""
+
+        write_snapshot(self.snapshot_path, self.id_counter, self.change_log.seq,
+                       [book_record(record) for record in self.books.values()], self.book_versions)
+        self.log.truncate()
+
+    def snapshot_in_background(self) -> None:
+        """
+        Save books to the snapshot by the background thread and remove entries of the log before it. Only references
+        to records are copied here. Records that are changed later can be saved with new values, but their changes
+        are after the copied size of the log, so they are kept in the log and replayed over the snapshot again.
+        """
+
+        records = list(self.books.values())
+        versions = dict(self.book_versions)
+        self.snapshot_thread = threading.Thread(target=self.save_snapshot,
+                                                args=(self.id_counter, self.change_log.seq, records, versions,
+                                                      self.log.size),
+                                                name="memory-snapshot",
+                                                daemon=True)
+        self.snapshot_thread.start()
+
+    def save_snapshot(self,
+                      id_counter: int,
+                      change_seq: int,
+                      records: List[Any],
+                      versions: BookVersions,
+                      log_size: int) -> None:
+        write_snapshot(self.snapshot_path, id_counter, change_seq, [book_record(record) for record in records],
+                       versions)
+        self.log.discard(log_size)
+
+    def snapshot_if_needed(self) -> None:
+        if self.log.size < self.snapshot_log_size:
+            return
+        if self.snapshot_thread is None or not self.snapshot_thread.is_alive():  # Otherwise the log waits for it.
+            self.snapshot_in_background()
+
+    def create(self, book: BookUpdate) -> Book:
+        book = super().create(book)
+        self.log.put(book_record(book))
+        self.snapshot_if_needed()
+        return book
+
+    def remove(self, book_id: int) -> None:
+        super().remove(book_id)
+        self.log.delete(book_id)
+        self.snapshot_if_needed()
+
+    def persist(self, book: Book) -> None:
+        super().persist(book)
+        self.log.put(book_record(book), self.book_versions[book.id])
+        self.snapshot_if_needed()
+
+    def close(self) -> None:
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        self.snapshot()  # Next start does not need to read the log.
+        self.log.close()
@@ -0,0 +1,205 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import bisect
+import math
+
+
+class SortedIndex:
+    """Sorted list of (value, book ID) pairs. Support range and prefix searches by binary search."""
+
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, value: Any, book_id: int) -> None:
+        if value is None:  # Empty values are not indexed: filters never match them.
+            return
+        bisect.insort(self.entries, (value, book_id))
+
+    def extend(self, entries: List[Tuple[Any, int]]) -> None:
+        """Add many (value, book ID) pairs: sorted once, so it is much faster than `add()` of every pair."""
+        self.entries.extend(entry for entry in entries if entry[0] is not None)
+        self.entries.sort()
+
+    def remove(self, value: Any, book_id: int) -> None:
+        if value is None:
+            return
+        position = bisect.bisect_left(self.entries, (value, book_id))
+        if position < len(self.entries) and self.entries[position] == (value, book_id):
+            del self.entries[position]
+
+    def range(self, lower: Any = None, upper: Any = None) -> List[int]:
+        """IDs of books with lower < value < upper. Empty bound is not checked."""
+        start = 0 if lower is None else bisect.bisect_right(self.entries, (lower, float("inf")))
+        end = len(self.entries) if upper is None else bisect.bisect_left(self.entries, (upper,))
+        return [book_id for _, book_id in self.entries[start:end]]
+
+    def count_range(self, lower: Any = None, upper: Any = None) -> int:
+        start = 0 if lower is None else bisect.bisect_right(self.entries, (lower, float("inf")))
+        end = len(self.entries) if upper is None else bisect.bisect_left(self.entries, (upper,))
+        return max(end - start, 0)
+
+    @staticmethod
+    def prefix_upper(prefix: str) -> Optional[str]:
+        """The smallest string that is greater than all strings with the prefix."""
+        if not prefix or ord(prefix[-1]) >= 0x10FFFF:
+            return None
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def prefix(self, prefix: str) -> List[int]:
+        """IDs of books with values that start from the prefix."""
+        start = bisect.bisect_left(self.entries, (prefix,))
+        upper = SortedIndex.prefix_upper(prefix)
+        end = len(self.entries) if upper is None else bisect.bisect_left(self.entries, (upper,))
+        return [book_id for _, book_id in self.entries[start:end]]
+
+    def count_prefix(self, prefix: str) -> int:
+        start = bisect.bisect_left(self.entries, (prefix,))
+        upper = SortedIndex.prefix_upper(prefix)
+        end = len(self.entries) if upper is None else bisect.bisect_left(self.entries, (upper,))
+        return end - start
+
+
+class InvertedIndex:
+    """Index of words for the full-text search: word -> {book ID: number of the word in the book}."""
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.words: List[str] = []  # Sorted words to search by prefix.
+        self.documents = 0
+
+    def add(self, book_id: int, words: List[str]) -> None:
+        self.documents += 1
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = {}
+                bisect.insort(self.words, word)
+            posting[book_id] = posting.get(book_id, 0) + 1
+
+    def extend(self, documents: List[Tuple[int, List[str]]]) -> None:
+        """Add many (book ID, words) documents: words are sorted once."""
+        postings = self.postings
+        for book_id, words in documents:
+            for word in words:
+                posting = postings.get(word)
+                if posting is None:
+                    posting = postings[word] = {}
+                posting[book_id] = posting.get(book_id, 0) + 1
+        self.documents += len(documents)
+        self.words = sorted(postings)
+
+    def remove(self, book_id: int, words: List[str]) -> None:
+        self.documents -= 1
+        for word in set(words):
+            posting = self.postings.get(word)
+            if posting is None or posting.pop(book_id, None) is None:
+                continue
+            if not posting:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def prefix_words(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self.words, prefix)
+        upper = SortedIndex.prefix_upper(prefix)
+        end = len(self.words) if upper is None else bisect.bisect_left(self.words, upper)
+        return self.words[start:end]
+
+    def search(self, query_words: List[str]) -> List[int]:
+        """
+        IDs of books that contain all query words as prefixes of own words. Books are ordered by TF-IDF score, so
+        books with more rare words are first.
+        """
+        scores: Optional[Dict[int, float]] = None
+        for query_word in query_words:
+            word_scores: Dict[int, float] = {}
+            for word in self.prefix_words(query_word):
+                posting = self.postings[word]
+                idf = math.log(1 + self.documents / len(posting))
+                for book_id, count in posting.items():
+                    word_scores[book_id] = word_scores.get(book_id, 0.0) + count * idf
+            if scores is None:
+                scores = word_scores
+            else:  # All words should be found.
+                scores = {book_id: score + word_scores[book_id]
+                          for book_id, score in scores.items() if book_id in word_scores}
+            if not scores:
+                return []
+        return sorted(scores, key=lambda book_id: (-scores[book_id], book_id))
+
+
+class GroupCounter:
+    """Number of books for every value of the field: facets are read in O(groups) instead of scan of all books."""
+
+    def __init__(self):
+        self.counts: Dict[Any, int] = {}
+
+    def add(self, value: Any) -> None:
+        self.counts[value] = self.counts.get(value, 0) + 1
+
+    def extend(self, values: Iterable[Any]) -> None:
+        counts = self.counts
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+
+    def remove(self, value: Any) -> None:
+        count = self.counts.get(value, 0) - 1
+        if count > 0:
+            self.counts[value] = count
+        else:
+            self.counts.pop(value, None)
+
+    def groups(self, key: Optional[Callable[[Any], Any]] = None) -> Dict[Any, int]:
+        """Counts of groups, values of the groups can be merged by the key function."""
+        if key is None:
+            return dict(self.counts)
+        groups: Dict[Any, int] = {}
+        for value, count in self.counts.items():
+            group = key(value)
+            groups[group] = groups.get(group, 0) + count
+        return groups
+
+
+class ChangeLog:
+    """
+    Sequence numbers of the last change of every book. Older changes of the book are dropped, so the log is not longer
+    than number of books and tombstones, and changes after any number are found by binary search.
+    """
+
+    def __init__(self, seq: int = 0):
+        self.seq = seq  # Number of the last change.
+        self.first_seq = seq  # Changes before it are unknown (they were before start).
+        self.book_seqs: Dict[int, int] = {}  # Book ID -> number of its last change.
+        self.seq_books: Dict[int, int] = {}  # Number of the last change -> book ID, ordered by numbers.
+        self.seqs: List[int] = []  # Sorted numbers, also of dropped changes.
+
+    def add(self, book_id: int) -> int:
+        self.seq += 1
+        previous = self.book_seqs.get(book_id)
+        if previous is not None:
+            del self.seq_books[previous]
+        self.book_seqs[book_id] = self.seq
+        self.seq_books[self.seq] = book_id
+        self.seqs.append(self.seq)
+        if len(self.seqs) > 2 * len(self.seq_books) + 1024:  # Drop numbers of old changes from time to time.
+            self.seqs = list(self.seq_books)
+        return self.seq
+
+    def extend(self, book_ids: Iterable[int]) -> None:
+        for book_id in book_ids:
+            self.add(book_id)
+
+    def since(self, seq: int, limit: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Pairs of change number and book ID of the last changes after `seq`."""
+        result = []
+        for position in range(bisect.bisect_right(self.seqs, seq), len(self.seqs)):
+            change_seq = self.seqs[position]
+            book_id = self.seq_books.get(change_seq)
+            if book_id is None:  # Book was changed again later.
+                continue
+            result.append((change_seq, book_id))
+            if limit is not None and len(result) >= limit:
+                break
+        return result
@@ -0,0 +1,277 @@
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from array import array
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Saved book: ID, author, title and published date.
+SavedBook = Tuple[int, Optional[str], Optional[str], Optional[date]]
+
+# Versions of changed books only, others have version 1.
+BookVersions = Dict[int, int]
+
+SNAPSHOT_MAGIC = b"BOOKSNP4"
+# Magic, ID counter, number of the last change, number of books, number of changed books and sizes of UTF-8 authors
+# and titles. Then columns follow: IDs, ordinals of dates (0 is empty), lengths of authors and titles in characters
+# (-1 is empty), IDs and versions of changed books, all authors and all titles. Columns are decoded by a few calls, so
+# loading of millions of books takes seconds.
+SNAPSHOT_HEADER = struct.Struct("<8sqqqqqq")
+SNAPSHOT_V3_MAGIC = b"BOOKSNP3"  # Previous version: without versions of books.
+SNAPSHOT_V3_HEADER = struct.Struct("<8sqqqqq")
+SNAPSHOT_V2_MAGIC = b"BOOKSNP2"  # Without number of the last change too.
+SNAPSHOT_V2_HEADER = struct.Struct("<8sqqqq")
+BOOK_HEADER = struct.Struct("<qiii")  # Book of the log: ID, date ordinal, lengths of UTF-8 author and title.
+LOG_HEADER = struct.Struct("<cII")  # Operation, length and CRC32 of the payload.
+BOOK_ID = struct.Struct("<q")
+BOOK_VERSION = struct.Struct("<q")
+
+PUT = b"P"  # Book with version 1.
+PUT_VERSION = b"V"  # Version and the book.
+DELETE = b"D"
+
+
+def encode_string(value: Optional[str]) -> bytes:
+    return b"" if value is None else value.encode()
+
+
+def encode_book(book: SavedBook) -> bytes:
+    book_id, author, title, published_date = book
+    author_bytes, title_bytes = encode_string(author), encode_string(title)
+    return BOOK_HEADER.pack(book_id,
+                            0 if published_date is None else published_date.toordinal(),
+                            -1 if author is None else len(author_bytes),
+                            -1 if title is None else len(title_bytes)) + author_bytes + title_bytes
+
+
+def decode_book(buffer, offset: int) -> SavedBook:
+    book_id, ordinal, author_size, title_size = BOOK_HEADER.unpack_from(buffer, offset)
+    offset += BOOK_HEADER.size
+    author = None
+    if author_size >= 0:
+        author = bytes(buffer[offset:offset + author_size]).decode()
+        offset += author_size
+    title = None
+    if title_size >= 0:
+        title = bytes(buffer[offset:offset + title_size]).decode()
+    return book_id, author, title, date.fromordinal(ordinal) if ordinal else None
+
+
+def string_lengths(values: List[Optional[str]]) -> array:
+    return array("i", [-1 if value is None else len(value) for value in values])
+
+
+def split_strings(text: str, lengths: array) -> List[Optional[str]]:
+    result = []
+    offset = 0
+    for length in lengths:
+        if length < 0:
+            result.append(None)
+        else:
+            result.append(text[offset:offset + length])
+            offset += length
+    return result
+
+
+def write_snapshot(path: str, id_counter: int, change_seq: int, books: List[SavedBook], versions: BookVersions) -> None:
+    """Write snapshot to the temporary file and replace the old one, so snapshot is never partially written."""
+    # Columns are built by loops instead of `zip(*books)`: one long call would hold GIL for the whole (background)
+    # snapshot.
+    ids, authors, titles, dates = [[book[column] for book in books] for column in range(4)]
+    authors_bytes = "".join(author for author in authors if author is not None).encode()
+    titles_bytes = "".join(title for title in titles if title is not None).encode()
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as snapshot:
+        snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, id_counter, change_seq, len(books), len(versions),
+                                           len(authors_bytes), len(titles_bytes)))
+        snapshot.write(array("q", ids).tobytes())
+        snapshot.write(array("i", [0 if value is None else value.toordinal() for value in dates]).tobytes())
+        snapshot.write(string_lengths(authors).tobytes())
+        snapshot.write(string_lengths(titles).tobytes())
+        snapshot.write(array("q", versions.keys()).tobytes())
+        snapshot.write(array("q", versions.values()).tobytes())
+        snapshot.write(authors_bytes)
+        snapshot.write(titles_bytes)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temp_path, path)
+
+
+def read_column(buffer, offset: int, type_code: str, count: int) -> Tuple[array, int]:
+    """Column of the snapshot at the offset and the offset after it."""
+    column = array(type_code)
+    end = offset + column.itemsize * count
+    column.frombytes(buffer[offset:end])
+    return column, end
+
+
+def read_snapshot(path: str) -> Tuple[int, int, Dict[int, SavedBook], BookVersions]:
+    """
+    Read ID counter, number of the last change, books and versions of changed books of the snapshot. Missing snapshot
+    is empty.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return 0, 0, {}, {}
+
+    with open(path, "rb") as snapshot, mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        versions_count = 0
+        if buffer[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC:
+            _, id_counter, change_seq, count, versions_count, authors_size, titles_size = \
+                SNAPSHOT_HEADER.unpack_from(buffer, 0)
+            offset = SNAPSHOT_HEADER.size
+        elif buffer[:len(SNAPSHOT_V3_MAGIC)] == SNAPSHOT_V3_MAGIC:
+            _, id_counter, change_seq, count, authors_size, titles_size = SNAPSHOT_V3_HEADER.unpack_from(buffer, 0)
+            offset = SNAPSHOT_V3_HEADER.size
+        elif buffer[:len(SNAPSHOT_V2_MAGIC)] == SNAPSHOT_V2_MAGIC:
+            _, id_counter, count, authors_size, titles_size = SNAPSHOT_V2_HEADER.unpack_from(buffer, 0)
+            change_seq = 0
+            offset = SNAPSHOT_V2_HEADER.size
+        else:
+            raise ValueError(f"File '{path}' is not a snapshot of books")
+        columns = []
+        for type_code in ["q", "i", "i", "i"]:
+            column, offset = read_column(buffer, offset, type_code, count)
+            columns.append(column)
+        version_ids, offset = read_column(buffer, offset, "q", versions_count)
+        version_values, offset = read_column(buffer, offset, "q", versions_count)
+        authors_text = buffer[offset:offset + authors_size].decode()
+        offset += authors_size
+        titles_text = buffer[offset:offset + titles_size].decode()
+
+    ids, ordinals, author_lengths, title_lengths = columns
+    dates = {ordinal: date.fromordinal(ordinal) for ordinal in set(ordinals) if ordinal}  # Dates are shared.
+    dates[0] = None
+    books = zip(ids,
+                split_strings(authors_text, author_lengths),
+                split_strings(titles_text, title_lengths),
+                [dates[ordinal] for ordinal in ordinals])
+    return id_counter, change_seq, {book[0]: book for book in books}, dict(zip(version_ids, version_values))
+
+
+class WriteLog:
+    """
+    Append-only log of changes that are made after the snapshot. Every entry is written to OS on append, so it survives
+    crash of the process, and synced to the disk at least once in `fsync_interval` seconds (on every append for 0).
+    """
+
+    def __init__(self, path: str, fsync_interval: float = 1.0):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+        self.dirty = False
+        self.closed = threading.Event()
+        self.sync_thread = None
+        if fsync_interval > 0:
+            self.sync_thread = threading.Thread(target=self.sync_periodically, name="write-log-sync", daemon=True)
+            self.sync_thread.start()
+
+    @staticmethod
+    def replay(path: str, books: Dict[int, SavedBook], versions: BookVersions) -> Tuple[int, int]:
+        """
+        Apply entries of the log to books and their versions. Return maximal ID of created books and number of
+        entries. Incomplete entry at the end of the log (process was stopped during the write) is ignored and cut off.
+        """
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 0, 0
+
+        max_id = 0
+        entries = 0
+        with open(path, "rb") as log, mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            offset = 0
+            while offset + LOG_HEADER.size <= len(buffer):
+                operation, size, checksum = LOG_HEADER.unpack_from(buffer, offset)
+                start, end = offset + LOG_HEADER.size, offset + LOG_HEADER.size + size
+                if end > len(buffer) or zlib.crc32(buffer[start:end]) != checksum:
+                    break
+                if operation == PUT:
+                    book = decode_book(buffer, start)
+                    books[book[0]] = book
+                    versions.pop(book[0], None)
+                    max_id = max(max_id, book[0])
+                elif operation == PUT_VERSION:
+                    book = decode_book(buffer, start + BOOK_VERSION.size)
+                    books[book[0]] = book
+                    versions[book[0]] = BOOK_VERSION.unpack_from(buffer, start)[0]
+                    max_id = max(max_id, book[0])
+                elif operation == DELETE:
+                    book_id = BOOK_ID.unpack_from(buffer, start)[0]
+                    books.pop(book_id, None)
+                    versions.pop(book_id, None)
+                entries += 1
+                offset = end
+            valid_size = offset
+        if valid_size < os.path.getsize(path):
+            os.truncate(path, valid_size)
+        return max_id, entries
+
+    def append(self, operation: bytes, payload: bytes) -> None:
+        with self.lock:
+            self.file.write(LOG_HEADER.pack(operation, len(payload), zlib.crc32(payload)) + payload)
+            self.file.flush()
+            self.size = self.file.tell()
+            if self.fsync_interval <= 0:
+                os.fsync(self.file.fileno())
+            else:
+                self.dirty = True
+
+    def put(self, book: SavedBook, version: int = 1) -> None:
+        if version == 1:
+            self.append(PUT, encode_book(book))
+        else:
+            self.append(PUT_VERSION, BOOK_VERSION.pack(version) + encode_book(book))
+
+    def delete(self, book_id: int) -> None:
+        self.append(DELETE, BOOK_ID.pack(book_id))
+
+    def sync(self) -> None:
+        with self.lock:
+            if self.dirty and not self.file.closed:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def sync_periodically(self) -> None:
+        while not self.closed.wait(self.fsync_interval):
+            self.sync()
+
+    def discard(self, size: int) -> None:
+        """
+        Remove entries of the first `size` bytes: they are saved by the snapshot. Entries that were appended after them
+        are moved to the new file, it replaces the log only when it is synced.
+        """
+        with self.lock:
+            with open(self.path, "rb") as log:
+                log.seek(size)
+                tail = log.read()
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as temp:
+                temp.write(tail)
+                temp.flush()
+                os.fsync(temp.fileno())
+            os.replace(temp_path, self.path)
+            self.file.close()
+            self.file = open(self.path, "ab")
+            self.size = len(tail)
+            self.dirty = False
+
+    def truncate(self) -> None:
+        """Remove all entries: they are saved by the snapshot."""
+        with self.lock:
+            self.file.truncate(0)
+            self.file.seek(0)
+            os.fsync(self.file.fileno())
+            self.size = 0
+            self.dirty = False
+
+    def close(self) -> None:
+        self.closed.set()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+        self.sync()
+        with self.lock:
+            self.file.close()
@@ -1,17 +1,38 @@
 from datetime import date
-from typing import List, Any, Optional
+from typing import Dict, Iterator, List, Any, Optional, Tuple
 
 from pydantic import ValidationError
 
-from rest_app.domain import Book, BookUpdate, BookNotFoundException
+from rest_app.domain import Book, BookChangesCompactedException, BookFacet, BookOrder, BookUpdate, \
+    BookNotFoundException, BookVersionConflictException, tokenize
+from rest_app.encoding import BOOK_FIELDS, BookChange, BookRecord, ChangeCursor
+from rest_app.metrics import VALIDATION_DURATION
+from rest_app.storage.sqlite_pool import SQLiteConnectionPool
+from rest_app.storage.sqlite_query import BookQueryBuilder
 
+import os
 import sqlite3
+import time
+
+# `UPDATE ... RETURNING` and `DELETE ... RETURNING` are supported since SQLite 3.35.
+RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Databases with checked schema in this process: real path -> (`schema_version` after the check, FTS5 flag). Storages
+# that are opened again (by tests, benchmarks, shards) skip the check in the write transaction if nobody changed the
+# schema since.
+checked_schemas: Dict[str, Tuple[int, bool]] = {}
 
 
 class SQLiteBookStorage:
     """Storage for books that save data in SQLite 3."""
 
-    def __init__(self, storage_name: str):
+    backend = "sqlite"
+
+    def __init__(self,
+                 storage_name: str,
+                 pool_size: int = 4,
+                 pragmas: Optional[Dict[str, str]] = None,
+                 slow_query_threshold: float = 0.0):
         self.storage_name = storage_name
 
         # Create database if it is not exists.
@@ -21,8 +42,26 @@ class SQLiteBookStorage:
             path.parent.mkdir()  # Create dirs.
             path.touch()  # Create file.
 
+        self.pool = SQLiteConnectionPool(self.storage_name, pool_size, pragmas,
+                                         slow_query_threshold=slow_query_threshold)
+        self.returning = RETURNING_SUPPORTED
+
+        schema_key = os.path.realpath(self.storage_name)
+        schema_version = self.read_schema_version()
+        checked_version, self.full_text_search = checked_schemas.get(schema_key, (None, False))
+        if checked_version != schema_version:
+            self.create_schema()
+            checked_schemas[schema_key] = self.read_schema_version(), self.full_text_search
+
+    def read_schema_version(self) -> int:
+        with self.pool.reader() as connection:
+            return connection.execute("PRAGMA schema_version;").fetchone()[0]
+
+    def create_schema(self) -> None:
+        """Create tables, indexes and triggers if they were not exists, update schema of old databases."""
+
         # Create table if it was not exists.
-        with sqlite3.connect(self.storage_name) as connection:
+        with self.pool.writer() as connection:
             cursor = connection.cursor()
             create_books_table = """
                 CREATE TABLE IF NOT EXISTS books (
@@ -31,11 +70,86 @@ class SQLiteBookStorage:
                     title           TEXT,
                     -- SQLite does not have a storage class set aside for storing dates and/or times. 
                     -- See: https://sqlite.org/datatype3.html
-                    published_date  TEXT
+                    published_date  TEXT,
+                    -- Incremented on every update, used for optimistic concurrency.
+                    version         INTEGER NOT NULL DEFAULT 1
                 );
             """
             cursor.execute(create_books_table)
-            connection.commit()
+            if "version" not in [column[1] for column in cursor.execute("PRAGMA table_info(books);")]:
+                cursor.execute("ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 1;")  # Old databases.
+            # Indexes for filters of the list: strings are searched case-insensitive, like LIKE do.
+            cursor.execute("CREATE INDEX IF NOT EXISTS books_author ON books(author COLLATE NOCASE);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS books_title ON books(title COLLATE NOCASE);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS books_published_date ON books(published_date);")
+            # Indexes of the list order: on the same expressions as `ORDER BY`, so pages are read without sorting.
+            cursor.execute("CREATE INDEX IF NOT EXISTS books_order_author ON books(IFNULL(author, ''));")
+            cursor.execute("CREATE INDEX IF NOT EXISTS books_order_title ON books(IFNULL(title, ''));")
+            self.full_text_search = SQLiteBookStorage.create_full_text_index(cursor)
+            SQLiteBookStorage.create_change_log(cursor)
+
+    @staticmethod
+    def create_full_text_index(cursor) -> bool:
+        """Create FTS5 index of authors and titles that is updated by triggers. Return False if FTS5 is missing."""
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts';").fetchone() is not None
+        if not exists:
+            try:
+                cursor.execute("""
+                    CREATE VIRTUAL TABLE books_fts USING fts5(
+                        author, title, content = 'books', content_rowid = 'id', tokenize = 'unicode61'
+                    );
+                """)
+            except sqlite3.OperationalError:  # SQLite was compiled without FTS5.
+                return False
+            cursor.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild');")  # Index existing books.
+
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+                INSERT INTO books_fts(rowid, author, title) VALUES (new.id, new.author, new.title);
+            END;
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+                INSERT INTO books_fts(books_fts, rowid, author, title) VALUES ('delete', old.id, old.author, old.title);
+            END;
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF author, title ON books BEGIN
+                INSERT INTO books_fts(books_fts, rowid, author, title) VALUES ('delete', old.id, old.author, old.title);
+                INSERT INTO books_fts(rowid, author, title) VALUES (new.id, new.author, new.title);
+            END;
+        """)
+        return True
+
+    @staticmethod
+    def create_change_log(cursor) -> None:
+        """
+        Create table of the last change of every book that is updated by triggers. Older changes of the book are
+        replaced, so the table is not longer than number of books and tombstones of removed books.
+        """
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'book_changes';").fetchone() is not None
+        if not exists:
+            cursor.execute("""
+                CREATE TABLE book_changes (
+                    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+                    book_id  INTEGER NOT NULL UNIQUE
+                );
+            """)
+            cursor.execute("INSERT INTO book_changes(book_id) SELECT id FROM books ORDER BY id;")  # Existing books.
+
+        for trigger, event, book in [("book_changes_insert", "INSERT", "new"),
+                                     ("book_changes_update", "UPDATE", "new"),
+                                     ("book_changes_delete", "DELETE", "old")]:
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON books BEGIN
+                    INSERT OR REPLACE INTO book_changes(book_id) VALUES ({book}.id);
+                END;
+            """)
+
+    def close(self) -> None:
+        """Close all connections to the database."""
+
+        self.pool.close()
 
     @staticmethod
     def get_book_columns(cursor) -> List[str]:
@@ -46,104 +160,321 @@ class SQLiteBookStorage:
         return Book(**dict(zip(book_columns, book_record)))
 
     @staticmethod
-    def string_compare_expr(key, value):
-        if value is None:
-            return None
+    def read_versioned_book(cursor, book_record: List[Any]) -> Tuple[Book, int]:
+        book_dict = dict(zip(SQLiteBookStorage.get_book_columns(cursor), book_record))
+        return Book(**book_dict), book_dict["version"]
 
-        if "?" in value or "*" in value:
-            value_expr = value.replace("?", "_").replace("*", "%")
-            return f'{key} LIKE "{value_expr}"'
-        else:
-            return f'{key} = "{value}"'
+    @property
+    def version(self) -> int:
+        """Version of the data: changed after every write."""
+
+        return self.pool.version
+
+    def statement_cache_stats(self) -> Dict[str, float]:
+        """Hits and misses of prepared statements cache."""
+
+        return self.pool.statement_stats.as_dict()
 
     @staticmethod
-    def date_compare_expr(key, comparator, value):
-        if value is None:
-            return None
+    def select_books(connection,
+                     author: Optional[str],
+                     title: Optional[str],
+                     published_date_from: Optional[date],
+                     published_date_to: Optional[date],
+                     limit: Optional[int],
+                     after_id: Optional[int],
+                     order_by: BookOrder):
+        order_by = BookOrder(order_by)
+        after = None
+        if after_id is not None:
+            after = SQLiteBookStorage.find_order_value(connection, order_by, after_id), after_id
 
-        time_format = "%Y-%m-%d"
-        return f'strftime("{time_format}", {key}) {comparator} strftime("{time_format}", "{value}")'
+        select_books, params = BookQueryBuilder.select_books(
+            author, title, published_date_from, published_date_to, limit, after, order_by.value)
+        return connection.execute(select_books, params)
 
     def list(self,
              author: Optional[str] = None,
              title: Optional[str] = None,
              published_date_from: Optional[date] = None,
-             published_date_to: Optional[date] = None) -> List[Book]:
-        """Provide list of saved books."""
+             published_date_to: Optional[date] = None,
+             limit: Optional[int] = None,
+             after_id: Optional[int] = None,
+             order_by: BookOrder = BookOrder.id) -> List[Book]:
+        """Provide list of saved books. Return at most `limit` books that follow the book `after_id`."""
 
-        filter_conditions = [SQLiteBookStorage.string_compare_expr("author", author),
-                             SQLiteBookStorage.string_compare_expr("title", title),
-                             SQLiteBookStorage.date_compare_expr("published_date", ">", published_date_from),
-                             SQLiteBookStorage.date_compare_expr("published_date", "<", published_date_to)]
-        condition = " AND ".join([v for v in filter_conditions if v])
-        where = "" if condition is "" else f"WHERE {condition}"
-
-        with sqlite3.connect(self.storage_name) as connection:
-            cursor = connection.cursor()
-            cursor.execute(f"SELECT * from books {where};")
+        with self.pool.reader() as connection:
+            cursor = SQLiteBookStorage.select_books(
+                connection, author, title, published_date_from, published_date_to, limit, after_id, order_by)
             book_record_list = cursor.fetchall()
             book_columns = SQLiteBookStorage.get_book_columns(cursor)
-            result = []
-            for book_record in book_record_list:
-                try:
-                    book = SQLiteBookStorage.read_book(book_columns, book_record)
-                    result.append(book)
-                except ValidationError:
-                    self.remove(book_record[0])
-            return result
+        start = time.perf_counter()
+        result = []
+        invalid_ids = []
+        for book_record in book_record_list:
+            try:
+                book = SQLiteBookStorage.read_book(book_columns, book_record)
+                result.append(book)
+            except ValidationError:
+                invalid_ids.append(book_record[0])
+        VALIDATION_DURATION.observe(time.perf_counter() - start, self.backend)
+        for book_id in invalid_ids:
+            self.remove(book_id)
+        return result
+
+    def list_records(self,
+                     author: Optional[str] = None,
+                     title: Optional[str] = None,
+                     published_date_from: Optional[date] = None,
+                     published_date_to: Optional[date] = None,
+                     limit: Optional[int] = None,
+                     after_id: Optional[int] = None,
+                     order_by: BookOrder = BookOrder.id) -> List[BookRecord]:
+        """The same as `list()`, but return rows as they are saved: records are written only after validation."""
+
+        with self.pool.reader() as connection:
+            cursor = SQLiteBookStorage.select_books(
+                connection, author, title, published_date_from, published_date_to, limit, after_id, order_by)
+            return cursor.fetchall()
+
+    def iterate(self,
+                author: Optional[str] = None,
+                title: Optional[str] = None,
+                published_date_from: Optional[date] = None,
+                published_date_to: Optional[date] = None,
+                limit: Optional[int] = None,
+                after_id: Optional[int] = None,
+                order_by: BookOrder = BookOrder.id,
+                batch_size: int = 1000) -> Iterator[Book]:
+        """Iterate over saved books. Records are read by batches from one cursor, so memory usage does not grow."""
+
+        with self.pool.stream_reader() as connection:  # Pooled readers are not held by slow clients.
+            cursor = SQLiteBookStorage.select_books(
+                connection, author, title, published_date_from, published_date_to, limit, after_id, order_by)
+            book_columns = SQLiteBookStorage.get_book_columns(cursor)
+            while True:
+                book_record_list = cursor.fetchmany(batch_size)
+                if not book_record_list:
+                    break
+                for book_record in book_record_list:
+                    try:
+                        yield SQLiteBookStorage.read_book(book_columns, book_record)
+                    except ValidationError:
+                        continue  # Incorrect records are removed by list().
+            cursor.close()
+
+    def iterate_records(self,
+                        author: Optional[str] = None,
+                        title: Optional[str] = None,
+                        published_date_from: Optional[date] = None,
+                        published_date_to: Optional[date] = None,
+                        limit: Optional[int] = None,
+                        after_id: Optional[int] = None,
+                        order_by: BookOrder = BookOrder.id,
+                        batch_size: int = 1000) -> Iterator[BookRecord]:
+        """The same as `iterate()`, but return rows as they are saved."""
+
+        with self.pool.stream_reader() as connection:
+            cursor = SQLiteBookStorage.select_books(
+                connection, author, title, published_date_from, published_date_to, limit, after_id, order_by)
+            while True:
+                book_record_list = cursor.fetchmany(batch_size)
+                if not book_record_list:
+                    break
+                yield from book_record_list
+            cursor.close()
+
+    def search(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[Book]:
+        """Find books that contain all words of the query (as prefixes) in author or title. Best matches are first."""
+
+        book_record_list = self.search_records(query, limit, offset)
+        start = time.perf_counter()
+        result = [SQLiteBookStorage.read_book(BOOK_FIELDS, book_record) for book_record in book_record_list]
+        VALIDATION_DURATION.observe(time.perf_counter() - start, self.backend)
+        return result
+
+    def search_records(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[BookRecord]:
+        """The same as `search()`, but return rows as they are saved."""
+
+        words = tokenize(query)
+        if not words:
+            return []
+        if self.full_text_search:
+            search_books, params = BookQueryBuilder.search_books(words, limit, offset)
+        else:
+            search_books, params = BookQueryBuilder.search_books_by_like(words, limit, offset)
+        with self.pool.reader() as connection:
+            return connection.execute(search_books, params).fetchall()
+
+    def count_groups(self,
+                     facet: BookFacet,
+                     author: Optional[str] = None,
+                     title: Optional[str] = None,
+                     published_date_from: Optional[date] = None,
+                     published_date_to: Optional[date] = None,
+                     limit: Optional[int] = None) -> List[Tuple[Optional[str], int]]:
+        """Count filtered books by groups of the facet by one `GROUP BY` statement."""
+
+        count_books, params = BookQueryBuilder.count_books(
+            BookFacet(facet).value, author, title, published_date_from, published_date_to, limit)
+        with self.pool.reader() as connection:
+            return connection.execute(count_books, params).fetchall()
+
+    def changes(self, since: ChangeCursor = 0, limit: Optional[int] = None) -> List[BookChange]:
+        """
+        The last changes of books after the change `since`, ordered by numbers of changes. Removed books have empty
+        records (tombstones).
+        """
+
+        with self.pool.reader() as connection:
+            change_records = connection.execute(*BookQueryBuilder.select_changes(since, limit)).fetchall()
+            if not change_records and not isinstance(since, int):  # Cursor of sharded storage.
+                raise BookChangesCompactedException(since, 0)
+            if not change_records and since > 0:
+                last_seq = connection.execute(*BookQueryBuilder.last_change_seq()).fetchone()
+                if last_seq is None or since > last_seq[0]:  # Numbers of another database.
+                    raise BookChangesCompactedException(since, 0)
+        return [(seq, book_id, None if record[0] is None else tuple(record))
+                for seq, book_id, *record in change_records]
 
     def find(self, book_id: int) -> Book:
         """Find book from the storage. Can be used for modification or delete requests."""
 
-        with sqlite3.connect(self.storage_name) as connection:
-            cursor = connection.cursor()
-            cursor.execute(f"SELECT * from books WHERE id = {book_id};")
+        with self.pool.reader() as connection:
+            return SQLiteBookStorage.find_book(connection, book_id)
+
+    def find_versioned(self, book_id: int) -> Tuple[Book, int]:
+        """Find book and its version."""
+
+        with self.pool.reader() as connection:
+            cursor = connection.execute(*BookQueryBuilder.select_book(book_id))
             book_record = cursor.fetchone()
             if book_record is None:
                 raise BookNotFoundException(book_id)
-            book_columns = SQLiteBookStorage.get_book_columns(cursor)
-            return SQLiteBookStorage.read_book(book_columns, book_record)
+            return SQLiteBookStorage.read_versioned_book(cursor, book_record)
+
+    @staticmethod
+    def find_order_value(connection, order_by: BookOrder, book_id: int) -> Any:
+        if order_by is BookOrder.id:
+            return book_id
+        order_record = connection.execute(*BookQueryBuilder.select_order_value(order_by.value, book_id)).fetchone()
+        if order_record is None:
+            raise BookNotFoundException(book_id)
+        return order_record[0]
+
+    @staticmethod
+    def find_book(connection, book_id: int) -> Book:
+        cursor = connection.execute(*BookQueryBuilder.select_book(book_id))
+        book_record = cursor.fetchone()
+        if book_record is None:
+            raise BookNotFoundException(book_id)
+        book_columns = SQLiteBookStorage.get_book_columns(cursor)
+        return SQLiteBookStorage.read_book(book_columns, book_record)
 
     def create(self, book: BookUpdate) -> Book:
         """Create book in a storage. Populate unique identifier for future requests."""
 
-        with sqlite3.connect(self.storage_name) as connection:
-            cursor = connection.cursor()
+        with self.pool.writer() as connection:
+            cursor = connection.execute(*BookQueryBuilder.insert_book(book.dict()))
+            # Read the record back inside of the same transaction: no need for another connection.
+            return SQLiteBookStorage.find_book(connection, cursor.lastrowid)
+
+    def create_many(self, books: List[BookUpdate]) -> List[Book]:
+        """Create books in one transaction."""
+
+        if not books:
+            return []
+        book_dicts = [book.dict() for book in books]
+        with self.pool.writer() as connection:
+            connection.executemany(*BookQueryBuilder.insert_books(book_dicts))
+            # Writes are serialized and AUTOINCREMENT IDs grow by one, so inserted books have the last IDs.
+            last_id = connection.execute(*BookQueryBuilder.last_book_id()).fetchone()[0]
+        first_id = last_id - len(book_dicts) + 1
+        return [Book(id=first_id + i, **book_dict) for i, book_dict in enumerate(book_dicts)]
+
+    def update_many(self, updates: List[Book]) -> List[Optional[Book]]:
+        """Update books in one transaction. Empty values are not changed. Return None for not found books."""
 
-            book_dict = book.dict()
-            columns = ', '.join(book_dict.keys())
-            values = ', '.join([f'"{str(val)}"' for val in book_dict.values()])
-            create_book = f"INSERT INTO books({columns}) VALUES ({values});"
-            print(create_book)
+        if not updates:
+            return []
+        with self.pool.writer() as connection:
+            connection.executemany(*BookQueryBuilder.update_books([update.dict() for update in updates]))
+            books = SQLiteBookStorage.find_books(connection, [update.id for update in updates])
+        return [books.get(update.id) for update in updates]
 
-            cursor.execute(create_book)
-            new_id = cursor.lastrowid
-            connection.commit()
-        return self.find(new_id)
+    def remove_many(self, book_ids: List[int]) -> List[Optional[Book]]:
+        """Remove books in one transaction. Return removed books or None for not found books."""
 
-    def remove(self, book_id: str) -> None:
+        if not book_ids:
+            return []
+        with self.pool.writer() as connection:
+            books = SQLiteBookStorage.find_books(connection, book_ids)
+            connection.execute(*BookQueryBuilder.delete_books(list(books.keys())))
+        return [books.pop(book_id, None) for book_id in book_ids]  # Each book is removed only once.
+
+    @staticmethod
+    def find_books(connection, book_ids: List[int]) -> Dict[int, Book]:
+        cursor = connection.execute(*BookQueryBuilder.select_books_by_ids(book_ids))
+        book_columns = SQLiteBookStorage.get_book_columns(cursor)
+        books = [SQLiteBookStorage.read_book(book_columns, book_record) for book_record in cursor.fetchall()]
+        return {book.id: book for book in books}
+
+    def remove(self, book_id: int) -> None:
         """Remove book from the storage."""
 
-        with sqlite3.connect(self.storage_name) as connection:
-            cursor = connection.cursor()
+        with self.pool.writer() as connection:
+            connection.execute(*BookQueryBuilder.delete_book(book_id))
 
-            cursor.execute(f"DELETE FROM books WHERE id = {book_id};")
+    @staticmethod
+    def raise_not_changed(connection, book_id: int) -> None:
+        """Statement did not change the book: it is missing or has other version."""
+        version_record = connection.execute(*BookQueryBuilder.select_version(book_id)).fetchone()
+        if version_record is None:
+            raise BookNotFoundException(book_id)
+        raise BookVersionConflictException(book_id, version_record[0])
 
-            connection.commit()
+    def update_fields(self,
+                      book_id: int,
+                      fields: Dict[str, Any],
+                      expected_version: Optional[int] = None) -> Tuple[Book, int]:
+        """
+        Set given fields of the book (empty values clear the field) by one statement, if the book has expected version.
+        Return updated book and its new version.
+        """
 
-    def persist(self, book: Book) -> None:
-        """Update book in a storage."""
+        with self.pool.writer() as connection:
+            if self.returning:
+                cursor = connection.execute(*BookQueryBuilder.update_fields(book_id, fields, expected_version, True))
+                book_records = cursor.fetchall()
+            else:  # Old SQLite: read the row back inside of the same transaction.
+                book_records = []
+                if connection.execute(
+                        *BookQueryBuilder.update_fields(book_id, fields, expected_version, False)).rowcount > 0:
+                    cursor = connection.execute(*BookQueryBuilder.select_book(book_id))
+                    book_records = cursor.fetchall()
+            if not book_records:
+                SQLiteBookStorage.raise_not_changed(connection, book_id)
+            return SQLiteBookStorage.read_versioned_book(cursor, book_records[0])
 
-        with sqlite3.connect(self.storage_name) as connection:
-            cursor = connection.cursor()
+    def delete_returning(self, book_id: int, expected_version: Optional[int] = None) -> Book:
+        """Remove book by one statement, if it has expected version. Return removed book."""
 
-            update_items = []
-            for item in book.dict().items():
-                if item[0] != 'id' and item[1]:
-                    update_items.append(item)
-            string_items = [f'"{item[0]}" = "{item[1]}"' for item in update_items]
-            update_str = ", ".join(string_items)
-            update_book = f"UPDATE books SET {update_str} WHERE id = {book.id};"
+        with self.pool.writer() as connection:
+            if self.returning:
+                cursor = connection.execute(*BookQueryBuilder.delete_book(book_id, expected_version, True))
+                book_records = cursor.fetchall()
+            else:
+                cursor = connection.execute(*BookQueryBuilder.select_book(book_id))
+                book_records = cursor.fetchall()
+                if book_records and connection.execute(
+                        *BookQueryBuilder.delete_book(book_id, expected_version)).rowcount == 0:
+                    book_records = []
+            if not book_records:
+                SQLiteBookStorage.raise_not_changed(connection, book_id)
+            return SQLiteBookStorage.read_versioned_book(cursor, book_records[0])[0]
+
+    def persist(self, book: Book) -> None:
+        """Update book in a storage."""
 
-            cursor.execute(update_book)
-            connection.commit()
+        with self.pool.writer() as connection:
+            connection.execute(*BookQueryBuilder.update_book(book.dict()))
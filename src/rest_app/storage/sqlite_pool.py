@@ -0,0 +1,278 @@
+from rest_app.deadline import RequestDeadlineException, current_deadline
+from rest_app.domain import StorageBusyException
+from rest_app.metrics import SQLITE_CONNECTION_WAIT, SQLITE_QUERY_DURATION, SlowQueryLog
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",  # Readers do not block the writer and vice versa.
+    "synchronous": "NORMAL",  # Safe with WAL, fsync only on checkpoints.
+    "mmap_size": str(256 * 1024 * 1024),
+    "cache_size": str(-16 * 1024),  # Negative value is the size in KiB.
+    "busy_timeout": "5000",
+    "temp_store": "MEMORY",
+}
+
+SUPPORTED_PRAGMAS = set(DEFAULT_PRAGMAS.keys())
+
+# Number of SQLite virtual machine steps between checks of the request deadline: checks add ~2% to long queries.
+DEADLINE_CHECK_STEPS = 1000
+
+# PRAGMA values can not be bound as parameters, so allow only simple tokens.
+PRAGMA_VALUE = re.compile(r"^-?[\w]+$")
+
+
+class StatementCacheStats:
+    """Count hits and misses of prepared statements cache of SQLite connections."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool) -> None:
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+class TrackingConnection(sqlite3.Connection):
+    """
+    Connection that follows the statement cache of sqlite3 module (LRU of SQL texts with `cached_statements` size)
+    to report how often prepared statements are reused. Also observe duration of statements and log slow ones
+    (for SELECT the duration includes only the first step, the rest is done by fetch).
+    """
+
+    def __init__(self, *args, cached_statements: int = 128, **kwargs):
+        super().__init__(*args, cached_statements=cached_statements, **kwargs)
+        self.cache_size = cached_statements
+        self.cached_sql = OrderedDict()
+        self.statement_stats: Optional[StatementCacheStats] = None
+        self.slow_query_log: Optional[SlowQueryLog] = None
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        self.track(sql)
+        start = time.perf_counter()
+        cursor = super().execute(sql, parameters)
+        self.observe(sql, time.perf_counter() - start)
+        return cursor
+
+    def executemany(self, sql: str, seq_of_parameters) -> sqlite3.Cursor:
+        self.track(sql)
+        start = time.perf_counter()
+        cursor = super().executemany(sql, seq_of_parameters)
+        self.observe(sql, time.perf_counter() - start)
+        return cursor
+
+    def observe(self, sql: str, duration: float) -> None:
+        words = sql.split(None, 1)
+        SQLITE_QUERY_DURATION.observe(duration, words[0].upper() if words else "")
+        if self.slow_query_log is not None:
+            self.slow_query_log.check(duration, sql)
+
+    def track(self, sql: str) -> None:
+        hit = sql in self.cached_sql
+        if hit:
+            self.cached_sql.move_to_end(sql)
+        else:
+            self.cached_sql[sql] = None
+            if len(self.cached_sql) > self.cache_size:
+                self.cached_sql.popitem(last=False)
+        if self.statement_stats is not None:
+            self.statement_stats.record(hit)
+
+
+class SQLiteConnectionPool:
+    """
+    Bounded pool of SQLite connections: up to `size` reader connections (one per worker thread) and one writer
+    connection. Writes are serialized by the lock, so there are never two write transactions inside the process.
+    Write transactions of different processes are serialized by SQLite (`BEGIN IMMEDIATE` waits for `busy_timeout`).
+    Readers are waited for at most `acquire_timeout` seconds. Long streams (exports) use their own connections, so
+    slow clients can not take all readers of short queries.
+    """
+
+    def __init__(self,
+                 database: str,
+                 size: int = 4,
+                 pragmas: Optional[Dict[str, str]] = None,
+                 cached_statements: int = 128,
+                 slow_query_threshold: float = 0.0,
+                 acquire_timeout: float = 5.0):
+        if size < 1:
+            raise ValueError(f"Connection pool size should be positive, but was {size}")
+
+        self.database = database
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.cached_statements = cached_statements
+        self.statement_stats = StatementCacheStats()
+        self.slow_query_log = SlowQueryLog(slow_query_threshold)
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        for name, value in (pragmas or {}).items():
+            if name not in SUPPORTED_PRAGMAS:
+                raise ValueError(f"Unsupported SQLite pragma '{name}'")
+            if not PRAGMA_VALUE.match(str(value)):
+                raise ValueError(f"Incorrect value '{value}' for SQLite pragma '{name}'")
+            self.pragmas[name] = str(value)
+
+        self.closed = False
+        self.readers_created = 0
+        self.readers = queue.LifoQueue()  # Reuse the most recent (hot) connection first.
+        self.readers_lock = threading.Lock()
+
+        self.writer_lock = threading.RLock()
+        self.writer_connection: Optional[sqlite3.Connection] = None
+
+        self.version_lock = threading.Lock()
+        self.version_connection: Optional[sqlite3.Connection] = None
+        self.data_version: Optional[int] = None
+        self.changes = 0  # Number of found changes of `data_version`.
+
+    def connect(self) -> sqlite3.Connection:
+        # Transactions are controlled explicitly, connections may be used by different threads (but never together).
+        connection = sqlite3.connect(self.database,
+                                     isolation_level=None,
+                                     check_same_thread=False,
+                                     factory=TrackingConnection,
+                                     cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {name} = {value};")
+        connection.statement_stats = self.statement_stats  # Do not count service statements.
+        connection.slow_query_log = self.slow_query_log
+        return connection
+
+    def acquire_reader(self) -> sqlite3.Connection:
+        if self.closed:
+            raise RuntimeError("Connection pool is closed")
+
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.readers_lock:
+            if self.readers_created < self.size:
+                self.readers_created += 1
+                return self.connect()
+        try:
+            return self.readers.get(timeout=self.acquire_timeout)  # Pool is exhausted: wait for other thread.
+        except queue.Empty:
+            raise StorageBusyException(self.acquire_timeout) from None
+
+    def release_reader(self, connection: sqlite3.Connection) -> None:
+        if self.closed:
+            connection.close()
+            return
+        self.readers.put(connection)
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow reader connection. Connection is in autocommit mode, so it does not hold WAL snapshots. Queries of the
+        request with the deadline are interrupted after it: nobody waits for them, but they hold the connection and
+        the thread.
+        """
+        start = time.perf_counter()
+        connection = self.acquire_reader()
+        SQLITE_CONNECTION_WAIT.observe(time.perf_counter() - start, "reader")
+        deadline = current_deadline()
+        if deadline is not None:
+            connection.set_progress_handler(lambda: time.perf_counter() > deadline, DEADLINE_CHECK_STEPS)
+        try:
+            yield connection
+        except sqlite3.OperationalError as e:
+            if deadline is not None and time.perf_counter() > deadline:  # Interrupted by the progress handler.
+                raise RequestDeadlineException() from e
+            raise
+        finally:
+            if deadline is not None:
+                connection.set_progress_handler(None, 0)
+            self.release_reader(connection)
+
+    @contextmanager
+    def stream_reader(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a dedicated reader connection for a long stream (export) that is consumed as fast as its client reads.
+        The connection is closed at the end: streams are limited by admission control, not by the pool.
+        """
+        if self.closed:
+            raise RuntimeError("Connection pool is closed")
+        connection = self.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Borrow writer connection inside of transaction. Commit on success, rollback on error."""
+        start = time.perf_counter()
+        with self.writer_lock:
+            SQLITE_CONNECTION_WAIT.observe(time.perf_counter() - start, "writer")
+            if self.closed:
+                raise RuntimeError("Connection pool is closed")
+            if self.writer_connection is None:
+                self.writer_connection = self.connect()
+
+            connection = self.writer_connection
+            if connection.in_transaction:  # Nested call: outer block controls the transaction.
+                yield connection
+                return
+
+            connection.execute("BEGIN IMMEDIATE;")
+            try:
+                yield connection
+            except BaseException:
+                connection.rollback()
+                raise
+            connection.commit()
+
+    @property
+    def version(self) -> int:
+        """
+        Version of the database: changed after commits of all connections, including connections of other processes.
+        `PRAGMA data_version` of a separate connection is changed by commits of any other connection and is read from
+        the shared memory of WAL, so it is cheap to check it on every request.
+        """
+        with self.version_lock:
+            if self.closed:
+                raise RuntimeError("Connection pool is closed")
+            if self.version_connection is None:  # Simple connection: checks are not counted by statistics.
+                self.version_connection = sqlite3.connect(self.database, isolation_level=None, check_same_thread=False)
+            data_version = self.version_connection.execute("PRAGMA data_version;").fetchone()[0]
+            if data_version != self.data_version:
+                self.data_version = data_version
+                self.changes += 1
+            return self.changes
+
+    def close(self) -> None:
+        """Close all connections. Connections that are borrowed at that moment will be closed on release."""
+        with self.writer_lock:
+            self.closed = True
+            while True:
+                try:
+                    self.readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            if self.writer_connection is not None:
+                self.writer_connection.close()
+                self.writer_connection = None
+        with self.version_lock:
+            if self.version_connection is not None:
+                self.version_connection.close()
+                self.version_connection = None
@@ -0,0 +1,277 @@
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+import json
+import re
+
+Query = Tuple[str, List[Any]]
+
+BOOK_COLUMNS = ["author", "title", "published_date"]
+
+MAX_ID = 2 ** 63 - 1
+
+# Values of the groups of books: author, year or month of publishing (dates are ISO strings).
+FACET_EXPRESSIONS = {
+    "author": "author",
+    "year": "substr(published_date, 1, 4)",
+    "month": "substr(published_date, 1, 7)",
+}
+
+# Empty strings are compared as empty strings, so they can be used in keyset conditions. Strings are ordered by
+# indexes on the same expressions (BINARY, like the memory storage). Empty dates are NULLs that are ordered first,
+# like empty strings, and the order is the same as order of the index.
+ORDER_EXPRESSIONS = {
+    "id": "id",
+    "author": "IFNULL(author, '')",
+    "title": "IFNULL(title, '')",
+    "published_date": "published_date",
+}
+
+
+def escape_like(value: str) -> str:
+    """Escape LIKE special symbols, so they are matched literally."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def ascii_lower(value: str) -> str:
+    """Lower case only ASCII letters, like NOCASE collation of SQLite does."""
+    return "".join([chr(ord(c) + 32) if "A" <= c <= "Z" else c for c in value])
+
+
+def like_prefix_range(prefix: str) -> Optional[Tuple[str, str]]:
+    """Range [lower, upper) of NOCASE strings that start from the prefix."""
+    if not prefix:
+        return None
+
+    lower = ascii_lower(prefix)
+    last = ord(lower[-1])
+    if last >= 0x10FFFF:
+        return None
+    return lower, lower[:-1] + chr(last + 1)
+
+
+def to_sql_value(value: Any) -> Any:
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+class BookQueryBuilder:
+    """
+    Build SQL statements for books table. All values are bound as parameters, so SQL text depends only on the
+    combination of the filters and SQLite can reuse prepared statements from the cache of the connection.
+    """
+
+    @staticmethod
+    def string_compare_expr(key: str, value: Optional[str]) -> Optional[Query]:
+        if value is None:
+            return None
+
+        if "?" not in value and "*" not in value:
+            # Index is case-insensitive: use it to find candidates and then check exact value.
+            return f"{key} = ? COLLATE NOCASE AND {key} = ?", [value, value]
+
+        value_expr = escape_like(value).replace("?", "_").replace("*", "%")
+        like_expr = f"{key} LIKE ? ESCAPE '\\'"
+
+        prefix = re.split(r"[?*]", value, maxsplit=1)[0]
+        prefix_range = like_prefix_range(prefix)
+        if prefix_range is None:
+            return like_expr, [value_expr]  # Pattern starts from wildcard: nothing to search in index.
+        # LIKE is case-insensitive like the index, so the range scan over index returns all candidates.
+        return f"{key} >= ? COLLATE NOCASE AND {key} < ? COLLATE NOCASE AND {like_expr}", \
+               [prefix_range[0], prefix_range[1], value_expr]
+
+    @staticmethod
+    def date_compare_expr(key: str, comparator: str, value: Optional[date]) -> Optional[Query]:
+        if value is None:
+            return None
+
+        # Dates are saved as ISO strings that have the same order as dates, so raw column can be compared with index.
+        return f"{key} {comparator} ?", [value.isoformat()]
+
+    @staticmethod
+    def where(conditions: List[Optional[Query]]) -> Query:
+        expressions, params = [], []
+        for condition in conditions:
+            if condition is None:
+                continue
+            expressions.append(condition[0])
+            params.extend(condition[1])
+        if not expressions:
+            return "", params
+        return "WHERE " + " AND ".join(expressions), params
+
+    @staticmethod
+    def select_books(author: Optional[str] = None,
+                     title: Optional[str] = None,
+                     published_date_from: Optional[date] = None,
+                     published_date_to: Optional[date] = None,
+                     limit: Optional[int] = None,
+                     after: Optional[Tuple[Any, int]] = None,
+                     order_by: str = "id") -> Query:
+        """
+        Select books ordered by `order_by` field and then by ID. Parameter `after` is a keyset cursor: pair of order
+        value and ID of the last book from the previous page.
+        """
+        order_expr = ORDER_EXPRESSIONS[order_by]
+        date_from_condition = BookQueryBuilder.date_compare_expr("published_date", ">", published_date_from)
+        keyset_condition = None
+        if after is not None:
+            if order_by == "id":
+                keyset_condition = "id > ?", [after[1]]
+            elif order_by == "published_date" and published_date_from is not None:
+                # Filter and cursor are joined to one lower bound, so SQLite seeks the index directly to the page.
+                if after[0] is not None:
+                    bound = max((published_date_from.isoformat(), MAX_ID), (after[0], after[1]))
+                    date_from_condition = "(published_date, id) > (?, ?)", list(bound)
+                # Otherwise cursor is on empty date, but filter selects only non-empty dates that are after it.
+            elif after[0] is None:  # Only for dates: NULL can not be compared.
+                keyset_condition = f"(({order_expr} IS NULL AND id > ?) OR {order_expr} IS NOT NULL)", [after[1]]
+            else:
+                # Row value is not a range of the index (ID is its hidden column): the first bound seeks to the page.
+                keyset_condition = f"{order_expr} >= ? AND ({order_expr}, id) > (?, ?)", [after[0], after[0], after[1]]
+
+        where, params = BookQueryBuilder.where([
+            BookQueryBuilder.string_compare_expr("author", author),
+            BookQueryBuilder.string_compare_expr("title", title),
+            date_from_condition,
+            BookQueryBuilder.date_compare_expr("published_date", "<", published_date_to),
+            keyset_condition
+        ])
+        if order_by != "id":
+            order = f"ORDER BY {order_expr}, id"
+        elif published_date_from is not None or published_date_to is not None:
+            # Unary plus hides ID order from the planner, otherwise SQLite prefers to scan the table in ID order and
+            # filter every row instead of the seek in the date index (matching rows are sorted then).
+            order = "ORDER BY +id"
+        else:
+            order = "ORDER BY id"
+        if limit is None:
+            return f"SELECT * FROM books {where} {order};", params
+        return f"SELECT * FROM books {where} {order} LIMIT ?;", params + [limit]
+
+    @staticmethod
+    def count_books(facet: str,
+                    author: Optional[str] = None,
+                    title: Optional[str] = None,
+                    published_date_from: Optional[date] = None,
+                    published_date_to: Optional[date] = None,
+                    limit: Optional[int] = None) -> Query:
+        """
+        Count filtered books by groups of the facet. Authors are ordered by number of books, dates are ordered by
+        value, empty values are the first ones.
+        """
+        where, params = BookQueryBuilder.where([
+            BookQueryBuilder.string_compare_expr("author", author),
+            BookQueryBuilder.string_compare_expr("title", title),
+            BookQueryBuilder.date_compare_expr("published_date", ">", published_date_from),
+            BookQueryBuilder.date_compare_expr("published_date", "<", published_date_to)
+        ])
+        order = "ORDER BY count DESC, value" if facet == "author" else "ORDER BY value"
+        return f"SELECT {FACET_EXPRESSIONS[facet]} AS value, COUNT(*) AS count FROM books {where} " \
+               f"GROUP BY value {order} LIMIT ?;", params + [-1 if limit is None else limit]
+
+    @staticmethod
+    def select_order_value(order_by: str, book_id: int) -> Query:
+        return f"SELECT {ORDER_EXPRESSIONS[order_by]} FROM books WHERE id = ?;", [book_id]
+
+    @staticmethod
+    def select_book(book_id: int) -> Query:
+        return "SELECT * FROM books WHERE id = ?;", [book_id]
+
+    @staticmethod
+    def select_version(book_id: int) -> Query:
+        return "SELECT version FROM books WHERE id = ?;", [book_id]
+
+    @staticmethod
+    def search_books(words: List[str], limit: Optional[int], offset: int, with_rank: bool = False) -> Query:
+        """Rank of the match is the first column, if `with_rank` (to merge results of several databases)."""
+        # Every word is quoted, so symbols of the user are not parsed as FTS5 query syntax.
+        match = " ".join([f'"{word}"*' for word in words])
+        columns = "books_fts.rank, books.*" if with_rank else "books.*"
+        return f"SELECT {columns} FROM books_fts JOIN books ON books.id = books_fts.rowid " \
+               "WHERE books_fts MATCH ? ORDER BY books_fts.rank, books.id LIMIT ? OFFSET ?;", \
+               [match, -1 if limit is None else limit, offset]
+
+    @staticmethod
+    def search_books_by_like(words: List[str], limit: Optional[int], offset: int) -> Query:
+        """Search without FTS5: slow scan and without ranking."""
+        conditions = " AND ".join(["(author LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\')"] * len(words))
+        params = []
+        for word in words:
+            params += [f"%{escape_like(word)}%"] * 2
+        return f"SELECT * FROM books WHERE {conditions} ORDER BY id LIMIT ? OFFSET ?;", \
+               params + [-1 if limit is None else limit, offset]
+
+    @staticmethod
+    def select_changes(since: int, limit: Optional[int]) -> Query:
+        # Removed books are not joined: their columns are NULLs.
+        return "SELECT c.seq, c.book_id, b.id, b.author, b.title, b.published_date FROM book_changes c " \
+               "LEFT JOIN books b ON b.id = c.book_id WHERE c.seq > ? ORDER BY c.seq LIMIT ?;", \
+               [since, -1 if limit is None else limit]
+
+    @staticmethod
+    def last_change_seq() -> Query:
+        return "SELECT seq FROM sqlite_sequence WHERE name = 'book_changes';", []
+
+    @staticmethod
+    def select_books_by_ids(book_ids: List[int]) -> Query:
+        # All IDs are passed as one JSON parameter, so the statement is the same for any number of IDs.
+        return "SELECT * FROM books WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id;", [json.dumps(book_ids)]
+
+    @staticmethod
+    def insert_book(book_dict: Dict[str, Any], with_ids: bool = False) -> Query:
+        insert_books, params = BookQueryBuilder.insert_books([book_dict], with_ids)
+        return insert_books, params[0]
+
+    @staticmethod
+    def insert_books(book_dicts: List[Dict[str, Any]], with_ids: bool = False) -> Tuple[str, List[List[Any]]]:
+        """Statement and list of parameters for `executemany()`. IDs are generated by SQLite, unless `with_ids`."""
+        insert_columns = ["id"] + BOOK_COLUMNS if with_ids else BOOK_COLUMNS
+        columns = ", ".join(insert_columns)
+        placeholders = ", ".join(["?"] * len(insert_columns))
+        return f"INSERT INTO books({columns}) VALUES ({placeholders});", \
+               [[to_sql_value(book_dict.get(column)) for column in insert_columns] for book_dict in book_dicts]
+
+    @staticmethod
+    def last_book_id() -> Query:
+        return "SELECT seq FROM sqlite_sequence WHERE name = 'books';", []
+
+    @staticmethod
+    def update_book(book_dict: Dict[str, Any]) -> Query:
+        update_books, params = BookQueryBuilder.update_books([book_dict])
+        return update_books, params[0]
+
+    @staticmethod
+    def update_books(book_dicts: List[Dict[str, Any]]) -> Tuple[str, List[List[Any]]]:
+        """Statement and list of parameters for `executemany()`."""
+        # Empty values do not overwrite existing ones, but the statement is the same for any set of values.
+        assignments = ", ".join([f"{column} = COALESCE(?, {column})" for column in BOOK_COLUMNS])
+        return f"UPDATE books SET {assignments}, version = version + 1 WHERE id = ?;", \
+               [[to_sql_value(book_dict.get(column) or None) for column in BOOK_COLUMNS] + [book_dict["id"]]
+                for book_dict in book_dicts]
+
+    @staticmethod
+    def update_fields(book_id: int, fields: Dict[str, Any], expected_version: Optional[int], returning: bool) -> Query:
+        """Set only given fields (empty values too) and increment version of the book, if it has expected version."""
+        columns = [column for column in BOOK_COLUMNS if column in fields]
+        assignments = ", ".join([f"{column} = ?" for column in columns] + ["version = version + 1"])
+        condition, params = BookQueryBuilder.versioned_condition(book_id, expected_version)
+        return f"UPDATE books SET {assignments} WHERE {condition}{' RETURNING *' if returning else ''};", \
+               [to_sql_value(fields[column]) for column in columns] + params
+
+    @staticmethod
+    def versioned_condition(book_id: int, expected_version: Optional[int]) -> Query:
+        if expected_version is None:
+            return "id = ?", [book_id]
+        return "id = ? AND version = ?", [book_id, expected_version]
+
+    @staticmethod
+    def delete_book(book_id: int, expected_version: Optional[int] = None, returning: bool = False) -> Query:
+        condition, params = BookQueryBuilder.versioned_condition(book_id, expected_version)
+        return f"DELETE FROM books WHERE {condition}{' RETURNING *' if returning else ''};", params
+
+    @staticmethod
+    def delete_books(book_ids: List[int]) -> Query:
+        return "DELETE FROM books WHERE id IN (SELECT value FROM json_each(?));", [json.dumps(book_ids)]
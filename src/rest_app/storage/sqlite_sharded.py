@@ -0,0 +1,441 @@
+from rest_app.deadline import call_with_deadline, current_deadline
+from rest_app.domain import Book, BookChangesCompactedException, BookFacet, BookOrder, BookUpdate, tokenize
+from rest_app.encoding import BOOK_FIELDS, BookChange, BookRecord, ChangeCursor
+from rest_app.storage.sqlite import SQLiteBookStorage
+from rest_app.storage.sqlite_query import BookQueryBuilder, Query
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from itertools import islice
+from operator import itemgetter
+from pydantic import ValidationError
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import heapq
+import os
+import threading
+
+
+def order_key(order_by: BookOrder) -> Callable[[BookRecord], Any]:
+    """Key of records that gives the same order as `ORDER BY` of `BookQueryBuilder.select_books()`."""
+    if order_by is BookOrder.id:
+        return itemgetter(0)
+    column = BOOK_FIELDS.index(order_by.value)
+    if order_by is BookOrder.published_date:  # Empty dates are NULLs: they are the first ones.
+        return lambda record: (record[column] is not None, record[column] or "", record[0])
+    return lambda record: (record[column] or "", record[0])
+
+
+class ShardIdConflictException(Exception):
+    """ID of the new book is not greater than the last ID of the shard: it was taken by another process."""
+
+
+class SQLiteShardStorage(SQLiteBookStorage):
+    """
+    One database of sharded storage. IDs of its books are `shard + 1`, `shard + 1 + shards` and so on, so the shard of
+    the book is known from its ID. Number of shards is saved in `user_version` of the database, so shards can not be
+    opened with another number (books would be looked for in wrong shards).
+    """
+
+    def __init__(self,
+                 storage_name: str,
+                 shard: int,
+                 shards: int,
+                 pool_size: int = 4,
+                 pragmas: Optional[Dict[str, str]] = None,
+                 slow_query_threshold: float = 0.0):
+        super().__init__(storage_name, pool_size, pragmas, slow_query_threshold)
+        self.shard = shard
+        self.shards = shards
+        with self.pool.reader() as connection:  # Write transaction only for a new shard.
+            saved_shards = connection.execute("PRAGMA user_version;").fetchone()[0]
+        if saved_shards == 0:
+            with self.pool.writer() as connection:
+                saved_shards = connection.execute("PRAGMA user_version;").fetchone()[0]
+                if saved_shards == 0:
+                    connection.execute(f"PRAGMA user_version = {int(shards)};")
+        if saved_shards not in [0, shards]:
+            self.close()
+            raise ValueError(f"Database {storage_name} is a shard of {saved_shards} shards, but not of {shards}")
+
+    @staticmethod
+    def last_id(connection) -> int:
+        """The largest ID that was ever used by the shard (AUTOINCREMENT also counts explicit IDs)."""
+        seq_record = connection.execute(*BookQueryBuilder.last_book_id()).fetchone()
+        return 0 if seq_record is None else seq_record[0]
+
+    def read_last_id(self) -> int:
+        with self.pool.reader() as connection:
+            return SQLiteShardStorage.last_id(connection)
+
+    def create_with_ids(self, book_dicts: List[Dict[str, Any]]) -> List[Book]:
+        """
+        Create books with given IDs in one transaction. IDs should be greater than all IDs of the shard, so IDs of
+        removed books are never used again.
+        """
+
+        with self.pool.writer() as connection:
+            if min(book_dict["id"] for book_dict in book_dicts) <= SQLiteShardStorage.last_id(connection):
+                raise ShardIdConflictException()
+            connection.executemany(*BookQueryBuilder.insert_books(book_dicts, with_ids=True))
+        return [Book(**book_dict) for book_dict in book_dicts]
+
+
+class ShardedSQLiteBookStorage:
+    """
+    Storage that partitions books by ID to several SQLite databases (shards) of one directory: the book with ID `n`
+    is saved to the shard `(n - 1) % shards`. Writes of different shards do not wait for each other (every database
+    has own write lock and own sync of the disk). IDs of new books are given by the counter of the process, so they
+    grow like IDs of one table; if another process has taken the ID, the counter is moved after the last IDs of shards
+    and the book is created again. Lists, searches and statistics are queried on all shards at once in the thread
+    pool and merged in the requested order, so every shard returns at most `limit` books. Batches are written by one
+    transaction per shard, so they are atomic only inside of a shard.
+    """
+
+    backend = "sqlite-sharded"
+
+    def __init__(self,
+                 directory: str,
+                 shards: int,
+                 pool_size: int = 4,
+                 pragmas: Optional[Dict[str, str]] = None,
+                 slow_query_threshold: float = 0.0):
+        if shards < 1:
+            raise ValueError(f"Number of shards should be positive, but was {shards}")
+        os.makedirs(directory, exist_ok=True)
+        self.shards = [SQLiteShardStorage(os.path.join(directory, f"books-{shard}.db"), shard, shards, pool_size,
+                                          pragmas, slow_query_threshold)
+                       for shard in range(shards)]
+        self.full_text_search = all(shard.full_text_search for shard in self.shards)
+        # Every caller thread can wait for all shards at once.
+        self.executor = ThreadPoolExecutor(max_workers=shards * pool_size, thread_name_prefix="shard")
+        self.id_lock = threading.Lock()
+        self.last_id = 0
+        self.sync_last_id()
+
+    def close(self) -> None:
+        """Close all connections to all shards."""
+
+        self.executor.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
+
+    def shard_of(self, book_id: int) -> SQLiteShardStorage:
+        return self.shards[(book_id - 1) % len(self.shards)]
+
+    def sync_last_id(self) -> None:
+        """Move the counter of IDs after the last IDs of all shards (they could be taken by other processes)."""
+        last_id = max(self.scatter(SQLiteShardStorage.read_last_id))
+        with self.id_lock:
+            self.last_id = max(self.last_id, last_id)
+
+    def take_ids(self, count: int) -> List[int]:
+        with self.id_lock:
+            first_id = self.last_id + 1
+            self.last_id += count
+        return list(range(first_id, first_id + count))
+
+    def scatter(self, function: Callable, *args, shards: Optional[List[SQLiteShardStorage]] = None) -> List[Any]:
+        """
+        Call function with every shard (or given shards) in the thread pool. Return results in order of shards.
+        Function of the only shard is called in the current thread.
+        """
+        shards = self.shards if shards is None else shards
+        if len(shards) == 1:
+            return [function(shards[0], *args)]
+        deadline = current_deadline()  # Of the request: threads of shards stop their queries after it too.
+        futures = [self.executor.submit(call_with_deadline, deadline, function, shard, *args) for shard in shards]
+        return [future.result() for future in futures]
+
+    def split_by_shards(self, book_ids: List[int]) -> Dict[SQLiteShardStorage, List[int]]:
+        """Positions of IDs of every shard that has any of IDs."""
+        positions: Dict[SQLiteShardStorage, List[int]] = {}
+        for position, book_id in enumerate(book_ids):
+            positions.setdefault(self.shard_of(book_id), []).append(position)
+        return positions
+
+    @property
+    def version(self) -> int:
+        """Version of the data: changed after every write to any shard."""
+
+        return sum(shard.version for shard in self.shards)
+
+    def statement_cache_stats(self) -> Dict[str, float]:
+        """Hits and misses of prepared statements cache of all shards."""
+
+        hits = sum(shard.pool.statement_stats.hits for shard in self.shards)
+        misses = sum(shard.pool.statement_stats.misses for shard in self.shards)
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+    def select_books(self,
+                     author: Optional[str],
+                     title: Optional[str],
+                     published_date_from: Optional[date],
+                     published_date_to: Optional[date],
+                     limit: Optional[int],
+                     after_id: Optional[int],
+                     order_by: BookOrder) -> Query:
+        """Query of the page for every shard: order value of the cursor is read only from the shard of its book."""
+        after = None
+        if after_id is not None:
+            with self.shard_of(after_id).pool.reader() as connection:
+                after = SQLiteBookStorage.find_order_value(connection, order_by, after_id), after_id
+        return BookQueryBuilder.select_books(author, title, published_date_from, published_date_to, limit, after,
+                                             order_by.value)
+
+    @staticmethod
+    def fetch_records(shard: SQLiteShardStorage, query: Query) -> List[BookRecord]:
+        with shard.pool.reader() as connection:
+            return connection.execute(*query).fetchall()
+
+    @staticmethod
+    def iterate_shard_records(shard: SQLiteShardStorage, query: Query, batch_size: int) -> Iterator[BookRecord]:
+        with shard.pool.stream_reader() as connection:
+            cursor = connection.execute(*query)
+            while True:
+                book_record_list = cursor.fetchmany(batch_size)
+                if not book_record_list:
+                    break
+                yield from book_record_list
+            cursor.close()
+
+    def list(self,
+             author: Optional[str] = None,
+             title: Optional[str] = None,
+             published_date_from: Optional[date] = None,
+             published_date_to: Optional[date] = None,
+             limit: Optional[int] = None,
+             after_id: Optional[int] = None,
+             order_by: BookOrder = BookOrder.id) -> List[Book]:
+        """Provide list of saved books. Return at most `limit` books that follow the book `after_id`."""
+
+        result = []
+        invalid_ids = []
+        for book_record in self.list_records(author, title, published_date_from, published_date_to, limit, after_id,
+                                             order_by):
+            try:
+                result.append(SQLiteBookStorage.read_book(BOOK_FIELDS, book_record))
+            except ValidationError:
+                invalid_ids.append(book_record[0])
+        for book_id in invalid_ids:
+            self.remove(book_id)
+        return result
+
+    def list_records(self,
+                     author: Optional[str] = None,
+                     title: Optional[str] = None,
+                     published_date_from: Optional[date] = None,
+                     published_date_to: Optional[date] = None,
+                     limit: Optional[int] = None,
+                     after_id: Optional[int] = None,
+                     order_by: BookOrder = BookOrder.id) -> List[BookRecord]:
+        """The same as `list()`, but return rows as they are saved. Pages of all shards are merged."""
+
+        order_by = BookOrder(order_by)
+        query = self.select_books(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+        book_record_lists = self.scatter(ShardedSQLiteBookStorage.fetch_records, query)
+        return list(islice(heapq.merge(*book_record_lists, key=order_key(order_by)), limit))
+
+    def iterate(self,
+                author: Optional[str] = None,
+                title: Optional[str] = None,
+                published_date_from: Optional[date] = None,
+                published_date_to: Optional[date] = None,
+                limit: Optional[int] = None,
+                after_id: Optional[int] = None,
+                order_by: BookOrder = BookOrder.id,
+                batch_size: int = 1000) -> Iterator[Book]:
+        """Iterate over saved books of all shards in the requested order."""
+
+        for book_record in self.iterate_records(author, title, published_date_from, published_date_to, limit,
+                                                after_id, order_by, batch_size):
+            try:
+                yield SQLiteBookStorage.read_book(BOOK_FIELDS, book_record)
+            except ValidationError:
+                continue  # Incorrect records are removed by list().
+
+    def iterate_records(self,
+                        author: Optional[str] = None,
+                        title: Optional[str] = None,
+                        published_date_from: Optional[date] = None,
+                        published_date_to: Optional[date] = None,
+                        limit: Optional[int] = None,
+                        after_id: Optional[int] = None,
+                        order_by: BookOrder = BookOrder.id,
+                        batch_size: int = 1000) -> Iterator[BookRecord]:
+        """The same as `iterate()`, but return rows as they are saved. Cursors of all shards are merged lazily."""
+
+        order_by = BookOrder(order_by)
+        query = self.select_books(author, title, published_date_from, published_date_to, limit, after_id, order_by)
+        iterators = [ShardedSQLiteBookStorage.iterate_shard_records(shard, query, batch_size) for shard in self.shards]
+        yield from islice(heapq.merge(*iterators, key=order_key(order_by)), limit)
+
+    def search(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[Book]:
+        """
+        Find books that contain all words of the query (as prefixes) in author or title. Best matches are first.
+        Ranks are computed by every shard, so they are approximate: statistics of words differ between shards.
+        """
+
+        return [SQLiteBookStorage.read_book(BOOK_FIELDS, book_record)
+                for book_record in self.search_records(query, limit, offset)]
+
+    @staticmethod
+    def search_shard(shard: SQLiteShardStorage, words: List[str], limit: Optional[int]) -> List[Tuple]:
+        """Ranked records of the shard: rank is the first column (all ranks are the same without FTS5)."""
+        with shard.pool.reader() as connection:
+            if shard.full_text_search:
+                return connection.execute(*BookQueryBuilder.search_books(words, limit, 0, with_rank=True)).fetchall()
+            book_record_list = connection.execute(*BookQueryBuilder.search_books_by_like(words, limit, 0)).fetchall()
+            return [(0.0,) + tuple(book_record) for book_record in book_record_list]
+
+    def search_records(self, query: str, limit: Optional[int] = None, offset: int = 0) -> List[BookRecord]:
+        """The same as `search()`, but return rows as they are saved."""
+
+        words = tokenize(query)
+        if not words:
+            return []
+        shard_limit = None if limit is None else offset + limit  # Offset is applied only after merge.
+        ranked_record_lists = self.scatter(ShardedSQLiteBookStorage.search_shard, words, shard_limit)
+        ranked_records = heapq.merge(*ranked_record_lists, key=itemgetter(0, 1))  # By rank, then by ID.
+        return [ranked_record[1:] for ranked_record in islice(ranked_records, offset, shard_limit)]
+
+    def count_groups(self,
+                     facet: BookFacet,
+                     author: Optional[str] = None,
+                     title: Optional[str] = None,
+                     published_date_from: Optional[date] = None,
+                     published_date_to: Optional[date] = None,
+                     limit: Optional[int] = None) -> List[Tuple[Optional[str], int]]:
+        """Count filtered books by groups of the facet in all shards and sum counts of the same groups."""
+
+        facet = BookFacet(facet)
+        counts: Dict[Optional[str], int] = {}
+        for groups in self.scatter(SQLiteShardStorage.count_groups, facet, author, title, published_date_from,
+                                   published_date_to):  # Groups of the limit can be split between shards.
+            for value, count in groups:
+                counts[value] = counts.get(value, 0) + count
+        return sorted(counts.items(), key=facet.sort_key)[:limit]
+
+    def parse_change_cursor(self, since: ChangeCursor) -> List[int]:
+        """Numbers of the last read changes of every shard. Cursor `0` is the start of all shards."""
+        if since == 0 or since == "0":
+            return [0] * len(self.shards)
+        seqs = str(since).split(".")
+        if len(seqs) != len(self.shards) or not all(seq.isdigit() for seq in seqs):  # Cursor of another storage.
+            raise BookChangesCompactedException(since, 0)
+        return [int(seq) for seq in seqs]
+
+    @staticmethod
+    def shard_changes(shard: SQLiteShardStorage, seqs: List[int], limit: Optional[int]) -> List[Tuple]:
+        return [(seq, shard.shard, book_id, record) for seq, book_id, record in shard.changes(seqs[shard.shard], limit)]
+
+    def changes(self, since: ChangeCursor = 0, limit: Optional[int] = None) -> List[BookChange]:
+        """
+        The last changes of books after the cursor `since` from all shards. Every shard counts own changes, so the
+        cursor is numbers of the last read changes of all shards joined by dots, like "12.0.7", and every change has
+        the cursor after it instead of the number. Changes of every shard are in order of their numbers.
+        """
+
+        seqs = self.parse_change_cursor(since)
+        try:
+            change_lists = self.scatter(ShardedSQLiteBookStorage.shard_changes, seqs, limit)
+        except BookChangesCompactedException:
+            raise BookChangesCompactedException(since, 0)
+        result = []
+        for seq, shard, book_id, record in islice(heapq.merge(*change_lists, key=itemgetter(0, 1)), limit):
+            seqs[shard] = seq
+            result.append((".".join(map(str, seqs)), book_id, record))
+        return result
+
+    def find(self, book_id: int) -> Book:
+        """Find book in its shard."""
+
+        return self.shard_of(book_id).find(book_id)
+
+    def find_versioned(self, book_id: int) -> Tuple[Book, int]:
+        """Find book and its version in its shard."""
+
+        return self.shard_of(book_id).find_versioned(book_id)
+
+    def create(self, book: BookUpdate) -> Book:
+        """Create book with the next ID in the shard of the ID."""
+
+        return self.create_many([book])[0]
+
+    def create_many(self, books: List[BookUpdate]) -> List[Book]:
+        """Create books with the next IDs by one transaction per shard, in parallel."""
+
+        created: List[Optional[Book]] = [None] * len(books)
+        positions = list(range(len(books)))
+        while positions:
+            book_dicts = [dict(books[position].dict(), id=book_id)
+                          for position, book_id in zip(positions, self.take_ids(len(positions)))]
+            shard_positions = self.split_by_shards([book_dict["id"] for book_dict in book_dicts])
+
+            def create_in_shard(shard: SQLiteShardStorage) -> Optional[List[Book]]:
+                try:
+                    return shard.create_with_ids([book_dicts[i] for i in shard_positions[shard]])
+                except ShardIdConflictException:
+                    return None
+
+            conflicts = []
+            for indexes, shard_books in zip(shard_positions.values(),
+                                            self.scatter(create_in_shard, shards=list(shard_positions))):
+                if shard_books is None:  # Create books of this shard again with new IDs.
+                    conflicts += [positions[i] for i in indexes]
+                    continue
+                for i, book in zip(indexes, shard_books):
+                    created[positions[i]] = book
+            if conflicts:
+                self.sync_last_id()
+            positions = sorted(conflicts)
+        return created
+
+    def scatter_items(self, book_ids: List[int], items: List[Any], method: Callable) -> List[Optional[Book]]:
+        """Call method of every shard with items of its IDs, in parallel. Return results in order of items."""
+        positions = self.split_by_shards(book_ids)
+        results = self.scatter(lambda shard: method(shard, [items[i] for i in positions[shard]]),
+                               shards=list(positions))
+        books: List[Optional[Book]] = [None] * len(items)
+        for shard_positions, shard_books in zip(positions.values(), results):
+            for position, book in zip(shard_positions, shard_books):
+                books[position] = book
+        return books
+
+    def update_many(self, updates: List[Book]) -> List[Optional[Book]]:
+        """Update books by one transaction per shard, in parallel. Return None for not found books."""
+
+        if not updates:
+            return []
+        return self.scatter_items([update.id for update in updates], updates, SQLiteShardStorage.update_many)
+
+    def remove_many(self, book_ids: List[int]) -> List[Optional[Book]]:
+        """Remove books by one transaction per shard, in parallel. Return removed books or None for not found books."""
+
+        if not book_ids:
+            return []
+        return self.scatter_items(book_ids, book_ids, SQLiteShardStorage.remove_many)
+
+    def remove(self, book_id: int) -> None:
+        """Remove book from its shard."""
+
+        self.shard_of(book_id).remove(book_id)
+
+    def update_fields(self,
+                      book_id: int,
+                      fields: Dict[str, Any],
+                      expected_version: Optional[int] = None) -> Tuple[Book, int]:
+        """Set given fields of the book in its shard, if the book has expected version."""
+
+        return self.shard_of(book_id).update_fields(book_id, fields, expected_version)
+
+    def delete_returning(self, book_id: int, expected_version: Optional[int] = None) -> Book:
+        """Remove book from its shard, if it has expected version. Return removed book."""
+
+        return self.shard_of(book_id).delete_returning(book_id, expected_version)
+
+    def persist(self, book: Book) -> None:
+        """Update book in its shard."""
+
+        self.shard_of(book.id).persist(book)
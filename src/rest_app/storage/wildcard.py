@@ -0,0 +1,42 @@
+from typing import Callable, Optional
+
+import functools
+import re
+
+WILDCARDS = re.compile(r"([?*])")
+
+
+def literal_prefix(pattern: Optional[str]) -> Optional[str]:
+    """Beginning of the pattern before the first wildcard."""
+    if pattern is None:
+        return None
+    return WILDCARDS.split(pattern, maxsplit=1)[0] or None
+
+
+def translate(pattern: str) -> str:
+    """Regular expression of the pattern: '?' is zero or one symbol, '*' is any symbols, other symbols are literal."""
+    parts = []
+    for part in WILDCARDS.split(pattern):
+        if part == "?":
+            parts.append(".?")
+        elif part == "*":
+            parts.append(".*")
+        else:
+            parts.append(re.escape(part))
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=1024)
+def wildcard_matcher(pattern: str) -> Callable[[str], bool]:
+    """
+    Function that checks that the beginning of the value matches the pattern (the end of the value is not checked).
+    Patterns without wildcards or with only leading '*' are checked by string methods, others by compiled regular
+    expression. Matchers are cached, because the same filters are repeated by pages of the list.
+    """
+    pattern = pattern.rstrip("*")  # The end is not checked: trailing '*' matches anything.
+    middle = pattern.lstrip("*")
+    if "?" in pattern or "*" in middle:
+        return re.compile(translate(pattern), re.DOTALL).match
+    if middle != pattern:
+        return lambda value: middle in value
+    return lambda value: value.startswith(pattern)
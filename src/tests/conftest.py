@@ -2,35 +2,30 @@ import pytest
 
 from _pytest.fixtures import SubRequest
 from fastapi.testclient import TestClient
-from types import ModuleType
+from contextlib import ExitStack
+from typing import Dict, Iterator
 
 
-storages = ["sqlite:data/book_storage.db.test", "memory"]
+storages = ["sqlite:data/book_storage.db.test", "sqlite-sharded:data/book_storage.db.test-shards:3", "memory",
+            "memory?compact=1"]
 
+# Started clients by storage type: application of every storage is created and started once for all tests.
+clients: Dict[str, TestClient] = {}
 
-def update_env_var(name: str, value: str) -> None:
-    """Define environment variable."""
-    import os
-    os.environ[name] = value
 
-
-def reload_module(module_name: str) -> ModuleType:
-    """
-    That method load module at first time and reload it after.
-    Useful for reinitialize module with different system variables.
-    """
-    import sys
-    import importlib
-    if module_name not in sys.modules:
-        return importlib.import_module(module_name)
-    else:
-        module = importlib.import_module(module_name)
-        return importlib.reload(module)
+@pytest.fixture(scope="session")
+def started_apps() -> Iterator[ExitStack]:
+    """Stop applications that were started by tests at the end of the session (shutdown closes storages)."""
+    with ExitStack() as stack:
+        stack.callback(clients.clear)
+        yield stack
 
 
 @pytest.fixture
-def client(request: SubRequest) -> TestClient:
-    """Change system variable base of parameter from tests and reload module to reinitialize it."""
-    update_env_var("storage_type", request.param)
-    module = reload_module("rest_app.rest")
-    return TestClient(getattr(module, "app"))
+def client(request: SubRequest, started_apps: ExitStack) -> TestClient:
+    """Client of the application with storage from the parameter of the test. Tests should not expect empty storage."""
+    if request.param not in clients:
+        from rest_app.rest import Settings, create_app
+        setting = Settings(storage_type=request.param, preload_static_assets=False)  # Only a few tests need assets.
+        clients[request.param] = started_apps.enter_context(TestClient(create_app(setting)))
+    return clients[request.param]
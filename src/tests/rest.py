@@ -176,6 +176,48 @@ def test_book_update_not_found(client: TestClient):
     check_not_found_response(response, non_exists_book_id)
 
 
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_patch(client: TestClient):
+    book = create_book(client, {"author": "John Doe", "title": "Awesome Novel", "published_date": "2000-01-01"})
+
+    response = client.patch(f"/book/{book['id']}", json={"title": "Awesome Novel #2", "published_date": None})
+
+    assert response.status_code == 200
+    assert response.json() == {"id": book["id"], "author": "John Doe", "title": "Awesome Novel #2",
+                               "published_date": None}
+    assert response.json() in book_list(client)
+
+    check_not_found_response(client.patch(f"/book/{book['id'] + 1}", json={}), book["id"] + 1)
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_if_match(client: TestClient):
+    book = create_test_book(client)
+
+    response = client.get(f"/book/{book['id']}")
+    assert response.status_code == 200
+    assert response.json() == book
+    etag = response.headers["ETag"]
+
+    response = client.patch(f"/book/{book['id']}", json={"title": "Awesome Novel #2"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    new_etag = response.headers["ETag"]
+    assert new_etag != etag
+
+    # The book was changed after the first read: change and delete by old version are rejected.
+    response = client.put(f"/book/{book['id']}", json={"title": "Awesome Novel #3"}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert response.headers["ETag"] == new_etag
+    assert client.delete(f"/book/{book['id']}", headers={"If-Match": etag}).status_code == 412
+    assert client.delete(f"/book/{book['id']}", headers={"If-Match": '"0-1"'}).status_code == 412
+    assert client.get(f"/book/{book['id']}").json()["title"] == "Awesome Novel #2"
+
+    response = client.delete(f"/book/{book['id']}", headers={"If-Match": new_etag})
+    assert response.status_code == 200
+    assert response.json()["title"] == "Awesome Novel #2"
+    check_not_found_response(client.get(f"/book/{book['id']}"), book["id"])
+
+
 @pytest.mark.parametrize("client", storages, indirect=True)
 def test_book_delete_one(client: TestClient):
     book = create_test_book(client)
@@ -195,3 +237,447 @@ def test_book_delete_not_found(client: TestClient):
     response = client.delete(f"/book/{non_exists_book_id}")
 
     check_not_found_response(response, non_exists_book_id)
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_stats(client: TestClient):
+    delete_all_books(client)
+    books = create_test_book_list(client)
+    create_book(client, {"author": "Jack Daniel", "title": "Untitled"})
+
+    def stats(args: Dict) -> List[Dict]:
+        import urllib.parse
+        response = client.get("/book/stats?" + urllib.parse.urlencode(args))
+        assert response.status_code == 200
+        return [(group["value"], group["count"]) for group in response.json()]
+
+    assert stats({"group_by": "author"}) == [("Jack Daniel", 2), ("John Doe", 2)]
+    assert stats({"group_by": "author", "limit": 1}) == [("Jack Daniel", 2)]
+    assert stats({"group_by": "year"}) == [(None, 1), ("1980", 1), ("1981", 1), ("1982", 1)]
+    assert stats({"group_by": "month", "title": "*Story"}) == [("1981-04", 1), ("1982-06", 1)]
+    assert stats({"group_by": "author", "published_date_from": "1980-06-01"}) == [("Jack Daniel", 1), ("John Doe", 1)]
+
+    # Counters follow changes of books.
+    client.patch(f"/book/{books[0]['id']}", json={"author": "Jack Daniel", "published_date": "1981-01-01"})
+    client.delete(f"/book/{books[1]['id']}")
+    assert stats({"group_by": "author"}) == [("Jack Daniel", 3)]
+    assert stats({"group_by": "year"}) == [(None, 1), ("1981", 1), ("1982", 1)]
+    assert client.get("/book/stats?group_by=title").status_code == 422
+
+
+def book_pages(client: TestClient, args: Dict) -> List[List[Dict]]:
+    import urllib.parse
+    pages = []
+    while True:
+        response = client.get("/book/list?" + urllib.parse.urlencode(args))
+        assert response.status_code == 200
+        pages.append(response.json())
+        if "X-Next-Cursor" not in response.headers:
+            return pages
+        args = dict(args, after_id=response.headers["X-Next-Cursor"])
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_list_pagination(client: TestClient):
+    delete_all_books(client)
+    books = create_test_book_list(client) + create_test_book_list(client)
+
+    pages = book_pages(client, {"limit": 4})
+    assert [len(page) for page in pages] == [4, 2]
+    assert sum(pages, []) == books
+
+    pages = book_pages(client, {"limit": 2, "order_by": "title", "published_date_from": "1980-06-15"})
+    assert [len(page) for page in pages] == [2, 2]
+    assert [book["title"] for book in sum(pages, [])] == ["Awesome Story", "Awesome Story",
+                                                           "Tricky Story", "Tricky Story"]
+
+    pages = book_pages(client, {"limit": 3, "order_by": "published_date"})
+    assert [book["published_date"] for book in sum(pages, [])] == sorted([book["published_date"] for book in books])
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_list_wrong_page_parameters(client: TestClient):
+    assert client.get("/book/list?limit=0").status_code == 422
+    assert client.get("/book/list?order_by=unknown").status_code == 422
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_export(client: TestClient):
+    delete_all_books(client)
+    books = create_test_book_list(client)
+
+    response = client.get("/book/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    import json
+    assert [json.loads(line) for line in response.text.splitlines()] == books
+
+    response = client.get("/book/export?format=json&author=John%20Doe")
+    assert response.status_code == 200
+    assert response.json() == books[:2]
+
+    response = client.get("/book/export?format=json&author=Nobody")
+    assert response.json() == []
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_list_ndjson(client: TestClient):
+    delete_all_books(client)
+    books = create_test_book_list(client)
+
+    response = client.get("/book/list?limit=2", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["X-Next-Cursor"] == str(books[1]["id"])
+    import json
+    assert [json.loads(line) for line in response.text.splitlines()] == books[:2]
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_bulk(client: TestClient):
+    delete_all_books(client)
+
+    books = [
+        {"author": "John Doe", "title": "Awesome Novel", "published_date": "1980-02-15"},
+        {"author": "John Doe", "title": "Tricky Story", "published_date": "1981-04-20"},
+        {"author": "Jack Daniel", "title": "Awesome Story", "published_date": "wrong date"}
+    ]
+    response = client.post("/book/bulk", json=books)
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["status"] for result in results] == [200, 200, 422]
+    created = [result["book"] for result in results[:2]]
+    assert book_list(client) == created
+
+    updates = [{"id": created[0]["id"], "title": "Awesome Novel #2"}, {"id": created[1]["id"] + 100}]
+    response = client.put("/book/bulk", json=updates)
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["status"] for result in results] == [200, 404]
+    assert results[0]["book"] == dict(created[0], title="Awesome Novel #2")
+
+    response = client.request("DELETE", "/book/bulk", json=[created[1]["id"], created[1]["id"] + 100])
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["status"] for result in results] == [200, 404]
+    assert results[0]["book"] == created[1]
+    assert book_list(client) == [dict(created[0], title="Awesome Novel #2")]
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_bulk_ndjson(client: TestClient):
+    delete_all_books(client)
+
+    import json
+    body = "\n".join([json.dumps({"author": "John Doe", "title": f"Novel #{i}"}) for i in range(5)])
+    response = client.post("/book/bulk", data=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert [result["book"] for result in response.json()] == book_list(client)
+
+    response = client.post("/book/bulk", data="{", headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_list_cache(client: TestClient):
+    delete_all_books(client)
+    create_test_book_list(client)
+
+    stats = client.get("/cache/stats").json()
+    response = client.get("/book/list?author=John%20Doe")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get("/book/list?author=John%20Doe")
+    assert response.headers["ETag"] == etag
+    assert client.get("/cache/stats").json()["hits"] == stats["hits"] + 1
+
+    response = client.get("/book/list?author=John%20Doe", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # Any change of the storage invalidates the cache.
+    book = create_test_book(client)
+    response = client.get("/book/list?author=John%20Doe", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert book in response.json()
+
+
+def book_search(client: TestClient, query: str) -> List[Dict]:
+    response = client.get("/book/search", params={"q": query})
+
+    assert response.status_code == 200
+
+    return response.json()
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_search(client: TestClient):
+    delete_all_books(client)
+    books = create_test_book_list(client)
+
+    assert sorted(book["id"] for book in book_search(client, "story")) == [books[1]["id"], books[2]["id"]]
+    assert book_search(client, "awesome stor") == [books[2]]
+    assert book_search(client, "jack") == [books[2]]
+    assert book_search(client, "doe novel") == [books[0]]
+    assert book_search(client, "\"unknown\" OR *") == []
+
+    # Index follows changes of books.
+    client.put(f"/book/{books[0]['id']}", json={"title": "Boring Novel"})
+    assert book_search(client, "boring") == [dict(books[0], title="Boring Novel")]
+    assert book_search(client, "awesome") == [books[2]]
+    client.delete(f"/book/{books[2]['id']}")
+    assert book_search(client, "awesome") == []
+
+    response = client.get("/book/search", params={"q": "john", "limit": 1, "offset": 1})
+    assert len(response.json()) == 1
+
+
+def metric_value(metrics: str, sample: str) -> float:
+    for line in metrics.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_metrics(client: TestClient):
+    delete_all_books(client)
+    book = create_test_book(client)
+    before = client.get("/metrics").text
+
+    client.get(f"/book/list?after_id={book['id'] - 1}")
+    client.delete(f"/book/{book['id']}")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    metrics = response.text
+    assert "# TYPE http_request_duration_seconds histogram" in metrics
+
+    # Requests are labeled by route template, not by path.
+    for sample in ['http_requests_total{method="GET",route="/book/list",status="200"}',
+                   'http_requests_total{method="DELETE",route="/book/{book_id}",status="200"}',
+                   'http_request_duration_seconds_count{method="GET",route="/book/list"}']:
+        assert metric_value(metrics, sample) == metric_value(before, sample) + 1
+
+    rows = ['storage_rows_returned_total{backend="%s",operation="list_records"}' % backend
+            for backend in ["sqlite", "sqlite-sharded", "memory"]]
+    assert sum(metric_value(metrics, row) for row in rows) == sum(metric_value(before, row) for row in rows) + 1
+
+
+def test_export_limit_below_pool_size(tmp_path):
+    from rest_app.rest import BookService, Settings
+    service = BookService(Settings(storage_type=f"sqlite:{tmp_path / 'books.db'}?pool_size=2"))
+    with pytest.raises(ValueError):
+        service.open()  # Default limit of exports is 2.
+    assert service.storage is None
+
+
+def test_metrics_of_applications():
+    from rest_app.rest import Settings, create_app
+    # Storages are not opened: the clients are not started.
+    first = TestClient(create_app(Settings(list_cache_size=10, preload_static_assets=False)))
+    second = TestClient(create_app(Settings(list_cache_size=20, preload_static_assets=False)))
+
+    # Every application exports gauges of its own cache and process-wide metrics.
+    for client, max_size in [(first, 10), (second, 20), (first, 10)]:
+        metrics = client.get("/metrics").text
+        assert metric_value(metrics, 'list_cache{stat="max_size"}') == max_size
+        assert "# TYPE http_requests_total counter" in metrics
+
+
+@pytest.mark.parametrize("client", ["memory"], indirect=True)
+def test_static_assets(client: TestClient):
+    import re
+    page = client.get("/")
+    assert page.status_code == 200
+    assert page.headers["Cache-Control"] == "no-cache"
+    urls = re.findall(r'src="(/js/jquery\.[0-9a-f]{16}\.js)"', page.text)
+    assert len(urls) == 1
+
+    plain = client.get(urls[0], headers={"Accept-Encoding": "identity"})
+    assert plain.status_code == 200
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert plain.content == client.get("/js/jquery.js", headers={"Accept-Encoding": "identity"}).content
+
+    compressed = client.get(urls[0], headers={"Accept-Encoding": "gzip, deflate"}, stream=True)
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert int(compressed.headers["Content-Length"]) < len(plain.content) / 2
+    assert compressed.headers["ETag"] != plain.headers["ETag"]
+    assert client.get(urls[0], headers={"Accept-Encoding": "gzip", "If-None-Match": compressed.headers["ETag"]}) \
+        .status_code == 304
+    assert client.get("/js/missing.js").status_code == 404
+
+
+@pytest.mark.parametrize("client", ["memory"], indirect=True)
+def test_api_gzip(client: TestClient):
+    delete_all_books(client)
+    for i in range(20):
+        create_book(client, {"author": "John Doe", "title": f"Awesome Novel #{i}", "published_date": "2000-01-01"})
+
+    response = client.get("/book/list", headers={"Accept-Encoding": "gzip"}, stream=True)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()) == 20
+
+    # Small responses are not compressed.
+    response = client.get("/book/list?limit=1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+@pytest.mark.parametrize("client", storages, indirect=True)
+def test_book_changes(client: TestClient):
+    response = client.get("/book/changes")
+    assert response.status_code == 200
+    since = response.json()["last_seq"]
+    while response.json()["changes"]:  # Skip changes of other tests.
+        response = client.get(f"/book/changes?since={since}")
+        since = response.json()["last_seq"]
+
+    first = create_book(client, {"author": "John Doe", "title": "Awesome Novel"})
+    second = create_book(client, {"author": "John Doe", "title": "Tricky Story"})
+    client.patch(f"/book/{first['id']}", json={"title": "Awesome Novel #2"})
+    client.delete(f"/book/{second['id']}")
+
+    response = client.get(f"/book/changes?since={since}")
+    assert response.status_code == 200
+    changes = response.json()["changes"]
+    # Only the last change of every book: the update of the first book and the tombstone of the second one. Changes
+    # of different shards are not ordered by time.
+    book_changes = {change["id"]: change for change in changes}
+    assert [(book_id, change["deleted"]) for book_id, change in sorted(book_changes.items())] == \
+           [(first["id"], False), (second["id"], True)]
+    assert book_changes[first["id"]]["book"] == dict(first, title="Awesome Novel #2")
+    assert book_changes[second["id"]]["book"] is None
+    assert changes[1]["seq"] == response.json()["last_seq"]
+
+    response = client.get(f"/book/changes?since={changes[0]['seq']}&limit=1")
+    assert [change["id"] for change in response.json()["changes"]] == [changes[1]["id"]]
+
+    # Long polling returns empty list after the timeout.
+    last_seq = changes[1]["seq"]
+    response = client.get(f"/book/changes?since={last_seq}&wait=0.2")
+    assert response.json() == {"last_seq": last_seq, "changes": []}
+    assert client.get(f"/book/changes?since={last_seq}0000").status_code == 410  # Unknown changes.
+    assert client.get("/book/changes?since=1.x").status_code == 422
+
+    response = client.get("/book/changes/stream?timeout=0.1", headers={"Last-Event-ID": str(changes[0]["seq"])})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    assert response.text.startswith(f"id: {last_seq}\nevent: change\ndata: ")
+
+
+def test_admission_control():
+    import asyncio
+    from rest_app.admission import AdmissionMiddleware, route_limiters
+    from rest_app.metrics import ADMISSION_REJECTED
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    async def slow(_request):
+        await released.wait()
+        return PlainTextResponse("done")
+
+    async def endless(_request):
+        await asyncio.sleep(10)
+
+    released: Optional[asyncio.Event] = None
+    routes = [Route("/slow", slow), Route("/endless", endless)]
+    limiters = route_limiters({"/slow": 1, "/endless": 1}, queue_size=1)
+    app = AdmissionMiddleware(Starlette(routes=routes), routes, limiters, deadline=0.5, status_code=429, retry_after=2)
+
+    async def get(path: str):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": path, "root_path": "", "query_string": b"", "headers": []}
+        await app(scope, receive, send)
+        return messages[0]["status"], dict(messages[0]["headers"])
+
+    async def check():
+        nonlocal released
+        released = asyncio.Event()  # Created inside of the loop: Python 3.6 binds it to the current loop.
+        first = asyncio.ensure_future(get("/slow"))
+        await asyncio.sleep(0.01)
+        queued = asyncio.ensure_future(get("/slow"))
+        await asyncio.sleep(0.01)
+        assert limiters["/slow"].stats() == {"active": 1, "queued": 1}
+        assert await get("/slow") == (429, {b"retry-after": b"2", b"content-length": b"48",
+                                            b"content-type": b"application/json"})
+        released.set()
+        assert [(await request)[0] for request in [first, queued]] == [200, 200]
+        assert limiters["/slow"].stats() == {"active": 0, "queued": 0}
+
+        # Handler is cancelled after the deadline and its slot is released.
+        assert (await get("/endless"))[0] == 429
+        assert limiters["/endless"].stats() == {"active": 0, "queued": 0}
+
+    rejected = dict(ADMISSION_REJECTED.values)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check())
+    finally:
+        loop.close()
+    for labels in [("/slow", "queue_full"), ("/endless", "deadline")]:
+        assert ADMISSION_REJECTED.values[labels] == rejected.get(labels, 0) + 1
+
+
+def test_admission_deadline_interrupts_query(tmp_path):
+    import asyncio
+    import time
+    from rest_app.admission import AdmissionMiddleware, route_limiters
+    from rest_app.deadline import RequestDeadlineException
+    from rest_app.storage.asynchronous import ExecutorBookStorage
+    from rest_app.storage.sqlite import SQLiteBookStorage
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route, Router
+
+    storage = ExecutorBookStorage(SQLiteBookStorage(str(tmp_path / "books.db"), pool_size=1), max_workers=1)
+    errors = []
+
+    def long_query():  # About 10 seconds without the deadline.
+        try:
+            with storage.storage.pool.reader() as connection:
+                connection.execute("WITH RECURSIVE numbers(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM numbers "
+                                   "LIMIT 50000000) SELECT COUNT(*) FROM numbers;").fetchone()
+        except RequestDeadlineException as e:
+            errors.append(e)
+            raise
+
+    async def scan(_request):
+        await storage.run(long_query)
+        return PlainTextResponse("done")
+
+    routes = [Route("/scan", scan)]
+    # Router without error middleware, like inner middlewares of the application see it.
+    app = AdmissionMiddleware(Router(routes=routes), routes, route_limiters({"/scan": 1}, 1), deadline=0.2)
+
+    async def check():
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        start = time.perf_counter()
+        scope = {"type": "http", "method": "GET", "path": "/scan", "root_path": "", "query_string": b"", "headers": []}
+        await app(scope, receive, send)
+        assert messages[0]["status"] == 503
+        await storage.run(time.perf_counter)  # The only thread of the storage is free again.
+        return time.perf_counter() - start
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(check()) < 2
+        assert len(errors) == 1
+    finally:
+        loop.close()
+        storage.close()
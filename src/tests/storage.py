@@ -0,0 +1,556 @@
+from rest_app import get_storage, parse_storage_type
+from rest_app import encoding
+from rest_app.domain import Book, BookFacet, BookOrder, BookUpdate, BookChangesCompactedException, \
+    BookNotFoundException, BookVersionConflictException, StorageBusyException, parse_iso_date
+from rest_app.storage.memory import MemoryBookStorage, PersistentMemoryBookStorage
+from rest_app.storage.memory_persistence import WriteLog
+from rest_app.storage.sqlite import SQLiteBookStorage
+from rest_app.storage.sqlite_query import BookQueryBuilder
+from rest_app.storage.sqlite_sharded import ShardedSQLiteBookStorage
+from rest_app.storage.wildcard import literal_prefix, wildcard_matcher
+
+from datetime import date
+
+import asyncio
+import json
+import logging
+import pytest
+import re
+import threading
+
+
+def test_parse_storage_type():
+    assert parse_storage_type("memory") == (["memory"], {})
+    assert parse_storage_type("sqlite:data/books.db?pool_size=2&synchronous=FULL") == \
+        (["sqlite", "data/books.db"], {"pool_size": "2", "synchronous": "FULL"})
+
+
+def test_sqlite_pool_options(tmp_path):
+    storage = get_storage(f"sqlite:{tmp_path / 'books.db'}?pool_size=2&synchronous=FULL")
+    try:
+        assert isinstance(storage.storage, SQLiteBookStorage)
+        assert storage.storage.pool.size == 2
+        with storage.storage.pool.reader() as connection:
+            assert connection.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+            assert connection.execute("PRAGMA synchronous;").fetchone()[0] == 2  # FULL
+    finally:
+        storage.close()
+
+
+def test_sqlite_pool_reuse_connections(tmp_path):
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"), pool_size=1)
+    try:
+        with storage.pool.reader() as first:
+            pass
+        book = storage.create(BookUpdate(author="John Doe", title="Awesome Novel", published_date="1980-02-15"))
+        assert storage.list() == [book]
+        with storage.pool.reader() as second:
+            assert first is second
+    finally:
+        storage.close()
+
+
+def test_sqlite_exports_do_not_take_pool(tmp_path):
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"), pool_size=1)
+    try:
+        storage.create_many([BookUpdate(author="John Doe", title=f"Title {i}", published_date="1980-02-15")
+                             for i in range(3)])
+        exports = [storage.iterate_records(batch_size=1), storage.iterate(batch_size=1)]
+        for export in exports:
+            next(export)  # Slow clients: their cursors stay open.
+        assert len(storage.list_records()) == 3
+
+        storage.pool.acquire_timeout = 0.1
+        with storage.pool.reader():
+            with pytest.raises(StorageBusyException):
+                storage.list_records()
+        for export in exports:
+            assert len(list(export)) == 2
+    finally:
+        storage.close()
+
+
+def test_sqlite_unsupported_pragma(tmp_path):
+    with pytest.raises(ValueError):
+        get_storage(f"sqlite:{tmp_path / 'books.db'}?locking_mode=EXCLUSIVE")
+    with pytest.raises(ValueError):
+        get_storage(f"sqlite:{tmp_path / 'books.db'}?synchronous=OFF;DROP")
+
+
+def test_sqlite_quotes_in_values(tmp_path):
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"))
+    try:
+        book = storage.create(BookUpdate(author='Robert "Bob" O\'Neil', title="100% \\ Pure_Story"))
+        assert storage.find(book.id) == book
+        assert storage.list(author='Robert "Bob" O\'Neil') == [book]
+        assert storage.list(title="100% \\ Pure_*") == [book]
+        assert storage.list(title="100_ *") == []  # LIKE symbols from user are not wildcards.
+    finally:
+        storage.close()
+
+
+def test_sqlite_statement_cache_hits(tmp_path):
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"), pool_size=1)
+    try:
+        for i in range(10):
+            storage.create(BookUpdate(author=f"Author {i}", title=f"Title {i}"))
+            storage.list(author=f"Author {i}", title=f"Title*{i}")
+        stats = storage.statement_cache_stats()
+        assert stats["misses"] <= 5  # Only different shapes of statements are prepared.
+        assert stats["hit_rate"] > 0.8
+    finally:
+        storage.close()
+
+
+def query_plan(storage: SQLiteBookStorage, **filters) -> str:
+    select_books, params = BookQueryBuilder.select_books(**filters)
+    with storage.pool.reader() as connection:
+        plan = connection.execute(f"EXPLAIN QUERY PLAN {select_books}", params).fetchall()
+    return " ".join([row[-1] for row in plan])
+
+
+def test_sqlite_list_use_indexes(tmp_path):
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"))
+    try:
+        assert "USING INDEX books_published_date" in query_plan(storage, published_date_from=date(1980, 1, 1))
+        assert "USING INDEX books_published_date" in query_plan(storage, published_date_to=date(1980, 1, 1))
+        assert "USING INDEX books_published_date" in query_plan(storage, published_date_from=date(1980, 1, 1),
+                                                                limit=10)
+        # Index provides the order, so pages are read without sorting.
+        date_page_plan = query_plan(storage, published_date_from=date(1980, 1, 1), order_by="published_date",
+                                    after=("1985-01-01", 10), limit=10)
+        assert "USING INDEX books_published_date" in date_page_plan
+        assert "ORDER BY" not in date_page_plan
+        for order_by in ["author", "title"]:
+            for after in [None, ("Doe", 10)]:
+                order_plan = query_plan(storage, order_by=order_by, after=after, limit=10)
+                assert f"USING INDEX books_order_{order_by}" in order_plan
+                assert "USE TEMP B-TREE FOR ORDER BY" not in order_plan
+        assert "USING INDEX books_order_author (<expr>>?)" in query_plan(storage, order_by="author",
+                                                                        after=("Doe", 10), limit=10)
+        assert "USING INDEX books_author" in query_plan(storage, author="John Doe")
+        assert "USING INDEX books_title" in query_plan(storage, title="Tolk*")
+        assert "SCAN" in query_plan(storage, title="*Story")  # No prefix: nothing to search in index.
+    finally:
+        storage.close()
+
+
+def test_sqlite_prefix_filter_is_case_insensitive(tmp_path):
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"))
+    try:
+        books = [storage.create(BookUpdate(author="J. R. R. Tolkien", title=title))
+                 for title in ["The Hobbit", "the hobbit, second edition", "The Silmarillion", "Theory"]]
+        assert storage.list(title="The H*") == books[:2]
+        assert storage.list(title="THE ?obbit*") == books[:2]
+        assert storage.list(title="The Hobbit") == books[:1]
+        assert storage.list(author="j. r. r. tolkien") == []  # Exact match is case-sensitive.
+    finally:
+        storage.close()
+
+
+def test_memory_indexes():
+    storage = MemoryBookStorage()
+    books = [storage.create(BookUpdate(author=f"Author {i % 7}", title=f"Title {i}",
+                                       published_date=date(1900 + i, 1, 1))) for i in range(100)]
+    storage.remove(books[50].id)
+    books[10].title = "Renamed"
+    storage.persist(books[10])
+
+    # Search by index reads only candidates of the most selective filter.
+    assert len(storage.candidates(None, "Title 1*", date(1950, 1, 1), None)) == 10
+    assert storage.candidates(None, "*1", None, None) is None
+
+    assert storage.list(published_date_from=date(1948, 6, 1), published_date_to=date(1952, 6, 1)) == \
+        [books[49], books[51], books[52]]
+    assert storage.list(title="Title 1?") == [books[1]] + books[11:20]
+    assert storage.list(title="Ren*") == [books[10]]
+    assert storage.list(author="Author 3", published_date_to=date(1930, 1, 1)) == [books[3], books[10], books[17],
+                                                                                    books[24]]
+    assert storage.list(limit=3, after_id=books[48].id) == [books[49], books[51], books[52]]
+
+
+def test_async_storage_runs_sqlite_in_executor(tmp_path):
+    storage = get_storage(f"sqlite:{tmp_path / 'books.db'}?pool_size=2")
+
+    async def check():
+        book = await storage.create(BookUpdate(author="John Doe", title="Awesome Novel"))
+        threads = await asyncio.gather(*[storage.run(threading.current_thread) for _ in range(4)])
+        assert threading.main_thread() not in threads
+        found = await asyncio.gather(*[storage.find(book.id) for _ in range(10)])
+        assert found == [book] * 10
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check())
+    finally:
+        loop.close()
+        storage.close()
+
+
+def test_sqlite_group_commit(tmp_path):
+    storage = get_storage(f"sqlite:{tmp_path / 'books.db'}?group_commit=8")
+
+    async def check():
+        books = await asyncio.gather(*[storage.create(BookUpdate(author=f"Author {i}")) for i in range(20)])
+        assert sorted(book.id for book in books) == list(range(1, 21))
+
+        results = await asyncio.gather(storage.update_fields(1, {"title": "Awesome Novel"}),
+                                       storage.update_fields(100, {"title": "Missing"}),
+                                       storage.delete_returning(2),
+                                       return_exceptions=True)
+        assert results[0][0].title == "Awesome Novel"
+        assert isinstance(results[1], BookNotFoundException)  # Error is returned only to own caller.
+        assert results[2].id == 2
+        with pytest.raises(BookNotFoundException):
+            await storage.find(2)
+        assert (await storage.find(3)).author == "Author 2"
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check())
+        stats = storage.group_commit_stats()
+        assert stats["writes"] == 23
+        assert 1 < stats["max_batch_size"] <= 8
+        assert stats["batches"] < stats["writes"]
+    finally:
+        loop.close()
+        storage.close()
+
+
+def test_sqlite_group_commit_task(tmp_path):
+    storage = get_storage(f"sqlite:{tmp_path / 'books.db'}?group_commit=8&group_commit_delay=10")
+
+    async def failed_commit():
+        raise RuntimeError("Commit loop failed")
+
+    async def check():
+        # Error of the task is returned to waiting writes.
+        commit_pending, storage.commit_pending = storage.commit_pending, failed_commit
+        with pytest.raises(RuntimeError):
+            await storage.create(BookUpdate(author="John Doe"))
+        storage.commit_pending = commit_pending
+
+        # Writes that wait for the delay are cancelled by close.
+        write = asyncio.ensure_future(storage.create(BookUpdate(author="John Doe")))
+        await asyncio.sleep(0.01)
+        assert not storage.commit_task.done()
+        storage.close()
+        with pytest.raises(asyncio.CancelledError):
+            await write
+        assert storage.commit_task.cancelled()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(check())
+    finally:
+        loop.close()
+        storage.close()
+
+
+def test_sqlite_slow_query_log(tmp_path, caplog):
+    # Every statement is slow.
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"), pool_size=1, slow_query_threshold=1e-9)
+    try:
+        with caplog.at_level(logging.WARNING, logger="rest_app.slow_query"):
+            storage.list(author="John Doe")
+        assert any("SELECT" in record.getMessage() for record in caplog.records)
+
+        caplog.clear()
+        storage.pool.slow_query_log.threshold = 0  # Disabled.
+        storage.list(author="John Doe")
+        assert not caplog.records
+    finally:
+        storage.close()
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_records_encoding(tmp_path, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(encoding, "orjson", None)  # Standard encoder.
+    books = [BookUpdate(author="John Doe", title="Awesome Novel", published_date="1980-02-15"),
+             BookUpdate(author="Jane \"Doe\"", title="Новая книга"),
+             BookUpdate()]
+    storages = [MemoryBookStorage(), MemoryBookStorage(compact=True), SQLiteBookStorage(str(tmp_path / "books.db"))]
+    for storage in storages:
+        try:
+            storage.create_many(books)
+            expected = [json.loads(book.json()) for book in storage.list()]
+            assert [json.loads(encoding.encode_record(record)) for record in storage.list_records()] == expected
+            assert [json.loads(encoding.encode_record(record)) for record in storage.iterate_records()] == expected
+            assert json.loads(b"".join(encoding.encode_records(storage.search_records("doe"), False))) == \
+                [json.loads(book.json()) for book in storage.search("doe")]
+        finally:
+            storage.close()
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_memory_snapshot(tmp_path, compact):
+    snapshot_path = str(tmp_path / "books.snapshot")
+    storage = PersistentMemoryBookStorage(snapshot_path, compact, fsync_interval=0)
+    first, second, third = storage.create_many([
+        BookUpdate(author="John Doe", title="Awesome Novel", published_date="1980-02-15"),
+        BookUpdate(author="Jane Doe", title="Новая книга"),
+        BookUpdate()])
+    storage.close()
+
+    # Changes after the snapshot are read from the log.
+    storage = PersistentMemoryBookStorage(snapshot_path, compact, fsync_interval=0)
+    assert storage.list() == [first, second, third]
+    storage.remove(second.id)
+    third.title = "Boring Novel"
+    storage.persist(third)
+    fourth = storage.create(BookUpdate(author="Jack Doe"))
+    storage.log.close()  # Process was stopped without snapshot.
+    with open(snapshot_path + ".log", "ab") as log:
+        log.write(b"P\x00")  # Incomplete entry.
+
+    storage = PersistentMemoryBookStorage(snapshot_path, compact, fsync_interval=0)
+    try:
+        assert storage.list() == [first, third, fourth]
+        assert storage.list(title="Boring*") == [third]
+        assert storage.search("jack") == [fourth]
+        assert storage.create(BookUpdate(title="Fifth")).id == fourth.id + 1
+        # Versions are restored too: tags that were read before the restart do not match changed books.
+        assert storage.find_versioned(third.id)[1] == 2
+        with pytest.raises(BookVersionConflictException):
+            storage.update_fields(third.id, {"title": "Lost Update"}, expected_version=1)
+        storage.update_fields(third.id, {"title": "Boring Novel 2"}, expected_version=2)
+    finally:
+        storage.close()
+
+    storage = PersistentMemoryBookStorage(snapshot_path, compact, fsync_interval=0)  # From the snapshot only.
+    try:
+        assert storage.find_versioned(first.id)[1] == 1
+        assert storage.find_versioned(third.id)[1] == 3
+    finally:
+        storage.close()
+
+
+def test_memory_snapshot_in_background(tmp_path):
+    snapshot_path = str(tmp_path / "books.snapshot")
+    storage = PersistentMemoryBookStorage(snapshot_path, fsync_interval=0, snapshot_log_size=1024)
+    books = storage.create_many([BookUpdate(author=f"Author {i}", title=f"Title {i}") for i in range(100)])
+    assert storage.snapshot_thread is not None
+    storage.snapshot_thread.join()
+    assert WriteLog.replay(snapshot_path + ".log", {}, {})[1] < len(books)  # Entries before the snapshot were removed.
+
+    storage.remove(books[0].id)
+    books[1].title = "Changed"
+    storage.persist(books[1])
+    storage.log.close()  # Process was stopped without the last snapshot.
+
+    storage = PersistentMemoryBookStorage(snapshot_path, fsync_interval=0)
+    try:
+        assert storage.list() == books[1:]
+        assert storage.find_versioned(books[1].id) == (books[1], 2)
+    finally:
+        storage.close()
+
+
+def test_sqlite_version_of_other_process(tmp_path):
+    # Storages with separate pools work with the database like different worker processes.
+    first = SQLiteBookStorage(str(tmp_path / "books.db"))
+    second = SQLiteBookStorage(str(tmp_path / "books.db"))
+    try:
+        first_version, second_version = first.version, second.version
+        assert first.version == first_version  # Not changed without writes.
+
+        book = first.create(BookUpdate(author="John Doe", title="Awesome Novel"))
+        assert first.version != first_version
+        assert second.version != second_version
+        assert second.list() == [book]
+
+        second_version = second.version
+        second.remove(book.id)
+        assert second.version != second_version
+        assert first.list() == []
+    finally:
+        first.close()
+        second.close()
+
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_sqlite_versioned_changes(tmp_path, returning):
+    storage = SQLiteBookStorage(str(tmp_path / "books.db"))
+    storage.returning = returning  # Without RETURNING (SQLite before 3.35) rows are read by another statement.
+    try:
+        book = storage.create(BookUpdate(author="John Doe", title="Awesome Novel"))
+        assert storage.find_versioned(book.id) == (book, 1)
+
+        book, version = storage.update_fields(book.id, {"author": None}, expected_version=1)
+        assert (book.author, book.title, version) == (None, "Awesome Novel", 2)
+        with pytest.raises(BookVersionConflictException) as conflict:
+            storage.update_fields(book.id, {"title": "Other"}, expected_version=1)
+        assert conflict.value.version == 2
+        with pytest.raises(BookVersionConflictException):
+            storage.delete_returning(book.id, expected_version=1)
+        with pytest.raises(BookNotFoundException):
+            storage.update_fields(book.id + 1, {"title": "Other"})
+
+        assert storage.delete_returning(book.id, expected_version=2) == book
+        with pytest.raises(BookNotFoundException):
+            storage.delete_returning(book.id)
+    finally:
+        storage.close()
+
+
+def test_sqlite_version_column_is_added(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "books.db")
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE books (id INTEGER PRIMARY KEY AUTOINCREMENT, author TEXT, title TEXT, "
+                           "published_date TEXT);")
+        connection.execute("INSERT INTO books(author, title) VALUES ('John Doe', 'Awesome Novel');")
+    connection.close()
+
+    storage = SQLiteBookStorage(path)
+    try:
+        assert storage.find_versioned(1)[1] == 1
+        assert storage.update_fields(1, {"title": "Other"})[1] == 2
+    finally:
+        storage.close()
+
+
+def test_memory_compact_shares_values():
+    storage = MemoryBookStorage(compact=True)
+    first, second = storage.create_many([BookUpdate(author="".join(["John", " Doe"]), published_date="1980-02-15")
+                                         for _ in range(2)])
+    assert storage.books[first.id].author is storage.books[second.id].author
+    assert storage.books[first.id].published_date is storage.books[second.id].published_date
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_memory_group_counters(compact):
+    books = [(1, "John Doe", "Awesome Novel", date(1980, 2, 15)), (2, "John Doe", "Tricky Story", None),
+             (3, None, "Awesome Story", date(1980, 6, 25))]
+    loaded = MemoryBookStorage(compact)
+    loaded.load(3, books)
+    created = MemoryBookStorage(compact)
+    created.create_many([BookUpdate(author=author, title=title, published_date=published_date)
+                         for _, author, title, published_date in books])
+    for storage in [loaded, created]:
+        assert storage.count_groups("author") == [("John Doe", 2), (None, 1)]
+        assert storage.count_groups("year") == [(None, 1), ("1980", 2)]
+        assert storage.count_groups("month") == [(None, 1), ("1980-02", 1), ("1980-06", 1)]
+        # Filtered groups are counted by scan of found books.
+        assert storage.count_groups("author", title="Awesome*") == [(None, 1), ("John Doe", 1)]
+
+
+def test_parse_iso_date():
+    from datetime import datetime
+
+    def parse_by_strptime(date_string: str):
+        for date_format in ["%Y-%m-%d", "%Y-%m", "%Y"]:
+            try:
+                return datetime.strptime(date_string, date_format).date()
+            except ValueError:
+                continue
+        return None
+
+    for date_string in ["2000-01-15", "2000-1-5", "2000-12", "2000-2", "2000", "0001-01-01", "2000-02-29", "2001-02-29",
+                        "2000-13-01", "2000-00", "2000-01-32", "200", "20000", "2000-01-", "2000/01/01", " 2000",
+                        "2000-01-01T00:00"]:
+        assert parse_iso_date(date_string) == parse_by_strptime(date_string), date_string
+
+
+def test_wildcard_matcher():
+    values = ["Awesome Novel", "Awesome Story", "Tricky Story", "Story", "", "a.b (c)", "a+b [c]"]
+    for pattern in ["Awesome", "Awesome*", "*Story", "*Story*", "Story", "*", "", "Aw?some", "A*S", "Tricky?Story"]:
+        # Patterns without special symbols of regular expressions are matched like before.
+        expected = re.compile(pattern.replace("?", ".?").replace("*", ".*"))
+        assert [value for value in values if wildcard_matcher(pattern)(value)] == \
+            [value for value in values if expected.match(value)], pattern
+
+    # Symbols of regular expressions are matched literally.
+    assert wildcard_matcher("a.b (c)")("a.b (c)") and not wildcard_matcher("a.b (c)")("axb c")
+    assert wildcard_matcher("a+b [c]")("a+b [c]") and not wildcard_matcher("a+b*")("aab")
+    assert wildcard_matcher("*(c)")("a.b (c)") and wildcard_matcher("a?b*[c]")("a+b [c]")
+    assert literal_prefix("a.b*c") == "a.b" and literal_prefix("*c") is None
+
+
+def test_memory_changes_after_restart(tmp_path):
+    snapshot_path = str(tmp_path / "books.snapshot")
+    storage = PersistentMemoryBookStorage(snapshot_path, fsync_interval=0)
+    first, second = storage.create_many([BookUpdate(author="John Doe"), BookUpdate(author="Jane Doe")])
+    storage.remove(first.id)
+    assert [(seq, book_id, record is None) for seq, book_id, record in storage.changes()] == \
+        [(2, second.id, False), (3, first.id, True)]
+    storage.log.close()  # Process was stopped without snapshot: numbers of changes are restored from the log.
+
+    storage = PersistentMemoryBookStorage(snapshot_path, fsync_interval=0)
+    try:
+        # Tombstones are not saved: old numbers can not be continued, but all books are new changes.
+        with pytest.raises(BookChangesCompactedException):
+            storage.changes(2)
+        assert storage.changes(3) == [(4, second.id, (second.id, "Jane Doe", None, None))]
+        assert storage.changes(0) == storage.changes(3)
+    finally:
+        storage.close()
+
+
+def test_sqlite_changes_of_existing_books(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "books.db")
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE books (id INTEGER PRIMARY KEY AUTOINCREMENT, author TEXT, title TEXT, "
+                           "published_date TEXT);")
+        connection.executemany("INSERT INTO books(author) VALUES (?);", [("John Doe",), ("Jane Doe",)])
+    connection.close()
+
+    storage = SQLiteBookStorage(path)
+    try:
+        assert [change[:2] for change in storage.changes()] == [(1, 1), (2, 2)]
+        storage.update_fields(1, {"title": "Awesome Novel"})
+        storage.remove_many([2])
+        assert storage.changes(2) == [(3, 1, (1, "John Doe", "Awesome Novel", None)), (4, 2, None)]
+        with pytest.raises(BookChangesCompactedException):
+            storage.changes(5)
+    finally:
+        storage.close()
+
+
+def test_sqlite_sharded_storage(tmp_path):
+    storage = ShardedSQLiteBookStorage(str(tmp_path), 3)
+    other_process = ShardedSQLiteBookStorage(str(tmp_path), 3)
+    try:
+        books = storage.create_many([BookUpdate(author=f"Author {i % 4}", title=f"Title {i}",
+                                                published_date=date(2000 + i % 2, 1, 1)) for i in range(10)])
+        assert [book.id for book in books] == list(range(1, 11))
+        assert [len(shard.list()) for shard in storage.shards] == [4, 3, 3]
+
+        # The next ID is taken by another process: the book is created again with the next free ID.
+        assert other_process.create(BookUpdate(author="Author 0")).id == 11
+        assert storage.create(BookUpdate(author="Author 0", title="Title 10")).id == 12
+
+        assert [book.id for book in storage.list(limit=5, after_id=3)] == [4, 5, 6, 7, 8]
+        by_author = [(book.author, book.id) for book in storage.list(order_by=BookOrder.author)]
+        assert by_author == sorted(by_author, key=lambda book: (book[0] or "", book[1]))
+        page = storage.list(limit=3, after_id=9, order_by=BookOrder.author)
+        assert [book.id for book in page] == [11, 12, 2]
+        assert [book.id for book in storage.iterate(title="Title 1*", batch_size=1)] == [2, 12]
+        found = storage.search("title")
+        assert sorted(book.id for book in found) == list(range(1, 11)) + [12]
+        assert storage.search("title", limit=3, offset=1) == found[1:4]
+
+        assert storage.count_groups(BookFacet.author, limit=2) == [("Author 0", 5), ("Author 1", 3)]
+        assert storage.count_groups(BookFacet.year) == [(None, 2), ("2000", 5), ("2001", 5)]
+
+        assert [book and book.id for book in storage.remove_many([5, 100, 6, 5])] == [5, None, 6, None]
+        assert storage.update_many([Book(id=7, title="New Title"), Book(id=5)])[0].title == "New Title"
+        assert storage.update_fields(8, {"title": "Other Title"})[0].title == "Other Title"
+        with pytest.raises(BookNotFoundException):
+            storage.find(5)
+        # Cursors of changes are numbers of changes of every shard.
+        changes = storage.changes()
+        assert sorted(book_id for _, book_id, record in changes if record is not None) == \
+               [book.id for book in storage.list()]
+        assert storage.changes(changes[-1][0]) == []
+        assert storage.changes(changes[2][0], limit=2) == changes[3:5]
+        with pytest.raises(BookChangesCompactedException):
+            storage.changes(5)  # Number of not sharded storage.
+    finally:
+        storage.close()
+        other_process.close()
+
+    with pytest.raises(ValueError):
+        ShardedSQLiteBookStorage(str(tmp_path), 2)